@@ -38,10 +38,19 @@ if res != nmsg_res_success:
     raise Exception, 'unable to initialize libnmsg'
 
 include "nmsg_msgmod.pyx"
+include "nmsg_schema.pyx"
+include "nmsg_filter.pyx"
+include "nmsg_stats.pyx"
+include "nmsg_profile.pyx"
 include "nmsg_message.pyx"
 include "nmsg_output.pyx"
 include "nmsg_msgtype.pyx"
 msgtype = _msgtype()
+include "nmsg_columns.pyx"
 include "nmsg_input.pyx"
+include "nmsg_sockinput.pyx"
+include "nmsg_filereader.pyx"
+include "nmsg_convert.pyx"
 include "nmsg_io.pyx"
+include "nmsg_fanout.pyx"
 include "nmsg_util.pyx"
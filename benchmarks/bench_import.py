@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2026 by Farsight Security, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Wall time of 'import nmsg' in a fresh interpreter, alone and followed by
+# a first message construction, which is where message modules are now
+# initialized. Each tree is a checkout with the extension built in place
+# (python setup.py build_ext -i). With --baseline the same snippets are
+# timed against that tree too, e.g. a worktree of the commit before the
+# lazy msgtype change:
+#
+#     git worktree add /tmp/pynmsg-base <commit>
+#     (cd /tmp/pynmsg-base && python setup.py build_ext -i)
+#     python benchmarks/bench_import.py --baseline /tmp/pynmsg-base
+from __future__ import print_function
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+SNIPPETS = [
+    ('python startup', 'pass'),
+    ('import nmsg', 'import nmsg'),
+    ('import + first message', 'import nmsg; nmsg.msgtype.base.dnsqr()'),
+]
+
+
+def run(code, count, tree):
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(p for p in (tree, env.get('PYTHONPATH')) if p)
+    times = []
+    for _ in range(count):
+        t0 = time.time()
+        # Run outside the tree so only PYTHONPATH decides which nmsg loads.
+        subprocess.check_call([ sys.executable, '-c', code ], env=env, cwd=os.sep)
+        times.append(time.time() - t0)
+    times.sort()
+    return times[len(times) // 2]
+
+
+def main():
+    p = argparse.ArgumentParser(description='pynmsg import time')
+    p.add_argument('-n', '--count', type=int, default=20, help='runs per snippet; the median is kept')
+    p.add_argument('--tree', default=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                   help='built tree to time (default: this checkout)')
+    p.add_argument('--baseline', help='built tree to compare against')
+    args = p.parse_args()
+
+    if args.baseline:
+        print('%-24s %10s %10s %8s' % ('', 'baseline', 'tree', 'change'))
+    for name, code in SNIPPETS:
+        t = run(code, args.count, args.tree)
+        if args.baseline:
+            base = run(code, args.count, args.baseline)
+            print('%-24s %7.1f ms %7.1f ms %+7.1f%%' % (name, base * 1000, t * 1000, (t / base - 1) * 100))
+        else:
+            print('%-24s %8.1f ms (median of %d)' % (name, t * 1000, args.count))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2026 by Farsight Security, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Per-message construction rate with the process-wide msgmod cache, and
+# without it. Before the cache, every message initialized and finalized its
+# own msgmod; that path is reproduced by building a msgmod directly next to
+# each cached construction.
+from __future__ import print_function
+
+import sys
+import time
+
+import nmsg
+
+
+def rate(fn, count):
+    t0 = time.time()
+    for _ in range(count):
+        fn()
+    return count / (time.time() - t0)
+
+
+def main(count):
+    cls = nmsg.msgtype.base.dnsqr
+    m = cls()
+    vid, msgtype = m.vid, m.msgtype
+    j = m.to_json().encode('utf-8')
+
+    def uncached(fn):
+        def run():
+            nmsg.msgmod(vid, msgtype)
+            fn()
+        return run
+
+    cases = [
+        ('message construction', cls),
+        ('message.from_json', lambda: nmsg.message.from_json(j)),
+    ]
+
+    print('%-22s %12s %12s %8s' % ('', 'uncached/s', 'cached/s', 'speedup'))
+    for name, fn in cases:
+        off = rate(uncached(fn), count)
+        on = rate(fn, count)
+        print('%-22s %12.0f %12.0f %7.2fx' % (name, off, on, on / off))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
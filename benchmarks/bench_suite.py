@@ -0,0 +1,312 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2026 by Farsight Security, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Throughput of the binding's hot paths over synthetic data. Runs offline:
+# every input is generated into a temporary directory from a fixed seed.
+#
+#   bench_suite.py [-n COUNT] [-r REPEAT] [-o results.json]
+#   bench_suite.py --compare old.json new.json
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import nmsg
+
+
+def fill_ncap(m, i, rnd):
+    m['type'] = 'IPV4'
+    m['srcip'] = '10.%d.%d.%d' % (rnd.randint(0, 255), rnd.randint(0, 255), rnd.randint(1, 254))
+    m['dstip'] = '192.0.2.%d' % rnd.randint(1, 254)
+    m['proto'] = 17
+    m['srcport'] = rnd.randint(1024, 65535)
+    m['dstport'] = 53
+    m['payload'] = bytes(bytearray(rnd.getrandbits(8) for _ in range(64)))
+
+
+def fill_dnsqr(m, i, rnd):
+    m['type'] = 'UDP_QUERY_RESPONSE'
+    m['query_ip'] = '198.51.100.%d' % rnd.randint(1, 254)
+    m['response_ip'] = '203.0.113.%d' % rnd.randint(1, 254)
+    m['proto'] = 17
+    m['query_port'] = rnd.randint(1024, 65535)
+    m['response_port'] = 53
+    m['id'] = rnd.randint(0, 65535)
+    m['qname'] = b'\x04host\x07example\x03com\x00'
+    m['qclass'] = 1
+    m['qtype'] = 1
+    m['rcode'] = 0
+    m['query_time_sec'] = [ 1700000000 + i ]
+    m['query_time_nsec'] = [ 0 ]
+    m['response_time_sec'] = [ 1700000000 + i ]
+    m['response_time_nsec'] = [ 5000 ]
+
+
+def fill_dnsdedupe(m, i, rnd):
+    m['type'] = 'INSERTION'
+    m['count'] = rnd.randint(1, 1000)
+    m['time_first'] = 1700000000 + i
+    m['time_last'] = 1700000000 + i + rnd.randint(0, 3600)
+    m['response_ip'] = '203.0.113.%d' % rnd.randint(1, 254)
+    m['bailiwick'] = b'\x07example\x03com\x00'
+    m['rrname'] = b'\x04host\x07example\x03com\x00'
+    m['rrclass'] = 1
+    m['rrtype'] = 1
+    m['rrttl'] = 3600
+    m['rdata'] = [ bytes(bytearray([ 192, 0, 2, rnd.randint(1, 254) ])) ]
+
+
+def fill_encode(m, i, rnd):
+    m['type'] = 'TEXT'
+    m['payload'] = ('message %d' % i).encode('ascii')
+
+
+# (name, vendor, msgtype, fill function). Modules that are not installed
+# are skipped.
+SPECS = [
+    ('ncap', 'base', 'ncap', fill_ncap),
+    ('dnsqr', 'base', 'dnsqr', fill_dnsqr),
+    ('dnsdedupe', 'SIE', 'dnsdedupe', fill_dnsdedupe),
+    ('encode', 'base', 'encode', fill_encode),
+]
+
+
+def message_class(vname, mname):
+    for v in (vname, vname.lower()):
+        cls = getattr(getattr(nmsg.msgtype, v, None), mname, None)
+        if cls is not None:
+            return cls
+    return None
+
+
+def make_messages(cls, fill, count, seed):
+    rnd = random.Random(seed)
+    msgs = []
+    for i in range(count):
+        m = cls()
+        m.time_sec = 1700000000 + i
+        m.time_nsec = 0
+        fill(m, i, rnd)
+        msgs.append(m)
+    return msgs
+
+
+def write_file(path, msgs):
+    o = nmsg.output.open_file(path)
+    for m in msgs:
+        o.write(m)
+    o.flush()
+    o.close()
+    o.fileobj.close()
+
+
+# Splits an NMSG file into its containers, each usable as a nullinput
+# buffer.
+def file_containers(path):
+    with open(path, 'rb') as f:
+        buf = f.read()
+    hdr = bytearray(buf)
+    out = []
+    off = 0
+    while off + 10 <= len(buf):
+        n = hdr[off + 6] << 24 | hdr[off + 7] << 16 | hdr[off + 8] << 8 | hdr[off + 9]
+        out.append(buf[off:off + 10 + n])
+        off += 10 + n
+    return out
+
+
+def best(fn, repeat):
+    # Minimum over repeats: the least disturbed run.
+    t = None
+    for _ in range(repeat):
+        t0 = time.time()
+        fn()
+        dt = time.time() - t0
+        if t is None or dt < t:
+            t = dt
+    return t
+
+
+def bench_type(name, cls, fill, count, repeat, tmpdir, seed):
+    msgs = make_messages(cls, fill, count, seed)
+    path = os.path.join(tmpdir, '%s.nmsg' % name)
+    write_file(path, msgs)
+    containers = file_containers(path)
+    jsons = [ m.to_json() for m in msgs ]
+
+    def file_read():
+        i = nmsg.input.open_file(path)
+        while i.read_many(1000):
+            pass
+        i.close()
+
+    def nullinput_read():
+        ni = nmsg.nullinput()
+        for c in containers:
+            ni.read(c)
+
+    def construct():
+        for _ in range(count):
+            cls()
+
+    def write_file_out():
+        write_file(os.path.join(tmpdir, 'out.nmsg'), msgs)
+
+    def write_json_out():
+        o = nmsg.output.open_json(os.path.join(tmpdir, 'out.json'))
+        for m in msgs:
+            o.write(m)
+        o.flush()
+        o.close()
+        o.fileobj.close()
+
+    def write_callback():
+        o = nmsg.output.open_callback(lambda m: None)
+        for m in msgs:
+            o.write(m)
+
+    def to_json():
+        for m in msgs:
+            m.to_json()
+
+    def from_json():
+        for j in jsons:
+            nmsg.message.from_json(j)
+
+    def io_loop():
+        io = nmsg.io()
+        io.add_input(nmsg.input.open_file(path))
+        io.add_output_callback(lambda m: None)
+        io.loop()
+
+    cases = [
+        ('file_read', file_read),
+        ('nullinput_read', nullinput_read),
+        ('message_construction', construct),
+        ('write_file', write_file_out),
+        ('write_json', write_json_out),
+        ('write_callback', write_callback),
+        ('to_json', to_json),
+        ('from_json', from_json),
+        ('io_loop_callback', io_loop),
+    ]
+
+    results = {}
+    for case, fn in cases:
+        dt = best(fn, repeat)
+        results[case] = {
+            'seconds': dt,
+            'msgs_per_sec': count / dt if dt > 0 else None,
+        }
+    results['_input'] = {
+        'messages': count,
+        'bytes': os.path.getsize(path),
+        'containers': len(containers),
+    }
+    return results
+
+
+def git_revision():
+    try:
+        out = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                      cwd=os.path.dirname(os.path.abspath(__file__)),
+                                      stderr=subprocess.STDOUT)
+        return out.decode('ascii').strip()
+    except Exception:
+        return None
+
+
+def run(args):
+    tmpdir = tempfile.mkdtemp(prefix='nmsg-bench-')
+    try:
+        results = {}
+        for name, vname, mname, fill in SPECS:
+            if args.only and name not in args.only:
+                continue
+            cls = message_class(vname, mname)
+            if cls is None:
+                print('%-12s skipped: %s/%s not available' % (name, vname, mname), file=sys.stderr)
+                continue
+            results[name] = bench_type(name, cls, fill, args.count, args.repeat, tmpdir, args.seed)
+            for case in sorted(results[name]):
+                r = results[name][case]
+                if case.startswith('_'):
+                    continue
+                print('%-12s %-22s %12.0f msgs/s' % (name, case, r['msgs_per_sec'] or 0))
+    finally:
+        shutil.rmtree(tmpdir)
+
+    return {
+        'meta': {
+            'time': time.time(),
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'count': args.count,
+            'repeat': args.repeat,
+            'seed': args.seed,
+        },
+        'results': results,
+    }
+
+
+def compare(old_path, new_path):
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    print('%-12s %-22s %12s %12s %8s' % ('type', 'case', 'old msgs/s', 'new msgs/s', 'change'))
+    for name in sorted(new['results']):
+        for case in sorted(new['results'][name]):
+            if case.startswith('_'):
+                continue
+            n = new['results'][name][case]['msgs_per_sec']
+            o = old['results'].get(name, {}).get(case, {}).get('msgs_per_sec')
+            if not n or not o:
+                continue
+            print('%-12s %-22s %12.0f %12.0f %+7.1f%%' % (name, case, o, n, (n / o - 1) * 100))
+
+
+def main():
+    p = argparse.ArgumentParser(description='pynmsg hot path benchmarks')
+    p.add_argument('-n', '--count', type=int, default=20000, help='messages per type')
+    p.add_argument('-r', '--repeat', type=int, default=3, help='runs per case; the fastest is kept')
+    p.add_argument('-s', '--seed', type=int, default=1)
+    p.add_argument('-o', '--output', help='write results as JSON to this file')
+    p.add_argument('--only', action='append', help='benchmark only this message type')
+    p.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two result files')
+    args = p.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    doc = run(args)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(doc, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
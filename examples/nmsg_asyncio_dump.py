@@ -0,0 +1,34 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2026 by Farsight Security, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import sys
+
+import nmsg
+import nmsg_asyncio
+
+
+async def main(ip, port):
+    ni = nmsg.input.open_sock(ip, port)
+    async for m in nmsg_asyncio.iter_input(ni):
+        nmsg.print_nmsg_header(m, sys.stdout)
+        for key in m.keys():
+            print('%s: %s' % (key, m[key]))
+        print()
+
+
+if __name__ == '__main__':
+    asyncio.run(main(sys.argv[1], sys.argv[2]))
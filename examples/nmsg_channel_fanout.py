@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2026 by Farsight Security, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import print_function
+
+import nmsg
+import sys
+
+
+def count_rrname(m):
+    if 'rrname' in m:
+        m['rrname']
+
+
+def main(ch, workers):
+    f = nmsg.fanout(ch, count_rrname, workers=workers, lazy=True)
+    f.run()
+    for index, c in enumerate(f.counters()):
+        print('worker %d: %r' % (index, c))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else None)
@@ -29,7 +29,7 @@ cdef extern from "stdint.h":
     ctypedef signed int int32_t
     ctypedef signed long long int64_t
 
-cdef extern from "stdlib.h":
+cdef extern from "stdlib.h" nogil:
     ctypedef unsigned long size_t
     void free(void *ptr)
     void *malloc(size_t size)
@@ -41,6 +41,11 @@ cdef extern from "time.h":
     struct timespec:
         long tv_sec
         long tv_nsec
+
+    cdef enum:
+        CLOCK_MONOTONIC
+
+    int clock_gettime(int clk_id, timespec *tp) nogil
  
 cdef extern from "Python.h":
     void Py_INCREF(object)
@@ -163,6 +168,13 @@ cdef extern from "nmsg.h" nogil:
 
     ctypedef void (*nmsg_cb_message)(nmsg_message_t, void *user)
 
+    ctypedef enum nmsg_filter_message_verdict:
+        nmsg_filter_message_verdict_DECLINED
+        nmsg_filter_message_verdict_DROP
+        nmsg_filter_message_verdict_ACCEPT
+
+    ctypedef nmsg_res (*nmsg_filter_message_fp)(nmsg_message_t *msg, void *user, nmsg_filter_message_verdict *vres)
+
     nmsg_res            nmsg_init()
     void                nmsg_set_autoclose(bool)
     void                nmsg_set_debug(int)
@@ -200,6 +212,7 @@ cdef extern from "nmsg.h" nogil:
     nmsg_res            nmsg_message_get_field_by_idx(nmsg_message_t msg, unsigned field_idx, unsigned val_idx, void **data, size_t *len)
     nmsg_res            nmsg_message_get_field_flags_by_idx(nmsg_message_t msg, unsigned field_idx, unsigned *flags)
     nmsg_res            nmsg_message_set_field(nmsg_message_t msg, char *field_name, unsigned val_idx, uint8_t *data, size_t len)
+    nmsg_res            nmsg_message_set_field_by_idx(nmsg_message_t msg, unsigned field_idx, unsigned val_idx, uint8_t *data, size_t len)
 
 
     int32_t             nmsg_message_get_vid(nmsg_message_t msg)
@@ -231,6 +244,7 @@ cdef extern from "nmsg.h" nogil:
     void                nmsg_input_set_filter_operator(nmsg_input_t input, unsigned operator)
     void                nmsg_input_set_filter_group(nmsg_input_t input, unsigned group)
     nmsg_res            nmsg_input_set_blocking_io(nmsg_input_t input, bool flag)
+    void                nmsg_input_set_filter_func(nmsg_input_t input, nmsg_filter_message_fp fp, void *user)
 
     nmsg_output_t       nmsg_output_open_file(int fd, size_t bufsz)
     nmsg_output_t       nmsg_output_open_json(int fd)
@@ -248,6 +262,14 @@ cdef extern from "nmsg.h" nogil:
     void                nmsg_output_set_group(nmsg_output_t output, unsigned group)
     void                nmsg_output_set_zlibout(nmsg_output_t output, bool zlibout)
 
+    nmsg_rate_t         nmsg_rate_init(unsigned rate, unsigned freq)
+    void                nmsg_rate_destroy(nmsg_rate_t *rate)
+    void                nmsg_rate_sleep(nmsg_rate_t rate) nogil
+
+    nmsg_zbuf_t         nmsg_zbuf_inflate_init()
+    nmsg_res            nmsg_zbuf_inflate(nmsg_zbuf_t zb, size_t len, uint8_t *buf, size_t *u_len, uint8_t **u_buf)
+    void                nmsg_zbuf_destroy(nmsg_zbuf_t *zb)
+
     nmsg_res            nmsg_ipdg_parse(nmsg_ipdg *, unsigned etype, size_t, unsigned char *pkt)
 
     nmsg_res            nmsg_message_from_json(char *, nmsg_message_t *) nogil
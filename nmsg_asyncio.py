@@ -0,0 +1,143 @@
+# Copyright (c) 2026 by Farsight Security, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# asyncio bindings for nmsg inputs, outputs and io loops. Requires Python 3.7+.
+
+import asyncio
+import concurrent.futures
+
+import nmsg
+
+_END = object()
+
+
+async def iter_input(i, batch=256):
+    # Switches a socket input to non-blocking mode and yields every message
+    # that is ready each time the event loop reports the fd readable.
+    loop = asyncio.get_running_loop()
+    fd = i.fileno()
+    i.set_blocking_io(False)
+
+    while True:
+        msgs = i.read_many(batch)
+        if msgs:
+            for m in msgs:
+                yield m
+            continue
+
+        ready = loop.create_future()
+
+        def wakeup():
+            if not ready.done():
+                ready.set_result(None)
+
+        loop.add_reader(fd, wakeup)
+        try:
+            await ready
+        finally:
+            loop.remove_reader(fd)
+
+
+class AsyncOutput(object):
+    # Gives a file or socket output the native writer thread of
+    # output.set_async(), so serialization and I/O never run on the event
+    # loop. Writes keep their order; when the queue is full, write() waits
+    # for room without blocking the loop. Callback outputs run in the
+    # caller and are written to directly.
+    def __init__(self, output, queue_size=1024):
+        self.output = output
+        self.queue_size = queue_size
+        self._native = output.output_type != 'callback'
+        if self._native:
+            output.set_async(queue_size, 'block')
+
+    async def write(self, msg):
+        if self._native:
+            while self.output.async_stats()['depth'] >= self.queue_size:
+                await asyncio.sleep(0.001)
+        self.output.write(msg)
+
+    async def flush(self):
+        # Waits for the writer thread to drain its queue.
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.output.flush)
+
+    async def close(self):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.output.close)
+
+
+class AsyncIO(object):
+    # Runs nmsg.io.loop() on a worker thread and delivers its messages to
+    # an asyncio.Queue of maxsize entries. When the queue is full the
+    # libnmsg io thread waits, which pushes back on the inputs.
+    #
+    # Configure inputs and filters through the io attribute, then iterate:
+    #
+    #     aio = AsyncIO()
+    #     aio.io.add_input_channel('ch202')
+    #     async for msg in aio:
+    #         ...
+    def __init__(self, maxsize=1024, lazy=False):
+        self.io = nmsg.io()
+        self.maxsize = maxsize
+        self.lazy = lazy
+        self.queue = None
+        self._loop = None
+        self._task = None
+        self._stopping = False
+
+    def _deliver(self, msg):
+        fut = asyncio.run_coroutine_threadsafe(self.queue.put(msg), self._loop)
+        while True:
+            try:
+                fut.result(timeout=0.1)
+                return
+            except concurrent.futures.TimeoutError:
+                if self._stopping:
+                    fut.cancel()
+                    return
+
+    def _finished(self, fut):
+        if self.queue.full():
+            self._loop.create_task(self.queue.put(_END))
+        else:
+            self.queue.put_nowait(_END)
+
+    def start(self):
+        if self._task is not None:
+            return
+        self._loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(maxsize=self.maxsize)
+        self.io.add_output_callback(self._deliver, lazy=self.lazy)
+        self._task = self._loop.run_in_executor(None, self.io.loop)
+        self._task.add_done_callback(self._finished)
+
+    def stop(self):
+        self._stopping = True
+        self.io.break_loop()
+
+    async def wait(self):
+        if self._task is not None:
+            await self._task
+
+    def __aiter__(self):
+        self.start()
+        return self
+
+    async def __anext__(self):
+        msg = await self.queue.get()
+        if msg is _END:
+            raise StopAsyncIteration
+        return msg
@@ -0,0 +1,379 @@
+#cython: embedsignature=True
+
+# Copyright (c) 2026 by Farsight Security, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from cpython.buffer cimport PyBuffer_FillInfo
+from libc.string cimport memcpy, memset
+
+cdef size_t _IP_RECORD = 16
+
+# Growable native buffer backing one column array. It exports its data
+# through the buffer protocol, so a numpy array can use it in place.
+cdef class _colbuf(object):
+    cdef char *data
+    cdef size_t len
+    cdef size_t cap
+    cdef size_t exports
+
+    def __cinit__(self):
+        self.data = NULL
+        self.len = 0
+        self.cap = 0
+        self.exports = 0
+
+    def __dealloc__(self):
+        free(self.data)
+
+    def __getbuffer__(self, Py_buffer *view, int flags):
+        PyBuffer_FillInfo(view, self, self.data, self.len, 1, flags)
+        self.exports += 1
+
+    def __releasebuffer__(self, Py_buffer *view):
+        self.exports -= 1
+
+    cdef int reserve(self, size_t n) except -1:
+        cdef size_t cap
+        cdef char *data
+
+        if self.len + n <= self.cap:
+            return 0
+        if self.exports > 0:
+            raise BufferError('column buffer is exported')
+        cap = self.cap * 2 if self.cap else 4096
+        while cap < self.len + n:
+            cap *= 2
+        data = <char *> realloc(self.data, cap)
+        if data == NULL:
+            raise MemoryError()
+        self.data = data
+        self.cap = cap
+        return 0
+
+    cdef int append(self, const void *p, size_t n) except -1:
+        self.reserve(n)
+        memcpy(self.data + self.len, p, n)
+        self.len += n
+        return 0
+
+    cdef int append_zero(self, size_t n) except -1:
+        self.reserve(n)
+        memset(self.data + self.len, 0, n)
+        self.len += n
+        return 0
+
+    cdef int append_int64(self, int64_t v) except -1:
+        return self.append(&v, sizeof(v))
+
+    # Both exports are read-only views whose base keeps this buffer alive:
+    # a numpy array when numpy is available, otherwise a memoryview cast to
+    # the column's type. Python 2 memoryviews cannot be cast, so there the
+    # data is copied into an array.array.
+    cdef export(self, typecode, dtype):
+        if self.len == 0:
+            src = b''
+        else:
+            src = self
+        if numpy is not None:
+            return numpy.frombuffer(src, dtype=dtype)
+        mv = memoryview(src)
+        if hasattr(mv, 'cast'):
+            return mv.cast(typecode)
+        a = array.array(typecode)
+        a.fromstring(mv.tobytes())
+        return a
+
+cdef class column(object):
+    cdef readonly object name
+    cdef readonly int field_type
+    cdef readonly bool repeated
+    # Per-row validity: 1 if the field was present in the message.
+    cdef readonly object valid
+    # Repeated fields only: row i owns values[offsets[i]:offsets[i + 1]].
+    cdef readonly object offsets
+    # Fixed-width values, concatenated bytes/string data, or 16-byte IP records.
+    cdef readonly object values
+    # Bytes and string fields: value j is values[value_offsets[j]:value_offsets[j + 1]].
+    cdef readonly object value_offsets
+    # IP fields: 4 or 16 for each record, 0 for padding of absent values.
+    cdef readonly object value_lengths
+    # Enum fields: name for each numeric value that appears in values.
+    cdef readonly object enum_names
+
+    def __repr__(self):
+        return 'nmsg column %s type=%d repeated=%s rows=%d' % (self.name, self.field_type, self.repeated != 0, len(self.valid))
+
+cdef class columns(object):
+    cdef readonly unsigned vid
+    cdef readonly unsigned msgtype
+    cdef readonly size_t n
+    cdef readonly object time_sec
+    cdef readonly object time_nsec
+    cdef readonly object source
+    cdef readonly object operator
+    cdef readonly object group
+    cdef readonly dict fields
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, key):
+        return self.fields[key]
+
+    def __contains__(self, key):
+        return key in self.fields
+
+    def keys(self):
+        return self.fields.keys()
+
+    def __repr__(self):
+        return 'nmsg columns [%d:%d] rows=%d fields=%s' % (self.vid, self.msgtype, self.n, list(self.fields))
+
+cdef class _column_builder(object):
+    cdef object name
+    cdef unsigned field_idx
+    cdef nmsg_msgmod_field_type field_type
+    cdef bint repeated
+    cdef size_t width
+    cdef size_t n_values
+    cdef _colbuf valid
+    cdef _colbuf offsets
+    cdef _colbuf values
+    cdef _colbuf value_offsets
+    cdef _colbuf value_lengths
+
+    def __cinit__(self):
+        self.valid = _colbuf()
+        self.offsets = _colbuf()
+        self.values = _colbuf()
+        self.value_offsets = _colbuf()
+        self.value_lengths = _colbuf()
+        self.n_values = 0
+
+    cdef int setup(self, _schema schema, unsigned field_idx) except -1:
+        cdef nmsg_msgmod_field_type ft = schema.c_types[field_idx]
+
+        self.name = schema.names[field_idx]
+        self.field_idx = field_idx
+        self.field_type = ft
+        self.repeated = schema.c_flags[field_idx] & NMSG_MSGMOD_FIELD_REPEATED
+        if ft == nmsg_msgmod_ft_uint64 or ft == nmsg_msgmod_ft_int64 or ft == nmsg_msgmod_ft_double:
+            self.width = 8
+        elif ft == nmsg_msgmod_ft_bool:
+            self.width = 1
+        elif ft == nmsg_msgmod_ft_ip:
+            self.width = _IP_RECORD
+        elif ft == nmsg_msgmod_ft_bytes or ft == nmsg_msgmod_ft_string or ft == nmsg_msgmod_ft_mlstring:
+            self.width = 0
+            self.value_offsets.append_int64(0)
+        else:
+            self.width = 4
+        if self.repeated:
+            self.offsets.append_int64(0)
+        return 0
+
+    cdef int add_value(self, uint8_t *data, size_t data_len) except -1:
+        cdef uint8_t val_bool
+        cdef uint8_t ip_len
+
+        if self.width == 0:
+            if self.field_type != nmsg_msgmod_ft_bytes and data_len > 0 and data[data_len - 1] == 0:
+                data_len -= 1
+            self.values.append(data, data_len)
+            self.value_offsets.append_int64(self.values.len)
+        elif self.field_type == nmsg_msgmod_ft_ip:
+            ip_len = data_len if data_len <= _IP_RECORD else 0
+            self.values.append(data, ip_len)
+            self.values.append_zero(_IP_RECORD - ip_len)
+            self.value_lengths.append(&ip_len, 1)
+        elif self.field_type == nmsg_msgmod_ft_bool:
+            val_bool = (<int *> data)[0] != 0
+            self.values.append(&val_bool, 1)
+        else:
+            self.values.append(data, self.width)
+        self.n_values += 1
+        return 0
+
+    cdef int add_absent(self) except -1:
+        cdef uint8_t zero = 0
+
+        if self.width == 0:
+            self.value_offsets.append_int64(self.values.len)
+        else:
+            self.values.append_zero(self.width)
+            if self.field_type == nmsg_msgmod_ft_ip:
+                self.value_lengths.append(&zero, 1)
+        self.n_values += 1
+        return 0
+
+    cdef int add(self, nmsg_message_t instance) except -1:
+        cdef uint8_t present
+        cdef unsigned val_idx = 0
+        cdef uint8_t *data
+        cdef size_t data_len
+
+        while nmsg_message_get_field_by_idx(instance, self.field_idx, val_idx, <void **> &data, &data_len) == nmsg_res_success:
+            self.add_value(data, data_len)
+            val_idx += 1
+            if not self.repeated:
+                break
+
+        present = val_idx > 0
+        self.valid.append(&present, 1)
+        if self.repeated:
+            self.offsets.append_int64(self.n_values)
+        elif not present:
+            self.add_absent()
+        return 0
+
+    cdef column finish(self, _schema schema, nmsg_message_t template):
+        cdef column col = column()
+        cdef nmsg_msgmod_field_type ft = self.field_type
+
+        col.name = self.name
+        col.field_type = ft
+        col.repeated = self.repeated
+        col.valid = self.valid.export('B', 'bool')
+        if self.repeated:
+            col.offsets = self.offsets.export('q', '=i8')
+
+        if self.width == 0:
+            col.values = self.values.export('B', 'u1')
+            col.value_offsets = self.value_offsets.export('q', '=i8')
+        elif ft == nmsg_msgmod_ft_ip:
+            col.values = self.values.export('B', 'u1')
+            if numpy is not None:
+                col.values = col.values.reshape(-1, _IP_RECORD)
+            col.value_lengths = self.value_lengths.export('B', 'u1')
+        elif ft == nmsg_msgmod_ft_uint64:
+            col.values = self.values.export('Q', '=u8')
+        elif ft == nmsg_msgmod_ft_int64:
+            col.values = self.values.export('q', '=i8')
+        elif ft == nmsg_msgmod_ft_double:
+            col.values = self.values.export('d', '=f8')
+        elif ft == nmsg_msgmod_ft_bool:
+            col.values = self.values.export('B', 'bool')
+        elif ft == nmsg_msgmod_ft_int16 or ft == nmsg_msgmod_ft_int32:
+            col.values = self.values.export('i', '=i4')
+        else:
+            col.values = self.values.export('I', '=u4')
+
+        if ft == nmsg_msgmod_ft_enum:
+            col.enum_names = {}
+            for v in set(int(x) for x in col.values):
+                col.enum_names[v] = schema.enum_name(template, self.field_idx, v)
+        return col
+
+cdef class _columns_builder(object):
+    cdef unsigned vid
+    cdef unsigned msgtype
+    cdef size_t n
+    cdef _schema schema
+    cdef nmsg_message_t template
+    cdef list builders
+    cdef _colbuf time_sec
+    cdef _colbuf time_nsec
+    cdef _colbuf source
+    cdef _colbuf operator
+    cdef _colbuf group
+
+    def __cinit__(self):
+        self.template = NULL
+
+    def __dealloc__(self):
+        if self.template != NULL:
+            nmsg_message_destroy(&self.template)
+
+    def __init__(self, vid, msgtype, fields=None):
+        cdef _column_builder b
+
+        if type(vid) == str:
+            vid = msgmod_vname_to_vid(vid)
+        if type(msgtype) == str:
+            msgtype = msgmod_mname_to_msgtype(vid, msgtype)
+        self.vid = vid
+        self.msgtype = msgtype
+        self.n = 0
+
+        # An empty message of the requested type supplies the schema and
+        # enum names without waiting for the first matching message.
+        self.template = nmsg_message_init(_get_msgmod(self.vid, self.msgtype)._instance)
+        if self.template == NULL:
+            raise Exception, 'nmsg_message_init() failed'
+        self.schema = _get_schema(self.template)
+
+        if fields is None:
+            fields = self.schema.names
+        self.builders = []
+        for name in fields:
+            b = _column_builder()
+            b.setup(self.schema, self.schema.idx[name])
+            self.builders.append(b)
+
+        self.time_sec = _colbuf()
+        self.time_nsec = _colbuf()
+        self.source = _colbuf()
+        self.operator = _colbuf()
+        self.group = _colbuf()
+
+    cdef bint matches(self, nmsg_message_t instance):
+        return <unsigned> nmsg_message_get_vid(instance) == self.vid and \
+            <unsigned> nmsg_message_get_msgtype(instance) == self.msgtype
+
+    cdef int add(self, nmsg_message_t instance) except -1:
+        cdef timespec ts
+        cdef int64_t sec
+        cdef uint32_t u
+        cdef _column_builder b
+
+        nmsg_message_get_time(instance, &ts)
+        sec = ts.tv_sec
+        self.time_sec.append(&sec, sizeof(sec))
+        u = ts.tv_nsec
+        self.time_nsec.append(&u, sizeof(u))
+        u = nmsg_message_get_source(instance)
+        self.source.append(&u, sizeof(u))
+        u = nmsg_message_get_operator(instance)
+        self.operator.append(&u, sizeof(u))
+        u = nmsg_message_get_group(instance)
+        self.group.append(&u, sizeof(u))
+
+        for b in self.builders:
+            b.add(instance)
+        self.n += 1
+        return 0
+
+    cdef columns finish(self):
+        cdef columns c = columns()
+        cdef _column_builder b
+
+        c.vid = self.vid
+        c.msgtype = self.msgtype
+        c.n = self.n
+        c.time_sec = self.time_sec.export('q', '=i8')
+        c.time_nsec = self.time_nsec.export('I', '=u4')
+        c.source = self.source.export('I', '=u4')
+        c.operator = self.operator.export('I', '=u4')
+        c.group = self.group.export('I', '=u4')
+        c.fields = {}
+        for b in self.builders:
+            c.fields[b.name] = b.finish(self.schema, self.template)
+        return c
@@ -0,0 +1,465 @@
+#cython: embedsignature=True
+
+# Copyright (c) 2026 by Farsight Security, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Bulk NMSG <-> JSONL conversion. Messages never become Python objects:
+# each batch is read, converted and written by libnmsg with the GIL
+# released, and the GIL is only taken between batches to check for
+# signals.
+
+from multiprocessing.pool import ThreadPool
+
+from libc.errno cimport errno, EINTR, ENOMEM
+from libc.string cimport memcpy, memchr
+from posix.unistd cimport write
+
+# Messages converted per nogil batch on the sequential paths.
+cdef size_t _CONVERT_BATCH = 4096
+
+cdef struct _wbuf:
+    char *data
+    size_t len
+    size_t size
+
+cdef int _wbuf_append(_wbuf *w, const char *s, size_t n) nogil:
+    cdef size_t size
+    cdef char *data
+
+    if w.len + n > w.size:
+        size = w.size * 2 if w.size else 65536
+        while size < w.len + n:
+            size *= 2
+        data = <char *> realloc(w.data, size)
+        if data == NULL:
+            return ENOMEM
+        w.data = data
+        w.size = size
+    memcpy(w.data + w.len, s, n)
+    w.len += n
+    return 0
+
+cdef void _wbuf_free(_wbuf *w) nogil:
+    free(w.data)
+    w.data = NULL
+    w.len = 0
+    w.size = 0
+
+# Returns 0 or an errno value.
+cdef int _write_all(int fd, const char *p, size_t n) nogil:
+    cdef ssize_t r
+
+    while n > 0:
+        r = write(fd, p, n)
+        if r < 0:
+            if errno == EINTR:
+                continue
+            return errno
+        p += r
+        n -= r
+    return 0
+
+# Appends one message as a JSON line. Returns 0, 1 if libnmsg could not
+# render the message, or ENOMEM.
+cdef int _append_json(_wbuf *w, nmsg_message_t m) nogil:
+    cdef char *s
+    cdef int err
+
+    if nmsg_message_to_json(m, &s) != nmsg_res_success:
+        return 1
+    err = _wbuf_append(w, s, strlen(s))
+    free(s)
+    if err == 0:
+        err = _wbuf_append(w, '\n', 1)
+    return err
+
+# f is the file opened by _open_src() or _open_dst() that the error is
+# about, if any.
+cdef _raise_errno(int err, f=None):
+    if err == ENOMEM:
+        raise MemoryError()
+    if f is not None:
+        raise IOError(err, os.strerror(err), os.fsdecode(f.name))
+    raise IOError(err, os.strerror(err))
+
+# Converts the containers in p[start:end] to JSON lines in w.
+cdef int _jsonl_range(nmsg_input_t ni, const uint8_t *p, size_t start, size_t end, _wbuf *w,
+                      uint64_t *messages, uint64_t *errors) nogil:
+    cdef size_t off = start
+    cdef size_t length
+    cdef size_t n_msg
+    cdef size_t i
+    cdef nmsg_message_t *msgs
+    cdef nmsg_res res
+    cdef int err = 0
+    cdef int e
+
+    while off + _NMSG_HDRSIZE <= end:
+        length = (<uint32_t> p[off + 6] << 24) | (<uint32_t> p[off + 7] << 16) | \
+                 (<uint32_t> p[off + 8] << 8) | p[off + 9]
+        res = nmsg_input_read_null(ni, <uint8_t *> p + off, _NMSG_HDRSIZE + length, NULL, &msgs, &n_msg)
+        off += _NMSG_HDRSIZE + length
+        if res == nmsg_res_again:
+            continue
+        if res != nmsg_res_success:
+            errors[0] += 1
+            continue
+        for i in range(n_msg):
+            if err == 0:
+                e = _append_json(w, msgs[i])
+                if e == 1:
+                    errors[0] += 1
+                elif e != 0:
+                    err = e
+                else:
+                    messages[0] += 1
+            nmsg_message_destroy(&msgs[i])
+        free(msgs)
+        if err != 0:
+            return err
+    return 0
+
+cdef class _jsonl_chunk(object):
+    cdef const uint8_t *p
+    cdef size_t start
+    cdef size_t end
+    cdef _wbuf w
+    cdef uint64_t messages
+    cdef uint64_t errors
+    cdef int err
+
+    def __dealloc__(self):
+        _wbuf_free(&self.w)
+
+    def run(self):
+        cdef nmsg_input_t ni = nmsg_input_open_null()
+
+        if ni == NULL:
+            raise Exception, 'nmsg_input_open_null() failed'
+        with nogil:
+            self.err = _jsonl_range(ni, self.p, self.start, self.end, &self.w, &self.messages, &self.errors)
+        nmsg_input_close(&ni)
+        return self
+
+# Parses the JSON lines in p[start:end] into messages.
+cdef class _nmsg_chunk(object):
+    cdef const char *p
+    cdef size_t start
+    cdef size_t end
+    cdef nmsg_message_t *msgs
+    cdef size_t n
+    cdef uint64_t errors
+    cdef int err
+
+    def __cinit__(self):
+        self.msgs = NULL
+        self.n = 0
+
+    def __dealloc__(self):
+        cdef size_t i
+
+        for i in range(self.n):
+            nmsg_message_destroy(&self.msgs[i])
+        free(self.msgs)
+
+    cdef int _parse(self) nogil:
+        cdef const char *line = self.p + self.start
+        cdef const char *stop = self.p + self.end
+        cdef const char *nl
+        cdef size_t n
+        cdef size_t size = 0
+        cdef nmsg_message_t *msgs
+        cdef _wbuf scratch
+        cdef int err = 0
+
+        scratch.data = NULL
+        scratch.len = 0
+        scratch.size = 0
+        while line < stop:
+            nl = <const char *> memchr(line, '\n', stop - line)
+            n = (nl if nl != NULL else stop) - line
+            if n > 0:
+                # nmsg_message_from_json() wants a NUL-terminated string.
+                scratch.len = 0
+                err = _wbuf_append(&scratch, line, n)
+                if err == 0:
+                    err = _wbuf_append(&scratch, '\0', 1)
+                if err != 0:
+                    break
+                if self.n == size:
+                    size = size * 2 if size else 1024
+                    msgs = <nmsg_message_t *> realloc(self.msgs, size * sizeof(nmsg_message_t))
+                    if msgs == NULL:
+                        err = ENOMEM
+                        break
+                    self.msgs = msgs
+                if nmsg_message_from_json(scratch.data, &self.msgs[self.n]) == nmsg_res_success:
+                    self.n += 1
+                else:
+                    self.errors += 1
+            line += n + 1
+        _wbuf_free(&scratch)
+        return err
+
+    def run(self):
+        with nogil:
+            self.err = self._parse()
+        return self
+
+def _convert_run(chunk):
+    return chunk.run()
+
+# src and dst are paths, as str, bytes or os.PathLike, or open file
+# objects. Paths are opened here and the file returned; None means the
+# caller's file object is used.
+def _is_path(obj):
+    return isinstance(obj, (str, bytes, unicode)) or hasattr(obj, '__fspath__')
+
+def _open_src(src):
+    if _is_path(src):
+        return open(os.fsencode(src), 'rb')
+    return None
+
+def _open_dst(dst):
+    if _is_path(dst):
+        return open(os.fsencode(dst), 'wb')
+    dst.flush()
+    return None
+
+# Splits the mapped file at newlines into ranges of about chunk_size bytes.
+def _line_chunks(mm, size_t chunk_size):
+    cdef size_t size = len(mm)
+    cdef size_t start = 0
+    cdef Py_ssize_t end
+
+    chunks = []
+    while start < size:
+        end = mm.find(b'\n', min(start + chunk_size, size) - 1)
+        if end < 0:
+            end = size - 1
+        chunks.append((start, end + 1))
+        start = end + 1
+    return chunks
+
+# Converts an NMSG file or stream to one JSON object per line. src and
+# dst are paths or file objects. With threads > 1 and a path as src, the
+# file is mapped and split into runs of containers_per_chunk containers
+# that are converted concurrently and written in order. Returns the
+# number of messages written and of messages or containers that could
+# not be converted.
+def nmsg_to_jsonl(src, dst, unsigned threads=1, size_t bufsz=1048576, size_t containers_per_chunk=16):
+    cdef nmsg_input_t ni
+    cdef nmsg_message_t m
+    cdef nmsg_res res = nmsg_res_success
+    cdef _wbuf w
+    cdef _jsonl_chunk c
+    cdef Py_buffer view
+    cdef uint64_t messages = 0
+    cdef uint64_t errors = 0
+    cdef size_t i
+    cdef int fd
+    cdef int err = 0
+    cdef int e
+
+    src_f = _open_src(src)
+    dst_f = _open_dst(dst)
+    try:
+        fd = (dst_f or dst).fileno()
+
+        if threads > 1 and src_f is not None:
+            chunks = _file_chunks(src_f.name, containers_per_chunk)
+            if not chunks:
+                return { 'messages': 0, 'errors': 0 }
+            mm = mmap.mmap(src_f.fileno(), 0, access=mmap.ACCESS_READ)
+            PyObject_GetBuffer(mm, &view, PyBUF_SIMPLE)
+            pool = ThreadPool(threads)
+            try:
+                # One window of chunks at a time keeps memory bounded.
+                for i in range(0, len(chunks), threads):
+                    jobs = []
+                    for start, end in chunks[i:i + threads]:
+                        c = _jsonl_chunk()
+                        c.p = <const uint8_t *> view.buf
+                        c.start = start
+                        c.end = end
+                        jobs.append(c)
+                    for c in pool.map(_convert_run, jobs):
+                        if c.err != 0:
+                            _raise_errno(c.err)
+                        with nogil:
+                            err = _write_all(fd, c.w.data, c.w.len)
+                        if err != 0:
+                            _raise_errno(err, dst_f)
+                        messages += c.messages
+                        errors += c.errors
+                        _wbuf_free(&c.w)
+                    if PyErr_CheckSignals() != 0:
+                        raise KeyboardInterrupt
+            finally:
+                pool.terminate()
+                pool.join()
+                PyBuffer_Release(&view)
+                mm.close()
+            return { 'messages': messages, 'errors': errors }
+
+        ni = nmsg_input_open_file((src_f or src).fileno())
+        if ni == NULL:
+            raise Exception, 'nmsg_input_open_file() failed'
+        w.data = NULL
+        w.len = 0
+        w.size = 0
+        try:
+            while res == nmsg_res_success:
+                with nogil:
+                    for i in range(_CONVERT_BATCH):
+                        res = nmsg_input_read(ni, &m)
+                        if res == nmsg_res_again:
+                            res = nmsg_res_success
+                            continue
+                        if res != nmsg_res_success:
+                            break
+                        e = _append_json(&w, m)
+                        nmsg_message_destroy(&m)
+                        if e == 1:
+                            errors += 1
+                        elif e != 0:
+                            err = e
+                            break
+                        else:
+                            messages += 1
+                        if w.len >= bufsz:
+                            err = _write_all(fd, w.data, w.len)
+                            w.len = 0
+                            if err != 0:
+                                break
+                if err != 0:
+                    _raise_errno(err, dst_f)
+                if PyErr_CheckSignals() != 0:
+                    raise KeyboardInterrupt
+            if res != nmsg_res_eof:
+                raise Exception, 'nmsg_input_read() failed: %s' % _cstr2str(nmsg_res_lookup(res))
+            with nogil:
+                err = _write_all(fd, w.data, w.len)
+            if err != 0:
+                _raise_errno(err, dst_f)
+        finally:
+            _wbuf_free(&w)
+            nmsg_input_close(&ni)
+        return { 'messages': messages, 'errors': errors }
+    finally:
+        if src_f is not None:
+            src_f.close()
+        if dst_f is not None:
+            dst_f.close()
+
+# Converts JSON lines to an NMSG file. With threads > 1 and a path as src,
+# lines are parsed concurrently in ranges of about chunk_size bytes and
+# written in order. Lines that do not parse are counted and skipped.
+def jsonl_to_nmsg(src, dst, unsigned threads=1, zlibout=False, size_t bufsz=NMSG_WBUFSZ_MAX,
+                  size_t chunk_size=4 * 1048576):
+    cdef nmsg_input_t ni = NULL
+    cdef nmsg_output_t no
+    cdef nmsg_message_t m
+    cdef nmsg_res res = nmsg_res_success
+    cdef nmsg_res wres = nmsg_res_success
+    cdef _nmsg_chunk c
+    cdef Py_buffer view
+    cdef uint64_t messages = 0
+    cdef uint64_t errors = 0
+    cdef size_t i
+    cdef size_t j
+
+    src_f = _open_src(src)
+    dst_f = _open_dst(dst)
+    try:
+        no = nmsg_output_open_file((dst_f or dst).fileno(), bufsz)
+        if no == NULL:
+            raise Exception, 'nmsg_output_open_file() failed'
+        nmsg_output_set_zlibout(no, zlibout)
+        try:
+            if threads > 1 and src_f is not None:
+                if os.fstat(src_f.fileno()).st_size == 0:
+                    return { 'messages': 0, 'errors': 0 }
+                mm = mmap.mmap(src_f.fileno(), 0, access=mmap.ACCESS_READ)
+                PyObject_GetBuffer(mm, &view, PyBUF_SIMPLE)
+                pool = ThreadPool(threads)
+                try:
+                    chunks = _line_chunks(mm, chunk_size)
+                    for i in range(0, len(chunks), threads):
+                        jobs = []
+                        for start, end in chunks[i:i + threads]:
+                            c = _nmsg_chunk()
+                            c.p = <const char *> view.buf
+                            c.start = start
+                            c.end = end
+                            jobs.append(c)
+                        for c in pool.map(_convert_run, jobs):
+                            if c.err != 0:
+                                _raise_errno(c.err)
+                            with nogil:
+                                for j in range(c.n):
+                                    if wres == nmsg_res_success:
+                                        wres = nmsg_output_write(no, c.msgs[j])
+                                        if wres == nmsg_res_success:
+                                            messages += 1
+                                    nmsg_message_destroy(&c.msgs[j])
+                                c.n = 0
+                            if wres != nmsg_res_success:
+                                raise Exception, 'nmsg_output_write() failed: %s' % _cstr2str(nmsg_res_lookup(wres))
+                            errors += c.errors
+                        if PyErr_CheckSignals() != 0:
+                            raise KeyboardInterrupt
+                finally:
+                    pool.terminate()
+                    pool.join()
+                    PyBuffer_Release(&view)
+                    mm.close()
+            else:
+                ni = nmsg_input_open_json((src_f or src).fileno())
+                if ni == NULL:
+                    raise Exception, 'nmsg_input_open_json() failed'
+                while res == nmsg_res_success:
+                    with nogil:
+                        for i in range(_CONVERT_BATCH):
+                            res = nmsg_input_read(ni, &m)
+                            if res == nmsg_res_parse_error or res == nmsg_res_again:
+                                if res == nmsg_res_parse_error:
+                                    errors += 1
+                                res = nmsg_res_success
+                                continue
+                            if res != nmsg_res_success:
+                                break
+                            wres = nmsg_output_write(no, m)
+                            nmsg_message_destroy(&m)
+                            if wres != nmsg_res_success:
+                                break
+                            messages += 1
+                    if wres != nmsg_res_success:
+                        raise Exception, 'nmsg_output_write() failed: %s' % _cstr2str(nmsg_res_lookup(wres))
+                    if PyErr_CheckSignals() != 0:
+                        raise KeyboardInterrupt
+                if res != nmsg_res_eof:
+                    raise Exception, 'nmsg_input_read() failed: %s' % _cstr2str(nmsg_res_lookup(res))
+        finally:
+            if ni != NULL:
+                nmsg_input_close(&ni)
+            res = nmsg_output_close(&no)
+        if res != nmsg_res_success:
+            raise Exception, 'nmsg_output_close() failed: %s' % _cstr2str(nmsg_res_lookup(res))
+        return { 'messages': messages, 'errors': errors }
+    finally:
+        if src_f is not None:
+            src_f.close()
+        if dst_f is not None:
+            dst_f.close()
@@ -0,0 +1,189 @@
+#cython: embedsignature=True
+
+# Copyright (c) 2026 by Farsight Security, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import multiprocessing
+import zlib
+
+# Per-worker counter slots in the shared counter array.
+_FANOUT_RECEIVED = 0
+_FANOUT_PROCESSED = 1
+_FANOUT_ERRORS = 2
+_FANOUT_NCOUNTERS = 3
+
+_fanout_counter_names = ('received', 'processed', 'errors')
+
+# How long the dispatcher may hold a partly filled container for a worker.
+_FANOUT_MAX_DELAY = 0.1
+
+def _fanout_key_hash(v):
+    # Stable across processes and runs, unlike hash() on str/bytes.
+    if isinstance(v, numbers.Integral):
+        return v
+    if isinstance(v, bytes):
+        return zlib.crc32(v) & 0xffffffff
+    if isinstance(v, unicode):
+        return zlib.crc32(v.encode('utf-8')) & 0xffffffff
+    return zlib.crc32(repr(v).encode('utf-8')) & 0xffffffff
+
+def _fanout_key(msg, key):
+    if key == 'source' or key == 'operator' or key == 'group':
+        return getattr(msg, key)
+    elif callable(key):
+        return key(msg)
+    return msg[key] if key in msg else None
+
+def _fanout_loop(io i):
+    # SIGINT and SIGTERM reach the loop through sig_manager.c, which io()
+    # installs, as KeyboardInterrupt and SystemExit.
+    try:
+        i.loop()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+
+def _fanout_worker(unsigned index, socks, conn, fn, bint lazy, counters):
+    base = index * _FANOUT_NCOUNTERS
+
+    def cb(msg):
+        counters[base + _FANOUT_RECEIVED] += 1
+        try:
+            fn(msg)
+        except Exception:
+            counters[base + _FANOUT_ERRORS] += 1
+            raise
+        counters[base + _FANOUT_PROCESSED] += 1
+
+    i = io()
+    if conn is not None:
+        i.add_input(input.open_file(conn))
+    for addr, port in socks:
+        i.add_input(input.open_sock(addr, port))
+    i.add_output_callback(cb, lazy=lazy)
+    _fanout_loop(i)
+
+def _fanout_dispatcher(socks, conns, key):
+    cdef unsigned n = len(conns)
+    outs = [ output.open_file(conn, max_delay=_FANOUT_MAX_DELAY) for conn in conns ]
+
+    def cb(msg):
+        outs[_fanout_key_hash(_fanout_key(msg, key)) % n].write(msg)
+
+    i = io()
+    for addr, port in socks:
+        i.add_input(input.open_sock(addr, port))
+    i.add_output_callback(cb, lazy=True)
+    try:
+        _fanout_loop(i)
+    finally:
+        for o in outs:
+            o.close()
+
+class fanout(object):
+    # Spreads an nmsg channel across worker processes, each running its own
+    # io loop and calling fn(msg) for the messages it owns.
+    #
+    # By default the channel's sockets are dealt round-robin to the
+    # workers. With key set ('source', 'operator', 'group', a field name
+    # or a callable taking the message) a single dispatcher process binds
+    # the sockets and sends each message over a pipe to the worker its key
+    # hashes to, so a key is always handled by the same worker.
+    #
+    # channel is a channel alias name or a list of (address, port) pairs.
+    def __init__(self, channel, fn, workers=None, key=None, lazy=False):
+        self.channel = channel
+        if isinstance(channel, str):
+            self.socks = _channel_sockets(channel)
+        else:
+            self.socks = [ (addr, int(port)) for addr, port in channel ]
+        self.fn = fn
+        self.key = key
+        self.lazy = lazy
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        if key is None:
+            workers = min(workers, len(self.socks))
+        if workers < 1:
+            raise ValueError('workers must be at least 1')
+        self.workers = workers
+        self.counters_array = multiprocessing.RawArray('Q', workers * _FANOUT_NCOUNTERS)
+        self.processes = []
+
+    def start(self):
+        if self.processes:
+            raise Exception, 'fanout already started'
+        conns = [ (None, None) ] * self.workers
+        if self.key is not None:
+            conns = [ multiprocessing.Pipe(False) for _ in range(self.workers) ]
+        for index in range(self.workers):
+            self._start(_fanout_worker, index, self.worker_socks(index), conns[index][0], self.fn, self.lazy,
+                    self.counters_array)
+        if self.key is not None:
+            self._start(_fanout_dispatcher, self.socks, [ w for r, w in conns ], self.key)
+            # The processes hold their own ends of the pipes.
+            for r, w in conns:
+                r.close()
+                w.close()
+
+    def _start(self, target, *args):
+        p = multiprocessing.Process(target=target, args=args)
+        p.daemon = True
+        p.start()
+        self.processes.append(p)
+
+    def worker_socks(self, unsigned index):
+        if self.key is None:
+            return self.socks[index::self.workers]
+        return []
+
+    def stop(self, timeout=5):
+        # SIGTERM breaks each process out of its io loop, including one
+        # busy in fn(), through the handler from sig_manager.c.
+        for p in self.processes:
+            if p.is_alive():
+                p.terminate()
+        deadline = time.time() + timeout
+        for p in self.processes:
+            p.join(max(0, deadline - time.time()))
+        self.processes = [ p for p in self.processes if p.is_alive() ]
+        if self.processes:
+            raise Exception, 'fanout processes did not exit within %s seconds' % timeout
+
+    def join(self):
+        for p in self.processes:
+            p.join()
+
+    def alive(self):
+        return [ p.is_alive() for p in self.processes ]
+
+    def counters(self):
+        res = []
+        for index in range(self.workers):
+            base = index * _FANOUT_NCOUNTERS
+            res.append(dict((name, self.counters_array[base + j])
+                for j, name in enumerate(_fanout_counter_names)))
+        return res
+
+    def run(self):
+        # Starts the workers and blocks until they exit, stopping them
+        # cleanly on SIGINT or SIGTERM.
+        setup_sighandler()
+        self.start()
+        try:
+            while any(self.alive()):
+                time.sleep(0.5)
+        except (KeyboardInterrupt, SystemExit):
+            pass
+        finally:
+            self.stop()
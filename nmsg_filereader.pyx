@@ -0,0 +1,517 @@
+#cython: embedsignature=True
+
+# Copyright (c) 2026 by Farsight Security, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import bisect
+import json
+import mmap
+import multiprocessing
+import struct
+
+from libc.stdint cimport INT64_MAX
+from libc.string cimport memcmp
+
+cdef enum:
+    _NMSG_HDRSIZE = 10
+    _NMSG_VERSION = 2
+    _NMSG_FLAG_ZLIB = 0x01
+    _NMSG_FLAG_FRAGMENT = 0x02
+
+_INDEX_VERSION = 1
+
+# One NMSG container in a mapped file. Fragmented containers cannot be
+# scanned on their own; their count is 0 and their times are -1.
+cdef struct _container_entry:
+    int64_t offset
+    uint32_t length
+    uint8_t flags
+    uint32_t count
+    int64_t first_ns
+    int64_t last_ns
+
+cdef inline int _pb_varint(const uint8_t **pp, const uint8_t *end, uint64_t *v) nogil:
+    cdef const uint8_t *p = pp[0]
+    cdef uint64_t r = 0
+    cdef unsigned shift = 0
+
+    while p < end and shift < 64:
+        r |= <uint64_t> (p[0] & 0x7f) << shift
+        if not (p[0] & 0x80):
+            pp[0] = p + 1
+            v[0] = r
+            return 0
+        p += 1
+        shift += 7
+    return -1
+
+cdef int _pb_skip(const uint8_t **pp, const uint8_t *end, unsigned wire_type) nogil:
+    cdef uint64_t n
+
+    if wire_type == 0:
+        return _pb_varint(pp, end, &n)
+    elif wire_type == 1:
+        n = 8
+    elif wire_type == 2:
+        if _pb_varint(pp, end, &n) != 0:
+            return -1
+    elif wire_type == 5:
+        n = 4
+    else:
+        return -1
+    if n > <uint64_t> (end - pp[0]):
+        return -1
+    pp[0] += n
+    return 0
+
+# Reads the header fields of one serialized NmsgPayload without touching
+# its payload bytes.
+cdef int _scan_payload(const uint8_t *p, const uint8_t *end, uint64_t *key, int64_t *t_ns) nogil:
+    cdef uint64_t tag
+    cdef uint64_t v
+    cdef uint64_t vid = 0
+    cdef uint64_t mtype = 0
+    cdef int64_t sec = 0
+    cdef uint32_t nsec = 0
+
+    while p < end:
+        if _pb_varint(&p, end, &tag) != 0:
+            return -1
+        if (tag & 7) == 0 and 1 <= (tag >> 3) <= 3:
+            if _pb_varint(&p, end, &v) != 0:
+                return -1
+            if (tag >> 3) == 1:
+                vid = v
+            elif (tag >> 3) == 2:
+                mtype = v
+            else:
+                sec = <int64_t> v
+        elif tag == ((4 << 3) | 5):
+            if end - p < 4:
+                return -1
+            nsec = p[0] | (<uint32_t> p[1] << 8) | (<uint32_t> p[2] << 16) | (<uint32_t> p[3] << 24)
+            p += 4
+        elif _pb_skip(&p, end, tag & 7) != 0:
+            return -1
+    key[0] = (vid << 32) | <uint32_t> mtype
+    t_ns[0] = sec * 1000000000 + nsec
+    return 0
+
+cdef int64_t _time_ns(t) except? -1:
+    if not isinstance(t, numbers.Real):
+        raise ValueError('time must be a real number')
+    sec = int(t)
+    return <int64_t> sec * 1000000000 + <int64_t> ((t - sec) * 1000000000)
+
+def input_open_mmap(path, lazy=False):
+    return filereader(path, lazy)
+
+# Random access to an NMSG file through mmap. Opening the file walks the
+# container headers and builds an index of offsets, time ranges and
+# per-(vid, msgtype) counts, or loads it from a sidecar written by
+# save_index(). Payloads are only decoded when messages are read.
+cdef class filereader(object):
+    cdef readonly object path
+    cdef object fileobj
+    cdef object mm
+    cdef size_t size
+    cdef _container_entry *entries
+    cdef size_t n_entries
+    cdef size_t cap
+    cdef list types
+    cdef list time_keys
+    cdef size_t pos
+    cdef nullinput ni
+
+    open = staticmethod(input_open_mmap)
+
+    def __cinit__(self):
+        self.entries = NULL
+        self.n_entries = 0
+        self.cap = 0
+        self.pos = 0
+
+    def __dealloc__(self):
+        free(self.entries)
+
+    def __init__(self, path, lazy=False):
+        self.path = path
+        self.fileobj = open(path, 'rb')
+        self.size = os.fstat(self.fileobj.fileno()).st_size
+        if self.size > 0:
+            self.mm = mmap.mmap(self.fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+        self.ni = nullinput()
+        self.ni.set_lazy(lazy)
+        if not self.load_index():
+            self.build_index()
+
+    def __repr__(self):
+        return 'nmsg filereader object path=%s containers=%d' % (self.path, self.n_entries)
+
+    def __len__(self):
+        return self.n_entries
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+        if self.fileobj is not None:
+            self.fileobj.close()
+            self.fileobj = None
+
+    cdef _container_entry *_add_entry(self) except NULL:
+        cdef size_t cap
+        cdef _container_entry *entries
+
+        if self.n_entries == self.cap:
+            cap = self.cap * 2 if self.cap else 1024
+            entries = <_container_entry *> realloc(self.entries, cap * sizeof(_container_entry))
+            if entries == NULL:
+                raise MemoryError()
+            self.entries = entries
+            self.cap = cap
+        self.n_entries += 1
+        return &self.entries[self.n_entries - 1]
+
+    cdef int _scan_container(self, _container_entry *e, const uint8_t *p, const uint8_t *end, dict types) except -1:
+        cdef uint64_t tag
+        cdef uint64_t n
+        cdef uint64_t key
+        cdef uint64_t run_key = 0
+        cdef size_t run = 0
+        cdef int64_t t_ns
+
+        while p < end:
+            if _pb_varint(&p, end, &tag) != 0:
+                raise Exception, 'malformed container at offset %d' % e.offset
+            if tag == ((1 << 3) | 2):
+                if _pb_varint(&p, end, &n) != 0 or n > <uint64_t> (end - p):
+                    raise Exception, 'malformed container at offset %d' % e.offset
+                if _scan_payload(p, p + n, &key, &t_ns) != 0:
+                    raise Exception, 'malformed payload at offset %d' % e.offset
+                p += n
+
+                if e.count == 0 or t_ns < e.first_ns:
+                    e.first_ns = t_ns
+                if e.count == 0 or t_ns > e.last_ns:
+                    e.last_ns = t_ns
+                e.count += 1
+
+                # Payloads of one type usually come in runs; only touch
+                # the dict when the type changes.
+                if run > 0 and key != run_key:
+                    k = (<unsigned> (run_key >> 32), <unsigned> run_key)
+                    types[k] = types.get(k, 0) + run
+                    run = 0
+                run_key = key
+                run += 1
+            elif _pb_skip(&p, end, tag & 7) != 0:
+                raise Exception, 'malformed container at offset %d' % e.offset
+
+        if run > 0:
+            k = (<unsigned> (run_key >> 32), <unsigned> run_key)
+            types[k] = types.get(k, 0) + run
+        return 0
+
+    def build_index(self):
+        cdef Py_buffer view
+        cdef const uint8_t *p
+        cdef size_t off = 0
+        cdef uint32_t length
+        cdef uint8_t *u_buf
+        cdef size_t u_len
+        cdef nmsg_res res
+        cdef nmsg_zbuf_t zb = NULL
+        cdef _container_entry *e
+
+        self.n_entries = 0
+        self.types = []
+        self.time_keys = None
+        self.pos = 0
+        if self.mm is None:
+            return
+
+        zb = nmsg_zbuf_inflate_init()
+        if zb == NULL:
+            raise Exception, 'nmsg_zbuf_inflate_init() failed'
+        PyObject_GetBuffer(self.mm, &view, PyBUF_SIMPLE)
+        try:
+            p = <const uint8_t *> view.buf
+            while off + _NMSG_HDRSIZE <= self.size:
+                if memcmp(p + off, b'NMSG', 4) != 0:
+                    raise Exception, 'bad NMSG magic at offset %d' % off
+                if p[off + 5] != _NMSG_VERSION:
+                    raise Exception, 'unsupported NMSG version %d at offset %d' % (p[off + 5], off)
+                length = (<uint32_t> p[off + 6] << 24) | (<uint32_t> p[off + 7] << 16) | \
+                         (<uint32_t> p[off + 8] << 8) | p[off + 9]
+                if off + _NMSG_HDRSIZE + length > self.size:
+                    # A container still being written; stop at the last
+                    # complete one.
+                    break
+
+                e = self._add_entry()
+                e.offset = off
+                e.length = length
+                e.flags = p[off + 4]
+                e.count = 0
+                e.first_ns = -1
+                e.last_ns = -1
+                types = {}
+                self.types.append(types)
+
+                if e.flags & _NMSG_FLAG_FRAGMENT:
+                    pass
+                elif e.flags & _NMSG_FLAG_ZLIB:
+                    with nogil:
+                        res = nmsg_zbuf_inflate(zb, length, <uint8_t *> p + off + _NMSG_HDRSIZE, &u_len, &u_buf)
+                    if res != nmsg_res_success:
+                        raise Exception, 'nmsg_zbuf_inflate() failed at offset %d' % off
+                    try:
+                        self._scan_container(e, u_buf, u_buf + u_len, types)
+                    finally:
+                        free(u_buf)
+                else:
+                    self._scan_container(e, p + off + _NMSG_HDRSIZE, p + off + _NMSG_HDRSIZE + length, types)
+
+                off += _NMSG_HDRSIZE + length
+        finally:
+            PyBuffer_Release(&view)
+            nmsg_zbuf_destroy(&zb)
+
+    def _index_path(self, path):
+        if path is None:
+            return self.path + '.idx.json'
+        return path
+
+    def save_index(self, path=None):
+        cdef size_t i
+        cdef _container_entry *e
+
+        st = os.stat(self.path)
+        containers = []
+        for i in range(self.n_entries):
+            e = &self.entries[i]
+            containers.append([ e.offset, e.length, e.flags, e.count, e.first_ns, e.last_ns,
+                                [ [ k[0], k[1], v ] for k, v in sorted(self.types[i].items()) ] ])
+        with open(self._index_path(path), 'w') as f:
+            json.dump({ 'version': _INDEX_VERSION, 'size': st.st_size, 'mtime': st.st_mtime,
+                        'containers': containers }, f)
+
+    # Loads a sidecar index. Returns False if it is missing or does not
+    # match the file's current size and mtime.
+    def load_index(self, path=None):
+        cdef _container_entry *e
+
+        try:
+            with open(self._index_path(path)) as f:
+                idx = json.load(f)
+        except (IOError, OSError, ValueError):
+            return False
+        st = os.stat(self.path)
+        if idx.get('version') != _INDEX_VERSION or idx.get('size') != st.st_size or idx.get('mtime') != st.st_mtime:
+            return False
+
+        self.n_entries = 0
+        self.types = []
+        self.time_keys = None
+        self.pos = 0
+        for c in idx['containers']:
+            e = self._add_entry()
+            e.offset, e.length, e.flags, e.count, e.first_ns, e.last_ns = c[:6]
+            self.types.append(dict(((vid, msgtype), n) for vid, msgtype, n in c[6]))
+        return True
+
+    def container(self, size_t i):
+        cdef _container_entry *e
+
+        if i >= self.n_entries:
+            raise IndexError('container index out of range')
+        e = &self.entries[i]
+        return {
+            'offset': e.offset,
+            'length': e.length,
+            'zlib': (e.flags & _NMSG_FLAG_ZLIB) != 0,
+            'fragment': (e.flags & _NMSG_FLAG_FRAGMENT) != 0,
+            'count': e.count,
+            'first': e.first_ns / 1e9 if e.first_ns >= 0 else None,
+            'last': e.last_ns / 1e9 if e.last_ns >= 0 else None,
+            'types': dict(self.types[i]),
+        }
+
+    def counts(self):
+        total = {}
+        for types in self.types:
+            for k, v in types.items():
+                total[k] = total.get(k, 0) + v
+        return total
+
+    # Returns the first container that may hold a message at or after t.
+    def find_time(self, t):
+        cdef size_t i
+        cdef int64_t last_ns
+        cdef int64_t key = -1
+
+        if self.time_keys is None:
+            # Running maximum of each container's last timestamp, with
+            # untimed containers as the latest possible time. It is sorted,
+            # and its first entry >= t is the first container whose own
+            # last timestamp is >= t or unknown.
+            self.time_keys = []
+            for i in range(self.n_entries):
+                last_ns = self.entries[i].last_ns
+                if last_ns < 0:
+                    key = INT64_MAX
+                elif last_ns > key:
+                    key = last_ns
+                self.time_keys.append(key)
+        return bisect.bisect_left(self.time_keys, _time_ns(t))
+
+    def seek(self, size_t i):
+        if i > self.n_entries:
+            raise IndexError('container index out of range')
+        self.pos = i
+
+    def seek_time(self, t):
+        self.pos = self.find_time(t)
+
+    def tell(self):
+        return self.pos
+
+    def set_filter(self, expr):
+        self.ni.set_filter(expr)
+
+    def set_sample(self, rate, key=None):
+        self.ni.set_sample(rate, key)
+
+    def read_container(self, size_t i):
+        cdef _container_entry *e
+
+        if i >= self.n_entries:
+            raise IndexError('container index out of range')
+        e = &self.entries[i]
+        return self.ni.read(self.mm, offset=e.offset, length=_NMSG_HDRSIZE + e.length)
+
+    def __iter__(self):
+        while self.pos < self.n_entries:
+            msg_list = self.read_container(self.pos)
+            self.pos += 1
+            for msg in msg_list:
+                yield msg
+
+    # Yields the messages with start <= time < end, decoding only the
+    # containers whose time range overlaps the window.
+    def between(self, start, end):
+        cdef int64_t start_ns = _time_ns(start)
+        cdef int64_t end_ns = _time_ns(end)
+        cdef int64_t t_ns
+        cdef size_t i
+        cdef _container_entry *e
+
+        for i in range(self.n_entries):
+            e = &self.entries[i]
+            if e.first_ns >= 0 and (e.last_ns < start_ns or e.first_ns >= end_ns):
+                continue
+            for msg in self.read_container(i):
+                t_ns = <int64_t> msg.time_sec * 1000000000 + msg.time_nsec
+                if start_ns <= t_ns < end_ns:
+                    yield msg
+
+# Splits a file into byte ranges of about per_chunk containers, reading
+# only the container headers. A run of fragment containers is kept in one
+# range so the fragments can be reassembled.
+def _file_chunks(path, size_t per_chunk):
+    cdef Py_buffer view
+    cdef const uint8_t *p
+    cdef size_t size
+    cdef size_t off = 0
+    cdef size_t start = 0
+    cdef size_t n = 0
+    cdef uint32_t length
+
+    if per_chunk == 0:
+        raise ValueError('per_chunk must be at least 1')
+    chunks = []
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return chunks
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        PyObject_GetBuffer(mm, &view, PyBUF_SIMPLE)
+        try:
+            p = <const uint8_t *> view.buf
+            while off + _NMSG_HDRSIZE <= size:
+                if memcmp(p + off, b'NMSG', 4) != 0:
+                    raise Exception, 'bad NMSG magic at offset %d' % off
+                length = (<uint32_t> p[off + 6] << 24) | (<uint32_t> p[off + 7] << 16) | \
+                         (<uint32_t> p[off + 8] << 8) | p[off + 9]
+                if off + _NMSG_HDRSIZE + length > size:
+                    break
+                off += _NMSG_HDRSIZE + length
+                n += 1
+                if n >= per_chunk and not (p[off - _NMSG_HDRSIZE - length + 4] & _NMSG_FLAG_FRAGMENT):
+                    chunks.append((start, off))
+                    start = off
+                    n = 0
+        finally:
+            PyBuffer_Release(&view)
+            mm.close()
+    if off > start:
+        chunks.append((start, off))
+    return chunks
+
+def _decode_chunk(args):
+    cdef nullinput ni
+    cdef uint32_t length
+
+    path, start, end, fn, lazy = args
+    ni = nullinput()
+    ni.set_lazy(lazy)
+    results = []
+    with open(path, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            off = start
+            while off < end:
+                length = struct.unpack_from('>I', mm, off + 6)[0]
+                # Fragments read as no messages until the last of their run,
+                # which _file_chunks() keeps within this chunk.
+                for msg in ni.read(mm, offset=off, length=_NMSG_HDRSIZE + length):
+                    results.append(fn(msg))
+                off += _NMSG_HDRSIZE + length
+        finally:
+            mm.close()
+    return results
+
+# Decodes an NMSG file in a pool of worker processes and yields fn(msg)
+# for every message. The file is split at container boundaries, so each
+# worker decodes whole containers; fn must be picklable. With ordered
+# False, results are yielded as chunks complete.
+def map_file(path, fn, processes=None, ordered=True, size_t containers_per_chunk=64, lazy=False):
+    tasks = [ (path, start, end, fn, lazy) for start, end in _file_chunks(path, containers_per_chunk) ]
+    if not tasks:
+        return
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        if ordered:
+            it = pool.imap(_decode_chunk, tasks)
+        else:
+            it = pool.imap_unordered(_decode_chunk, tasks)
+        for results in it:
+            for r in results:
+                yield r
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
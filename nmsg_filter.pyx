@@ -0,0 +1,758 @@
+#cython: embedsignature=True
+
+# Copyright (c) 2026 by Farsight Security, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import struct
+
+from libc.string cimport memcmp, memcpy
+
+cdef extern from "pthread.h" nogil:
+    ctypedef struct pthread_rwlock_t:
+        pass
+    int pthread_rwlock_init(pthread_rwlock_t *lock, void *attr)
+    int pthread_rwlock_destroy(pthread_rwlock_t *lock)
+    int pthread_rwlock_rdlock(pthread_rwlock_t *lock)
+    int pthread_rwlock_wrlock(pthread_rwlock_t *lock)
+    int pthread_rwlock_unlock(pthread_rwlock_t *lock)
+
+# GCC and clang builtins, for counters bumped by io threads without the GIL.
+cdef extern from * nogil:
+    uint64_t __atomic_fetch_add(uint64_t *p, uint64_t v, int order)
+    uint64_t __atomic_load_n(uint64_t *p, int order)
+    enum: __ATOMIC_RELAXED
+
+# Filter expressions are built from field() references:
+#
+#     f = (nmsg.field('rrtype') == 'A') & nmsg.field('qname').endswith(b'\x07example\x03com\x00')
+#     i.set_filter(f)
+#
+# They are compiled once per message schema into a flat program that is
+# evaluated on the raw nmsg_message_t. A predicate on a repeated field
+# matches if any of its values match; a predicate on a field the message
+# type does not have never matches.
+
+class _expr(object):
+    def __init__(self, op, *args):
+        self.op = op
+        self.args = args
+
+    def __and__(self, other):
+        return _expr('and', self, other)
+
+    def __or__(self, other):
+        return _expr('or', self, other)
+
+    def __invert__(self):
+        return _expr('not', self)
+
+    def __repr__(self):
+        return 'nmsg filter %s%r' % (self.op, self.args)
+
+def _as_tuple(v):
+    if isinstance(v, (list, tuple, set, frozenset)):
+        return tuple(v)
+    return (v,)
+
+class field(object):
+    def __init__(self, name):
+        self.name = name
+
+    def __eq__(self, v):
+        return _expr('eq', self.name, (v,))
+
+    def __ne__(self, v):
+        return ~(self == v)
+
+    def __lt__(self, v):
+        return _expr('range', self.name, None, v, False, False)
+
+    def __le__(self, v):
+        return _expr('range', self.name, None, v, False, True)
+
+    def __gt__(self, v):
+        return _expr('range', self.name, v, None, False, False)
+
+    def __ge__(self, v):
+        return _expr('range', self.name, v, None, True, False)
+
+    __hash__ = None
+
+    def isin(self, values):
+        return _expr('eq', self.name, tuple(values))
+
+    def between(self, lo, hi):
+        return _expr('range', self.name, lo, hi, True, True)
+
+    def startswith(self, prefixes):
+        return _expr('prefix', self.name, _as_tuple(prefixes))
+
+    def endswith(self, suffixes):
+        return _expr('suffix', self.name, _as_tuple(suffixes))
+
+    def in_network(self, networks):
+        return _expr('net', self.name, _as_tuple(networks))
+
+    def exists(self):
+        return _expr('exists', self.name)
+
+cdef enum:
+    _F_FALSE
+    _F_AND
+    _F_OR
+    _F_NOT
+    _F_EXISTS
+    _F_EQ
+    _F_RANGE
+    _F_PREFIX
+    _F_SUFFIX
+    _F_NET
+
+cdef enum:
+    _F_HAS_LO = 0x01
+    _F_HAS_HI = 0x02
+    _F_LO_INCL = 0x04
+    _F_HI_INCL = 0x08
+
+# One step of a compiled filter program, in postfix order. Predicate
+# operands are packed in the field's wire representation: value i is
+# blob[offs[i]:offs[i + 1]].
+cdef struct _fnode:
+    int op
+    unsigned field_idx
+    nmsg_msgmod_field_type ft
+    bint repeated
+    size_t n_vals
+    uint8_t *blob
+    size_t *offs
+    uint8_t *bits
+    double lo
+    double hi
+    int range_flags
+
+cdef struct _fprog:
+    _fnode *nodes
+    size_t n
+    bint *stack
+
+# Programs up to this many steps are run on a stack local to the caller,
+# so threads without the GIL can share them.
+cdef enum:
+    _FSTACK_MAX = 64
+
+cdef inline int _fcmp(const uint8_t *a, size_t alen, const uint8_t *b, size_t blen) nogil:
+    if alen != blen:
+        return -1 if alen < blen else 1
+    return memcmp(a, b, alen)
+
+cdef double _fnum(nmsg_msgmod_field_type ft, const uint8_t *data) nogil:
+    if ft == nmsg_msgmod_ft_uint64:
+        return (<uint64_t *> data)[0]
+    elif ft == nmsg_msgmod_ft_int64:
+        return (<int64_t *> data)[0]
+    elif ft == nmsg_msgmod_ft_double:
+        return (<double *> data)[0]
+    elif ft == nmsg_msgmod_ft_int16 or ft == nmsg_msgmod_ft_int32 or ft == nmsg_msgmod_ft_bool:
+        return (<int32_t *> data)[0]
+    return (<uint32_t *> data)[0]
+
+cdef bint _fnode_match(_fnode *nd, const uint8_t *data, size_t data_len) nogil:
+    cdef size_t i
+    cdef size_t lo
+    cdef size_t hi
+    cdef size_t vlen
+    cdef size_t nbytes
+    cdef const uint8_t *v
+    cdef uint8_t mask
+    cdef int c
+    cdef double x
+
+    if (nd.ft == nmsg_msgmod_ft_string or nd.ft == nmsg_msgmod_ft_mlstring) and \
+            data_len > 0 and data[data_len - 1] == 0:
+        data_len -= 1
+
+    if nd.op == _F_EXISTS:
+        return True
+
+    elif nd.op == _F_EQ:
+        lo = 0
+        hi = nd.n_vals
+        while lo < hi:
+            i = (lo + hi) // 2
+            c = _fcmp(data, data_len, nd.blob + nd.offs[i], nd.offs[i + 1] - nd.offs[i])
+            if c == 0:
+                return True
+            elif c < 0:
+                hi = i
+            else:
+                lo = i + 1
+        return False
+
+    elif nd.op == _F_RANGE:
+        x = _fnum(nd.ft, data)
+        if nd.range_flags & _F_HAS_LO:
+            if x < nd.lo or (x == nd.lo and not nd.range_flags & _F_LO_INCL):
+                return False
+        if nd.range_flags & _F_HAS_HI:
+            if x > nd.hi or (x == nd.hi and not nd.range_flags & _F_HI_INCL):
+                return False
+        return True
+
+    for i in range(nd.n_vals):
+        v = nd.blob + nd.offs[i]
+        vlen = nd.offs[i + 1] - nd.offs[i]
+        if nd.op == _F_PREFIX:
+            if vlen <= data_len and memcmp(data, v, vlen) == 0:
+                return True
+        elif nd.op == _F_SUFFIX:
+            if vlen <= data_len and memcmp(data + data_len - vlen, v, vlen) == 0:
+                return True
+        elif nd.op == _F_NET:
+            if vlen != data_len:
+                continue
+            nbytes = nd.bits[i] // 8
+            if memcmp(data, v, nbytes) != 0:
+                continue
+            if nd.bits[i] % 8 == 0:
+                return True
+            mask = <uint8_t> (0xff << (8 - nd.bits[i] % 8))
+            if (data[nbytes] & mask) == (v[nbytes] & mask):
+                return True
+    return False
+
+cdef bint _fnode_eval(_fnode *nd, nmsg_message_t m) nogil:
+    cdef unsigned val_idx = 0
+    cdef uint8_t *data
+    cdef size_t data_len
+
+    while nmsg_message_get_field_by_idx(m, nd.field_idx, val_idx, <void **> &data, &data_len) == nmsg_res_success:
+        if _fnode_match(nd, data, data_len):
+            return True
+        if not nd.repeated:
+            break
+        val_idx += 1
+    return False
+
+cdef bint _fprog_run(_fprog *p, nmsg_message_t m, bint *stack) nogil:
+    cdef size_t i
+    cdef size_t sp = 0
+    cdef _fnode *nd
+
+    for i in range(p.n):
+        nd = &p.nodes[i]
+        if nd.op == _F_AND:
+            sp -= 1
+            stack[sp - 1] = stack[sp - 1] and stack[sp]
+        elif nd.op == _F_OR:
+            sp -= 1
+            stack[sp - 1] = stack[sp - 1] or stack[sp]
+        elif nd.op == _F_NOT:
+            stack[sp - 1] = not stack[sp - 1]
+        elif nd.op == _F_FALSE:
+            stack[sp] = False
+            sp += 1
+        else:
+            stack[sp] = _fnode_eval(nd, m)
+            sp += 1
+    return stack[0]
+
+cdef dict _fpack_formats = {
+    nmsg_msgmod_ft_uint16: '=I',
+    nmsg_msgmod_ft_uint32: '=I',
+    nmsg_msgmod_ft_enum: '=I',
+    nmsg_msgmod_ft_int16: '=i',
+    nmsg_msgmod_ft_int32: '=i',
+    nmsg_msgmod_ft_bool: '=i',
+    nmsg_msgmod_ft_uint64: '=Q',
+    nmsg_msgmod_ft_int64: '=q',
+    nmsg_msgmod_ft_double: '=d',
+}
+
+cdef inline bint _fis_text(nmsg_msgmod_field_type ft):
+    return ft == nmsg_msgmod_ft_bytes or ft == nmsg_msgmod_ft_string or ft == nmsg_msgmod_ft_mlstring
+
+# A filter expression compiled against one schema.
+cdef class _fprogram(object):
+    cdef _fprog prog
+    cdef list nodes
+    cdef _schema schema
+    cdef nmsg_message_t instance
+
+    def __cinit__(self):
+        self.prog.nodes = NULL
+        self.prog.n = 0
+        self.prog.stack = NULL
+
+    def __dealloc__(self):
+        cdef size_t i
+
+        if self.prog.nodes != NULL:
+            for i in range(self.prog.n):
+                free(self.prog.nodes[i].blob)
+                free(self.prog.nodes[i].offs)
+                free(self.prog.nodes[i].bits)
+            free(self.prog.nodes)
+        free(self.prog.stack)
+
+    cdef int compile(self, expr, _schema schema, nmsg_message_t instance) except -1:
+        cdef size_t i
+
+        self.schema = schema
+        self.instance = instance
+        self.nodes = []
+        self._emit(expr)
+        self.instance = NULL
+
+        self.prog.nodes = <_fnode *> malloc(len(self.nodes) * sizeof(_fnode))
+        self.prog.stack = <bint *> malloc(len(self.nodes) * sizeof(bint))
+        if self.prog.nodes == NULL or self.prog.stack == NULL:
+            raise MemoryError()
+        for i in range(len(self.nodes)):
+            self.prog.nodes[i].blob = NULL
+            self.prog.nodes[i].offs = NULL
+            self.prog.nodes[i].bits = NULL
+        self.prog.n = len(self.nodes)
+        for i in range(self.prog.n):
+            self._fill(&self.prog.nodes[i], self.nodes[i])
+        self.nodes = None
+        return 0
+
+    cdef _emit(self, expr):
+        if not isinstance(expr, _expr):
+            raise TypeError('filter must be built from nmsg.field() expressions')
+        op = expr.op
+        if op == 'and' or op == 'or':
+            self._emit(expr.args[0])
+            self._emit(expr.args[1])
+            self.nodes.append((_F_AND if op == 'and' else _F_OR,))
+        elif op == 'not':
+            self._emit(expr.args[0])
+            self.nodes.append((_F_NOT,))
+        elif expr.args[0] not in self.schema.idx:
+            self.nodes.append((_F_FALSE,))
+        else:
+            self.nodes.append(self._predicate(op, self.schema.idx[expr.args[0]], expr.args[1:]))
+
+    cdef bytes _pack(self, unsigned field_idx, v):
+        cdef nmsg_msgmod_field_type ft = self.schema.c_types[field_idx]
+
+        if ft == nmsg_msgmod_ft_enum and not isinstance(v, numbers.Integral):
+            v = self.schema.enum_value(self.instance, field_idx, v)
+        if ft in _fpack_formats:
+            return struct.pack(_fpack_formats[ft], v)
+        if ft == nmsg_msgmod_ft_ip and not isinstance(v, bytes):
+            return socket.inet_pton(socket.AF_INET6 if ':' in v else socket.AF_INET, v)
+        if isinstance(v, unicode):
+            return v.encode('utf-8')
+        return bytes(v)
+
+    cdef _number(self, unsigned field_idx, v):
+        if v is None:
+            return None
+        if self.schema.c_types[field_idx] == nmsg_msgmod_ft_enum and not isinstance(v, numbers.Real):
+            return self.schema.enum_value(self.instance, field_idx, v)
+        return float(v)
+
+    cdef tuple _predicate(self, op, unsigned field_idx, args):
+        cdef nmsg_msgmod_field_type ft = self.schema.c_types[field_idx]
+        name = self.schema.names[field_idx]
+
+        if op == 'exists':
+            return (_F_EXISTS, field_idx, [], [], None)
+        elif op == 'eq':
+            vals = sorted(set(self._pack(field_idx, v) for v in args[0]), key=lambda b: (len(b), b))
+            return (_F_EQ, field_idx, vals, [], None)
+        elif op == 'range':
+            if ft not in _fpack_formats:
+                raise ValueError('range filter on non-numeric field %s' % name)
+            return (_F_RANGE, field_idx, [], [], (self._number(field_idx, args[0]), self._number(field_idx, args[1]), args[2], args[3]))
+        elif op == 'prefix' or op == 'suffix':
+            if not _fis_text(ft):
+                raise ValueError('%s filter on non-string field %s' % (op, name))
+            vals = [ self._pack(field_idx, v) for v in args[0] ]
+            return (_F_PREFIX if op == 'prefix' else _F_SUFFIX, field_idx, vals, [], None)
+        elif op == 'net':
+            if ft != nmsg_msgmod_ft_ip:
+                raise ValueError('network filter on non-IP field %s' % name)
+            vals = []
+            bits = []
+            for net in args[0]:
+                addr, _, plen = net.partition('/')
+                v = self._pack(field_idx, addr)
+                plen = int(plen) if plen else len(v) * 8
+                if plen < 0 or plen > len(v) * 8:
+                    raise ValueError('bad network prefix length: %s' % net)
+                vals.append(v)
+                bits.append(plen)
+            return (_F_NET, field_idx, vals, bits, None)
+        raise ValueError('unknown filter operation %s' % op)
+
+    cdef int _fill(self, _fnode *nd, tuple t) except -1:
+        cdef size_t i
+        cdef size_t total = 0
+
+        nd.op = t[0]
+        nd.n_vals = 0
+        nd.range_flags = 0
+        if len(t) == 1:
+            return 0
+
+        nd.field_idx = t[1]
+        nd.ft = self.schema.c_types[nd.field_idx]
+        nd.repeated = self.schema.c_flags[nd.field_idx] & NMSG_MSGMOD_FIELD_REPEATED
+        vals = t[2]
+        bits = t[3]
+
+        nd.n_vals = len(vals)
+        for v in vals:
+            total += len(v)
+        nd.blob = <uint8_t *> malloc(max(total, 1))
+        nd.offs = <size_t *> malloc((nd.n_vals + 1) * sizeof(size_t))
+        nd.bits = <uint8_t *> malloc(max(len(bits), 1))
+        if nd.blob == NULL or nd.offs == NULL or nd.bits == NULL:
+            raise MemoryError()
+        nd.offs[0] = 0
+        for i in range(nd.n_vals):
+            memcpy(nd.blob + nd.offs[i], <char *> vals[i], len(vals[i]))
+            nd.offs[i + 1] = nd.offs[i] + len(vals[i])
+        for i in range(len(bits)):
+            nd.bits[i] = bits[i]
+
+        if t[4] is not None:
+            lo, hi, lo_incl, hi_incl = t[4]
+            if lo is not None:
+                nd.lo = lo
+                nd.range_flags |= _F_HAS_LO | (_F_LO_INCL if lo_incl else 0)
+            if hi is not None:
+                nd.hi = hi
+                nd.range_flags |= _F_HAS_HI | (_F_HI_INCL if hi_incl else 0)
+        return 0
+
+# Checks everything about an expression that does not depend on a message
+# schema, so a malformed filter fails when it is set rather than on the
+# first message it is compiled for.
+cdef _check_expr(expr):
+    if not isinstance(expr, _expr):
+        raise TypeError('filter must be built from nmsg.field() expressions')
+    op = expr.op
+    if op == 'and' or op == 'or':
+        _check_expr(expr.args[0])
+        _check_expr(expr.args[1])
+    elif op == 'not':
+        _check_expr(expr.args[0])
+    elif op == 'range':
+        for v in expr.args[1:3]:
+            if v is not None and not isinstance(v, (numbers.Real, str, unicode)):
+                raise TypeError('range filter bound must be a number or enum name: %r' % (v,))
+    elif op == 'net':
+        for net in expr.args[1]:
+            addr, _, plen = net.partition('/')
+            v = socket.inet_pton(socket.AF_INET6 if ':' in addr else socket.AF_INET, addr)
+            if plen and not 0 <= int(plen) <= len(v) * 8:
+                raise ValueError('bad network prefix length: %s' % net)
+    elif op not in ('eq', 'prefix', 'suffix', 'exists'):
+        raise ValueError('unknown filter operation %s' % op)
+
+cdef inline uint64_t _fnv1a(const uint8_t *data, size_t n) nogil:
+    cdef uint64_t h = 14695981039346656037ULL
+    cdef size_t i
+
+    for i in range(n):
+        h ^= data[i]
+        h *= 1099511628211ULL
+    # Fold the high bits down so h % rate is evenly spread.
+    h ^= h >> 33
+    h *= 0xff51afd7ed558ccdULL
+    h ^= h >> 33
+    return h
+
+# What a filter knows about one message type: its compiled program, if
+# there is an expression, and the index of the sample key field.
+cdef struct _fslot:
+    uint64_t key
+    _fprog *prog
+    long sample_idx
+
+# The part of a filter that is read without the GIL. The slots and sample
+# settings change only under the write lock; the counters are atomic.
+cdef struct _fstate:
+    pthread_rwlock_t lock
+    _fslot *slots
+    size_t n_slots
+    size_t cap_slots
+    size_t sample_rate
+    bint sample_keyed
+    uint64_t sample_count
+    uint64_t generation
+    uint64_t accepted
+    uint64_t rejected
+    uint64_t sampled_out
+
+cdef inline uint64_t _fmsg_key(nmsg_message_t m) nogil:
+    return (<uint64_t> <uint32_t> nmsg_message_get_vid(m)) << 32 | <uint32_t> nmsg_message_get_msgtype(m)
+
+cdef _fslot *_fstate_find(_fstate *st, uint64_t key) nogil:
+    cdef size_t i
+
+    for i in range(st.n_slots):
+        if st.slots[i].key == key:
+            return &st.slots[i]
+    return NULL
+
+cdef bint _fstate_sample(_fstate *st, _fslot *s, nmsg_message_t m) nogil:
+    cdef uint8_t *data = NULL
+    cdef size_t data_len = 0
+
+    if not st.sample_keyed:
+        return __atomic_fetch_add(&st.sample_count, 1, __ATOMIC_RELAXED) % st.sample_rate == 0
+    if s.sample_idx >= 0 and nmsg_message_get_field_by_idx(m, s.sample_idx, 0, <void **> &data, &data_len) != nmsg_res_success:
+        data_len = 0
+    return _fnv1a(data, data_len) % st.sample_rate == 0
+
+# Judges m against the filter without taking the GIL. Returns -1 for a
+# message type that has no slot yet, or whose program is too large for the
+# local stack and the caller does not hold the GIL; the caller then falls
+# back to _filter.accept().
+cdef int _fstate_accept(_fstate *st, nmsg_message_t m, bint gil) noexcept nogil:
+    cdef bint stack[_FSTACK_MAX]
+    cdef bint *sp = stack
+    cdef _fslot *s
+    cdef int res = -1
+
+    pthread_rwlock_rdlock(&st.lock)
+    s = _fstate_find(st, _fmsg_key(m))
+    if s != NULL:
+        if s.prog != NULL and s.prog.n > _FSTACK_MAX:
+            # The program's own stack is only used with the GIL held.
+            sp = s.prog.stack if gil else NULL
+        if sp != NULL:
+            if s.prog != NULL and not _fprog_run(s.prog, m, sp):
+                __atomic_fetch_add(&st.rejected, 1, __ATOMIC_RELAXED)
+                res = 0
+            elif st.sample_rate > 1 and not _fstate_sample(st, s, m):
+                __atomic_fetch_add(&st.sampled_out, 1, __ATOMIC_RELAXED)
+                res = 0
+            else:
+                __atomic_fetch_add(&st.accepted, 1, __ATOMIC_RELAXED)
+                res = 1
+    pthread_rwlock_unlock(&st.lock)
+    return res
+
+# Per-reader message selection applied before messages are wrapped: an
+# optional filter expression, compiled for each message type seen so far,
+# followed by optional 1-in-N sampling. Sampling with a key field keeps
+# or drops every message with a given value of that field together.
+cdef class _filter(object):
+    cdef readonly object expr
+    cdef dict progs
+    cdef readonly object sample_key
+    cdef _fstate st
+
+    def __cinit__(self):
+        self.st.slots = NULL
+        self.st.n_slots = 0
+        self.st.cap_slots = 0
+        if pthread_rwlock_init(&self.st.lock, NULL) != 0:
+            raise MemoryError()
+
+    def __dealloc__(self):
+        pthread_rwlock_destroy(&self.st.lock)
+        free(self.st.slots)
+
+    def __init__(self):
+        self.expr = None
+        self.progs = {}
+        self.st.sample_rate = 0
+        self.st.sample_keyed = False
+        self.st.sample_count = 0
+        self.st.generation = 0
+        self.st.accepted = 0
+        self.st.rejected = 0
+        self.st.sampled_out = 0
+
+    property sample_rate:
+        def __get__(self):
+            return self.st.sample_rate
+
+    property accepted:
+        def __get__(self):
+            return __atomic_load_n(&self.st.accepted, __ATOMIC_RELAXED)
+
+    property rejected:
+        def __get__(self):
+            return __atomic_load_n(&self.st.rejected, __ATOMIC_RELAXED)
+
+    property sampled_out:
+        def __get__(self):
+            return __atomic_load_n(&self.st.sampled_out, __ATOMIC_RELAXED)
+
+    # Writers hold the GIL while they wait for the lock and while they hold
+    # it, and do nothing in between that could run Python code and switch
+    # threads. Readers without the GIL never wait for it under the lock,
+    # and readers with the GIL cannot run while a writer is active.
+    cdef void _wrlock(self):
+        pthread_rwlock_wrlock(&self.st.lock)
+
+    cdef void _unlock(self):
+        pthread_rwlock_unlock(&self.st.lock)
+
+    cdef set_expr(self, expr):
+        cdef dict progs = {}
+
+        if expr is not None:
+            _check_expr(expr)
+        # The old expression and programs are released after the slots
+        # that point into them are gone and the lock is dropped.
+        old_expr = self.expr
+        old_progs = self.progs
+        self._wrlock()
+        self.st.generation += 1
+        self.st.n_slots = 0
+        self.expr = expr
+        self.progs = progs
+        self._unlock()
+
+    # Compiles the expression for one message type ahead of time, so errors
+    # that depend on the schema (a range on a string field, an unknown enum
+    # name) are raised by the caller instead of inside a read loop.
+    cdef int precompile(self, unsigned vid, unsigned msgtype) except -1:
+        cdef nmsg_message_t template
+        cdef _fprogram prog
+        cdef uint64_t key = (<uint64_t> vid) << 32 | msgtype
+
+        if self.expr is None or key in self.progs:
+            return 0
+        template = nmsg_message_init(_get_msgmod(vid, msgtype)._instance)
+        if template == NULL:
+            raise Exception, 'nmsg_message_init() failed'
+        try:
+            prog = _fprogram()
+            prog.compile(self.expr, _get_schema(template), template)
+        finally:
+            nmsg_message_destroy(&template)
+        self.progs[key] = prog
+        return 0
+
+    cdef set_sample(self, size_t rate, key):
+        old_key = self.sample_key
+        self._wrlock()
+        # The slots hold sample key indexes for the old key.
+        self.st.generation += 1
+        self.st.n_slots = 0
+        self.st.sample_rate = rate
+        self.st.sample_keyed = key is not None
+        self.st.sample_count = 0
+        self.sample_key = key
+        self._unlock()
+
+    cdef bint active(self):
+        return self.expr is not None or self.st.sample_rate > 1
+
+    # Compiles the expression and looks up the sample key for the message
+    # type of instance, and publishes them in a new slot.
+    cdef int _add_slot(self, nmsg_message_t instance) except -1:
+        cdef uint64_t key = _fmsg_key(instance)
+        cdef uint64_t generation = self.st.generation
+        cdef _fprogram prog = None
+        cdef long idx = -1
+        cdef size_t cap
+        cdef _fslot *slot
+        cdef bint nomem = False
+
+        if self.expr is not None:
+            prog = self.progs.get(key)
+            if prog is None:
+                prog = _fprogram()
+                prog.compile(self.expr, _get_schema(instance), instance)
+                self.progs[key] = prog
+        if self.sample_key is not None:
+            idx = _get_schema(instance).idx.get(self.sample_key, -1)
+
+        # Compiling may have let another thread change the expression or
+        # the sample key; the caller then retries with the new settings.
+        self._wrlock()
+        if self.st.generation == generation and _fstate_find(&self.st, key) == NULL:
+            if self.st.n_slots == self.st.cap_slots:
+                cap = self.st.cap_slots * 2 if self.st.cap_slots else 8
+                slot = <_fslot *> realloc(self.st.slots, cap * sizeof(_fslot))
+                if slot != NULL:
+                    self.st.slots = slot
+                    self.st.cap_slots = cap
+            if self.st.n_slots < self.st.cap_slots:
+                slot = &self.st.slots[self.st.n_slots]
+                slot.key = key
+                slot.prog = &prog.prog if prog is not None else NULL
+                slot.sample_idx = idx
+                self.st.n_slots += 1
+            else:
+                nomem = True
+        self._unlock()
+        if nomem:
+            raise MemoryError()
+        return 0
+
+    cdef bint accept(self, nmsg_message_t instance) except -1:
+        cdef int res = _fstate_accept(&self.st, instance, True)
+
+        # set_expr() or set_sample() from another thread may clear the new
+        # slot before it is used.
+        while res < 0:
+            self._add_slot(instance)
+            res = _fstate_accept(&self.st, instance, True)
+        return res
+
+# set_filter() and set_sample() helpers: update f, creating it if needed,
+# and return None when there is nothing left to apply.
+cdef _filter _filter_with_expr(_filter f, expr):
+    if f is None:
+        if expr is None:
+            return None
+        f = _filter()
+    f.set_expr(expr)
+    return f if f.active() else None
+
+cdef _filter _filter_with_sample(_filter f, rate, key):
+    if rate is None:
+        rate = 0
+    if rate < 0:
+        raise ValueError('sample rate must not be negative')
+    if f is None:
+        if rate <= 1:
+            return None
+        f = _filter()
+    f.set_sample(rate, key)
+    return f if f.active() else None
+
+# Drops the messages f rejects, compacting the array in place. Returns the
+# number kept. On error every message in the array is destroyed.
+cdef Py_ssize_t _filter_messages(_filter f, nmsg_message_t *msgs, size_t n) except -1:
+    cdef size_t i = 0
+    cdef size_t j = 0
+    cdef size_t k
+
+    try:
+        while i < n:
+            if f.accept(msgs[i]):
+                msgs[j] = msgs[i]
+                j += 1
+            else:
+                nmsg_message_destroy(&msgs[i])
+            i += 1
+    except:
+        for k in range(j):
+            nmsg_message_destroy(&msgs[k])
+        for k in range(i, n):
+            nmsg_message_destroy(&msgs[k])
+        raise
+    return j
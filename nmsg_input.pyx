@@ -16,10 +16,15 @@
 # limitations under the License.
 import threading
 
+from cpython.buffer cimport PyObject_GetBuffer, PyBuffer_Release, PyBUF_SIMPLE
+
 def _cstr2str(x):
     t = x.decode('ascii')
     return t
 
+# Number of messages input.__iter__ requests per read_many() call.
+_READ_BATCH = 256
+
 def input_open_file(obj):
     if type(obj) == str:
         obj = open(obj)
@@ -34,8 +39,13 @@ def input_open_json(obj):
     i._open_json(obj)
     return i
 
+def _sock_family(addr):
+    if ':' in addr:
+        return socket.AF_INET6
+    return socket.AF_INET
+
 def input_open_sock(addr, port):
-    obj = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    obj = socket.socket(_sock_family(addr), socket.SOCK_DGRAM)
     obj.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     try:
         obj.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1048576)
@@ -46,15 +56,79 @@ def input_open_sock(addr, port):
     i._open_sock(obj)
     return i
 
+# Messages decoded from one container. Each message is wrapped the first
+# time it is accessed; the rest are freed with the batch.
+cdef class message_batch(object):
+    cdef nmsg_message_t *_msgs
+    cdef size_t n
+    cdef list _wrapped
+    cdef bool lazy
+    cdef bool header_only
+
+    def __cinit__(self):
+        self._msgs = NULL
+        self.n = 0
+        self._wrapped = None
+        self.lazy = False
+        self.header_only = False
+
+    def __dealloc__(self):
+        cdef size_t i
+
+        if self._msgs == NULL:
+            return
+        for i in range(self.n):
+            if self._msgs[i] != NULL:
+                nmsg_message_destroy(&self._msgs[i])
+        free(self._msgs)
+
+    def __repr__(self):
+        return 'nmsg message_batch object n=%d' % self.n
+
+    def __len__(self):
+        return self.n
+
+    cdef object _get(self, size_t i):
+        if self._wrapped is None:
+            self._wrapped = [ None ] * self.n
+        if self._msgs[i] != NULL:
+            self._wrapped[i] = _wrap_message(self._msgs[i], self.lazy, self.header_only)
+            self._msgs[i] = NULL
+        return self._wrapped[i]
+
+    def __getitem__(self, key):
+        cdef Py_ssize_t i
+
+        if isinstance(key, slice):
+            return [ self._get(j) for j in range(*key.indices(self.n)) ]
+        i = key
+        if i < 0:
+            i += self.n
+        if i < 0 or i >= <Py_ssize_t> self.n:
+            raise IndexError('message_batch index out of range')
+        return self._get(i)
+
+    def __iter__(self):
+        cdef size_t i
+
+        for i in range(self.n):
+            yield self._get(i)
+
 cdef class nullinput(object):
     cdef nmsg_input_t _instance
     cdef object lock
+    cdef bool lazy
+    cdef bool header_only
+    cdef _filter _filter
+    cdef _stats _stats
 
     def __cinit__(self):
         self._instance = nmsg_input_open_null()
 
     def __init__(self):
         self.lock = threading.Lock()
+        self.lazy = False
+        self.header_only = False
 
     def __dealloc__(self):
         if self._instance != NULL:
@@ -63,51 +137,153 @@ cdef class nullinput(object):
     def __repr__(self):
         return 'nmsg nullinput object _instance=0x%x' % <uint64_t> self._instance
 
-    def read(self, bytes buf, tv=None):
+    cdef int _read_null(self, buf, tv, size_t offset, length, nmsg_message_t **_msgarray, size_t *n_msg) except -1:
         cdef nmsg_res res
-        cdef nmsg_message_t *_msgarray
-        cdef size_t n_msg
-        cdef _recv_message msg
         cdef timespec ts
         cdef timespec *tsp
-        msg_list = []
+        cdef Py_buffer view
+        cdef uint8_t *buf_ptr
+        cdef size_t buf_len
+        cdef int64_t start
 
         if self._instance == NULL:
             raise Exception, 'object not initialized'
 
-        cdef uint8_t * buf_ptr = <uint8_t *> buf
-        cdef size_t buf_len = len(buf)
-
         if tv is not None:
             if not isinstance(tv, numbers.Real):
                 raise ValueError('tv must be a real number')
             ts.tv_sec = int(tv)
-            ts.tv_nsec = tv - int(tv)
+            ts.tv_nsec = int((tv - int(tv)) * 1000000000)
             tsp = &ts
         else:
             tsp = NULL
 
-        with self.lock:
-            with nogil:
-                res = nmsg_input_read_null(self._instance, buf_ptr, buf_len, tsp, &_msgarray, &n_msg)
+        # Decode straight out of the caller's buffer; holding the buffer
+        # export keeps a bytearray from being resized underneath us.
+        PyObject_GetBuffer(buf, &view, PyBUF_SIMPLE)
+        try:
+            if offset > <size_t> view.len:
+                raise ValueError('offset is past the end of the buffer')
+            buf_len = view.len - offset
+            if length is not None:
+                if length < 0 or length > buf_len:
+                    raise ValueError('length is past the end of the buffer')
+                buf_len = length
+            buf_ptr = <uint8_t *> view.buf + offset
 
-        if res == nmsg_res_success:
-            for i in range(n_msg):
-                msg = _recv_message()
-                msg.set_instance(_msgarray[i])
+            with self.lock:
+                with nogil:
+                    start = _profile_start()
+                    res = nmsg_input_read_null(self._instance, buf_ptr, buf_len, tsp, _msgarray, n_msg)
+        finally:
+            PyBuffer_Release(&view)
+        _profile_record(_PROF_READ, _PROF_NOKEY, start)
+
+        if self._stats is not None:
+            self._stats.containers += 1
+            self._stats.bytes += buf_len
+        if res == nmsg_res_again:
+            # A fragment container other than the last one of its message:
+            # libnmsg keeps it until the message can be reassembled.
+            if self._stats is not None:
+                self._stats.again += 1
+            _msgarray[0] = NULL
+            n_msg[0] = 0
+            return 0
+        if res != nmsg_res_success:
+            if self._stats is not None:
+                self._stats.errors += 1
+            raise Exception, 'nmsg_input_null() failed: %s' % _cstr2str(nmsg_res_lookup(res))
+
+        if self._filter is not None:
+            try:
+                n_msg[0] = _filter_messages(self._filter, _msgarray[0], n_msg[0])
+            except:
+                free(_msgarray[0])
+                raise
+        if self._stats is not None:
+            self._stats.messages += n_msg[0]
+        return 0
+
+    # buf may be any object supporting the buffer protocol: bytes,
+    # bytearray, memoryview or mmap. offset and length select a window.
+    def read(self, buf, tv=None, size_t offset=0, length=None):
+        cdef nmsg_message_t *_msgarray
+        cdef size_t n_msg
+        cdef size_t i = 0
+        msg_list = []
+
+        self._read_null(buf, tv, offset, length, &_msgarray, &n_msg)
+        try:
+            while i < n_msg:
+                msg = _wrap_message(_msgarray[i], self.lazy, self.header_only)
+                i += 1
                 msg_list.append(msg)
+        finally:
+            # Free the instances that were never wrapped.
+            while i < n_msg:
+                nmsg_message_destroy(&_msgarray[i])
+                i += 1
             free(_msgarray)
-        else:
-            raise Exception, 'nmsg_input_null() failed: %s' % _cstr2str(nmsg_res_lookup(res))
 
         return msg_list
 
+    # Like read(), but messages are only wrapped in Python objects as the
+    # returned batch is indexed or iterated.
+    def read_batch(self, buf, tv=None, size_t offset=0, length=None):
+        cdef message_batch batch = message_batch()
+
+        self._read_null(buf, tv, offset, length, &batch._msgs, &batch.n)
+        batch.lazy = self.lazy
+        batch.header_only = self.header_only
+        return batch
+
+    def read_columns(self, buf, vid, msgtype, fields=None, tv=None, size_t offset=0, length=None):
+        cdef nmsg_message_t *_msgarray
+        cdef size_t n_msg
+        cdef _columns_builder builder = _columns_builder(vid, msgtype, fields)
+
+        self._read_null(buf, tv, offset, length, &_msgarray, &n_msg)
+        try:
+            for i in range(n_msg):
+                if builder.matches(_msgarray[i]):
+                    builder.add(_msgarray[i])
+        finally:
+            for i in range(n_msg):
+                nmsg_message_destroy(&_msgarray[i])
+            free(_msgarray)
+
+        return builder.finish()
+
+    def set_lazy(self, bool flag):
+        self.lazy = flag
+
+    # Return message_header objects instead of messages.
+    def set_header_only(self, bool flag):
+        self.header_only = flag
+
+    def set_filter(self, expr):
+        self._filter = _filter_with_expr(self._filter, expr)
+
+    def set_sample(self, rate, key=None):
+        self._filter = _filter_with_sample(self._filter, rate, key)
+
+    def set_stats(self, bool flag):
+        self._stats = _stats_enable(self._stats, flag)
+
+    def stats(self):
+        return _stats_snapshot(self._stats, self._filter)
+
 cdef class input(object):
     cdef nmsg_input_t _instance
     cdef object fileobj
     cdef str input_type
     cdef bool blocking_io
+    cdef bool lazy
+    cdef bool header_only
     cdef object lock
+    cdef _filter _filter
+    cdef _stats _stats
 
     open_file = staticmethod(input_open_file)
     open_json = staticmethod(input_open_json)
@@ -123,6 +299,8 @@ cdef class input(object):
 
     def __init__(self):
         self.blocking_io = True
+        self.lazy = False
+        self.header_only = False
 
     def __repr__(self):
         return 'nmsg input object type=%s _instance=0x%x' % (self.input_type, <uint64_t> self._instance)
@@ -164,7 +342,7 @@ cdef class input(object):
         cdef int err
         cdef nmsg_res res
         cdef nmsg_message_t _msg
-        cdef _recv_message msg
+        cdef int64_t start
 
         if self._instance == NULL:
             raise Exception, 'object not initialized'
@@ -174,14 +352,22 @@ cdef class input(object):
         while res != nmsg_res_success:
             with self.lock:
                 with nogil:
+                    start = _profile_start()
                     res = nmsg_input_read(self._instance, &_msg)
             if res == nmsg_res_success:
-                msg = _recv_message()
-                msg.set_instance(_msg)
-                return msg
+                _profile_record(_PROF_READ, _profile_key(nmsg_message_get_vid(_msg), nmsg_message_get_msgtype(_msg)), start)
+                if self._filter is not None and not self._filter.accept(_msg):
+                    nmsg_message_destroy(&_msg)
+                    res = nmsg_res_again
+                    continue
+                if self._stats is not None:
+                    self._stats.messages += 1
+                return _wrap_message(_msg, self.lazy, self.header_only)
             elif res == nmsg_res_eof:
                 return None
             elif res == nmsg_res_again:
+                if self._stats is not None:
+                    self._stats.again += 1
                 err = PyErr_CheckSignals()
                 if err != 0:
                     if PyErr_ExceptionMatches(KeyboardInterrupt):
@@ -190,8 +376,153 @@ cdef class input(object):
                     return None
                 continue
             else:
+                if self._stats is not None:
+                    self._stats.errors += 1
                 raise Exception, 'nmsg_input_read() xfailed: %s' % _cstr2str(nmsg_res_lookup(res))
         
+    # Returns a partial batch as soon as the input runs dry. An empty list
+    # means EOF, no data on a non-blocking input, or an expired timeout.
+    def read_many(self, size_t max_count, timeout=None):
+        cdef nmsg_res res
+        cdef size_t n = 0
+        cdef size_t i = 0
+        cdef nmsg_message_t *_msgarray
+        cdef int64_t start
+        cdef bint drain
+        cdef bint unblocked = False
+
+        if self._instance == NULL:
+            raise Exception, 'object not initialized'
+
+        if max_count == 0:
+            return []
+
+        # Once a blocking socket has delivered a message, read whatever else
+        # is already queued without waiting for the poll timeout. Blocking
+        # is turned off once and restored before returning.
+        drain = self.blocking_io and self.input_type == 'socket'
+
+        if timeout is not None:
+            if not isinstance(timeout, numbers.Real):
+                raise ValueError('timeout must be a real number')
+            deadline = time.time() + timeout
+
+        _msgarray = <nmsg_message_t *> malloc(max_count * sizeof(nmsg_message_t))
+        if _msgarray == NULL:
+            raise MemoryError()
+
+        msg_list = []
+        try:
+            while True:
+                with self.lock:
+                    with nogil:
+                        start = _profile_start()
+                        res = nmsg_res_success
+                        while n < max_count:
+                            res = nmsg_input_read(self._instance, &_msgarray[n])
+                            if res != nmsg_res_success:
+                                break
+                            n += 1
+                            if drain and not unblocked:
+                                unblocked = nmsg_input_set_blocking_io(self._instance, False) == nmsg_res_success
+                if n > 0:
+                    _profile_record(_PROF_READ, _PROF_NOKEY, start)
+                if self._filter is not None:
+                    # On error the filter has already freed every message.
+                    i = n
+                    n = 0
+                    n = _filter_messages(self._filter, _msgarray, i)
+                    i = 0
+                if n > 0 or res == nmsg_res_eof:
+                    break
+                elif res == nmsg_res_success:
+                    continue
+                elif res == nmsg_res_again:
+                    if self._stats is not None:
+                        self._stats.again += 1
+                    # Raises KeyboardInterrupt, or whatever else a signal
+                    # handler raised, right away.
+                    PyErr_CheckSignals()
+                    if self.blocking_io is False:
+                        break
+                    elif timeout is not None and time.time() >= deadline:
+                        break
+                    elif unblocked:
+                        # The filter dropped everything read so far; wait
+                        # for the next message again.
+                        with self.lock:
+                            nmsg_input_set_blocking_io(self._instance, True)
+                        unblocked = False
+                else:
+                    if self._stats is not None:
+                        self._stats.errors += 1
+                    raise Exception, 'nmsg_input_read() failed: %s' % _cstr2str(nmsg_res_lookup(res))
+
+            if self._stats is not None:
+                self._stats.messages += n
+            while i < n:
+                msg = _wrap_message(_msgarray[i], self.lazy, self.header_only)
+                i += 1
+                msg_list.append(msg)
+        finally:
+            if unblocked:
+                with self.lock:
+                    nmsg_input_set_blocking_io(self._instance, True)
+            # Free the instances that were never wrapped.
+            while i < n:
+                nmsg_message_destroy(&_msgarray[i])
+                i += 1
+            free(_msgarray)
+
+        return msg_list
+
+    # Decodes up to max_count messages of one type straight into columns;
+    # messages of other types are skipped.
+    def read_columns(self, vid, msgtype, size_t max_count, fields=None):
+        cdef nmsg_res res
+        cdef nmsg_message_t _msg
+        cdef _columns_builder builder = _columns_builder(vid, msgtype, fields)
+
+        if self._instance == NULL:
+            raise Exception, 'object not initialized'
+
+        while builder.n < max_count:
+            with self.lock:
+                with nogil:
+                    res = nmsg_input_read(self._instance, &_msg)
+            if res == nmsg_res_success:
+                try:
+                    if builder.matches(_msg) and (self._filter is None or self._filter.accept(_msg)):
+                        builder.add(_msg)
+                        if self._stats is not None:
+                            self._stats.messages += 1
+                finally:
+                    nmsg_message_destroy(&_msg)
+            elif res == nmsg_res_eof:
+                break
+            elif res == nmsg_res_again:
+                if builder.n > 0:
+                    break
+                if self._stats is not None:
+                    self._stats.again += 1
+                PyErr_CheckSignals()
+                if self.blocking_io is False:
+                    break
+            else:
+                if self._stats is not None:
+                    self._stats.errors += 1
+                raise Exception, 'nmsg_input_read() failed: %s' % _cstr2str(nmsg_res_lookup(res))
+
+        return builder.finish()
+
+    def __iter__(self):
+        while True:
+            msg_list = self.read_many(_READ_BATCH)
+            if not msg_list:
+                return
+            for msg in msg_list:
+                yield msg
+
     def set_filter_msgtype(self, vid, msgtype):
         if self._instance == NULL:
             raise Exception, 'object not initialized'
@@ -231,3 +562,27 @@ cdef class input(object):
         if res != nmsg_res_success:
             raise Exception, 'nmsg_input_set_blocking_io() failed'
         self.blocking_io = flag
+
+    def set_lazy(self, bool flag):
+        self.lazy = flag
+
+    def set_header_only(self, bool flag):
+        self.header_only = flag
+
+    # Drops messages that do not match expr, built from nmsg.field(),
+    # before they are wrapped in message objects. None clears the filter.
+    def set_filter(self, expr):
+        self._filter = _filter_with_expr(self._filter, expr)
+
+    # Keeps one message in rate, chosen before messages are wrapped. With
+    # key, the choice is a hash of that field's value, so all messages
+    # sharing a value are kept or dropped together. 0 or None disables.
+    def set_sample(self, rate, key=None):
+        self._filter = _filter_with_sample(self._filter, rate, key)
+
+    # Counts messages returned, nmsg_res_again polls and read errors.
+    def set_stats(self, bool flag):
+        self._stats = _stats_enable(self._stats, flag)
+
+    def stats(self):
+        return _stats_snapshot(self._stats, self._filter)
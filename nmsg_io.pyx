@@ -45,8 +45,63 @@ cdef public int pynmsg_raise_signal "pynmsg_raise_signal"(int sig) except 0 with
     PyErr_CheckSignals()
     return 0
 
+def _channel_sockets(str ch_input):
+    fname = None
+    for f in chalias_fnames:
+        if os.path.isfile(f):
+            fname = f
+    if fname is None:
+        raise Exception, 'unable to locate nmsg channel alias file'
+
+    socks_list = []
+    found_channel = False
+    for line in open(fname):
+        ch, socks = line.strip().split(None, 1)
+        if ch == ch_input:
+            found_channel = True
+            for sock in socks.split():
+                addr, portspec = sock.split('/', 1)
+                if '..' in portspec:
+                    portrange = [ int(p) for p in portspec.split('..', 1) ]
+                    for port in range(portrange[0], portrange[1] + 1):
+                        socks_list.append((addr, port))
+                else:
+                    socks_list.append((addr, int(portspec)))
+    if not found_channel:
+        raise Exception, 'lookup of channel %s failed' % ch_input
+    return socks_list
+
+# State handed to libnmsg with the io's input filter function. active is
+# read without the GIL so an io with no filter or sampling pays nothing
+# per message. filter is the io's filter, which lives as long as the io.
+cdef struct _io_filter_ctx:
+    bint active
+    _fstate *filter
+    void *io
+
+# Applies io.set_filter() and io.set_sample() to every message read by the
+# io's inputs, before libnmsg hands it to any output. The GIL is only taken
+# the first time a message type is seen, to compile the filter for it.
+cdef nmsg_res _io_filter_func(nmsg_message_t *msg, void *user, nmsg_filter_message_verdict *vres) noexcept nogil:
+    cdef _io_filter_ctx *ctx = <_io_filter_ctx *> user
+    cdef int res
+
+    vres[0] = nmsg_filter_message_verdict_DECLINED
+    if ctx.active:
+        res = _fstate_accept(ctx.filter, msg[0], False)
+        if res < 0:
+            with gil:
+                vres[0] = (<io> ctx.io)._filter_verdict(msg[0])
+        elif res:
+            vres[0] = nmsg_filter_message_verdict_ACCEPT
+        else:
+            vres[0] = nmsg_filter_message_verdict_DROP
+    return nmsg_res_success
+
 cdef class io(object):
     cdef nmsg_io_t _instance
+    cdef _io_filter_ctx _fctx
+    cdef object _error
 
     cdef unsigned filter_vid
     cdef unsigned filter_msgtype
@@ -57,9 +112,15 @@ cdef class io(object):
 
     cdef list inputs
     cdef list outputs
+    cdef _filter _filter
+    cdef _filter _fobj
+    cdef _stats _stats
 
     def __cinit__(self):
         self._instance = NULL
+        self._fctx.active = False
+        self._fctx.filter = NULL
+        self._fctx.io = <void *> self
 
     def __dealloc__(self):
         if self._instance != NULL:
@@ -95,6 +156,7 @@ cdef class io(object):
             i.set_filter_operator(self.filter_operator)
         if self.filter_group:
             i.set_filter_group(self.filter_group)
+        nmsg_input_set_filter_func(i._instance, _io_filter_func, &self._fctx)
 
         res = nmsg_io_add_input(self._instance, i._instance, NULL)
         if res != nmsg_res_success:
@@ -103,38 +165,36 @@ cdef class io(object):
         i._instance = NULL
 
     def add_input_channel(self, str ch_input):
-        fname = None
-        for f in chalias_fnames:
-            if os.path.isfile(f):
-                fname = f
-        if fname is None:
-            raise Exception, 'unable to locate nmsg channel alias file'
-
-        found_channel = False
-        for line in open(fname):
-            ch, socks = line.strip().split(None, 1)
-            if ch == ch_input:
-                found_channel = True
-                for sock in socks.split():
-                    addr, portspec = sock.split('/', 1)
-                    if '..' in portspec:
-                        portrange = [ int(p) for p in portspec.split('..', 1) ]
-                        for port in range(portrange[0], portrange[1] + 1):
-                            i = input.open_sock(addr, port)
-                            self.add_input(i)
-                    else:
-                        i = input.open_sock(addr, portspec)
-                        self.add_input(i)
-        if not found_channel:
-            raise Exception, 'lookup of channel %s failed'
+        for addr, port in _channel_sockets(ch_input):
+            i = input.open_sock(addr, port)
+            self.add_input(i)
 
     def add_output(self, output o):
         cdef nmsg_res res
+        cdef nmsg_output_t proxy
 
         if o._instance == NULL:
             raise Exception, 'output object not initialized'
 
         o.set_filter_msgtype(self.filter_vid, self.filter_msgtype)
+        if o._writer != NULL:
+            # The io writes to a callback output that hands each message to
+            # the writer thread, which keeps the output and its max_delay.
+            # The output object stays open and owns its nmsg output.
+            proxy = nmsg_output_open_callback(<nmsg_cb_message> pynmsg_writer_callback, <void *> o._writer)
+            if proxy == NULL:
+                raise Exception, 'nmsg_output_open_callback() failed'
+            res = nmsg_io_add_output(self._instance, proxy, NULL)
+            if res != nmsg_res_success:
+                nmsg_output_close(&proxy)
+                raise Exception, 'nmsg_io_add_output() failed'
+            o._io = self._instance
+            self.outputs.append(o)
+            return
+
+        if o.output_type == 'callback':
+            o._stats = self._stats
+        o._io = self._instance
 
         res = nmsg_io_add_output(self._instance, o._instance, NULL)
         if res != nmsg_res_success:
@@ -142,7 +202,7 @@ cdef class io(object):
         self.outputs.append(o)
         o._instance = NULL
 
-    def add_output_callback(self, fn):
+    def add_output_callback(self, fn, lazy=False, batch_size=None, max_delay=None, header_only=False):
         cdef output o
         cdef nmsg_res res
 
@@ -153,7 +213,7 @@ cdef class io(object):
                 self.break_loop()
                 raise KeyboardInterrupt
 
-        o = output.open_callback(wrapper)
+        o = output.open_callback(wrapper, lazy, batch_size, max_delay, header_only)
         self.add_output(o)
 
     def set_filter_msgtype(self, vid, msgtype):
@@ -178,11 +238,90 @@ cdef class io(object):
         msgmod.grname_to_grid(s_group)
         self.filter_group = s_group
 
+    # Field filters and sampling are applied to messages as the io's inputs
+    # read them, so every output, file and socket outputs included, sees
+    # the same selection. The expression is checked here, and compiled
+    # here too when the io is limited to one message type.
+    def set_filter(self, expr):
+        f = _filter_with_expr(self._fobj, expr)
+        if f is not None and (self.filter_vid or self.filter_msgtype):
+            f.precompile(self.filter_vid, self.filter_msgtype)
+        self._set_filter(f)
+
+    def set_sample(self, rate, key=None):
+        self._set_filter(_filter_with_sample(self._fobj, rate, key))
+
+    cdef _set_filter(self, _filter f):
+        # Input threads use the filter without the GIL, so the io keeps the
+        # first one it creates until it is freed and later calls update it
+        # in place.
+        if f is not None and self._fobj is None:
+            self._fobj = f
+            self._fctx.filter = &f.st
+        self._filter = f
+        self._fctx.active = f is not None
+
+    cdef nmsg_filter_message_verdict _filter_verdict(self, nmsg_message_t instance):
+        # set_filter(None) may have raced with the unlocked check in
+        # _io_filter_func.
+        if self._filter is None:
+            return nmsg_filter_message_verdict_DECLINED
+        if self._error is None:
+            try:
+                if self._filter.accept(instance):
+                    return nmsg_filter_message_verdict_ACCEPT
+            except BaseException:
+                self._error = sys.exc_info()
+                self.break_loop()
+        return nmsg_filter_message_verdict_DROP
+
+    cdef _share_with_outputs(self):
+        cdef output o
+
+        for o in self.outputs:
+            if o.output_type == 'callback':
+                o._stats = self._stats
+
+    # Callback outputs share the io's counters: messages delivered,
+    # callback time, and messages waiting in partial batches.
+    def set_stats(self, bool flag):
+        self._stats = _stats_enable(self._stats, flag)
+        self._share_with_outputs()
+
+    def stats(self):
+        cdef output o
+
+        d = _stats_snapshot(self._stats, self._filter)
+        d['queue_depth'] = sum([ o._queue_depth() for o in self.outputs ])
+        d['dropped'] = sum([ o._dropped() for o in self.outputs ])
+        d['inputs'] = len(self.inputs)
+        d['outputs'] = len(self.outputs)
+        return d
+
     def loop(self):
         cdef nmsg_res res
+        cdef output o
 
-        with nogil:
-            res = nmsg_io_loop(self._instance)
+        try:
+            with nogil:
+                res = nmsg_io_loop(self._instance)
+        finally:
+            for o in self.outputs:
+                try:
+                    o._flush_batch(False)
+                    if o._writer != NULL:
+                        o.flush()
+                except BaseException:
+                    if o._error is None:
+                        o._error = sys.exc_info()
+        # An error in the io's filter or a batched callback stops the
+        # loop; raise it here.
+        if self._error is not None:
+            err = self._error
+            self._error = None
+            raise err[0], err[1], err[2]
+        for o in self.outputs:
+            o._raise_error()
         if res != nmsg_res_success:
             raise Exception, 'nmsg_io_loop() failed: %s' % (nmsg_res_lookup(res))
 
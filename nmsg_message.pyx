@@ -18,10 +18,52 @@
 def message_from_json(s):
     return _json_message(s)
 
+# Copies the raw values of every field of src not named in skip into dst,
+# without decoding them.
+cdef int _copy_fields(nmsg_message_t src, nmsg_message_t dst, _schema schema, skip) except -1:
+    cdef nmsg_res res
+    cdef unsigned field_idx
+    cdef unsigned val_idx
+    cdef uint8_t *data
+    cdef size_t data_len
+
+    for field_idx in range(len(schema.names)):
+        if skip is not None and schema.names[field_idx] in skip:
+            continue
+        val_idx = 0
+        while nmsg_message_get_field_by_idx(src, field_idx, val_idx, <void **> &data, &data_len) == nmsg_res_success:
+            res = nmsg_message_set_field_by_idx(dst, field_idx, val_idx, data, data_len)
+            if res != nmsg_res_success:
+                raise Exception, 'nmsg_message_set_field_by_idx() failed'
+            val_idx += 1
+    return 0
+
+# A new instance with the header and field values of src, for a writer
+# that destroys what it is given while the caller keeps src.
+cdef nmsg_message_t _copy_instance(nmsg_message_t src) except NULL:
+    cdef nmsg_message_t dst
+    cdef timespec ts
+
+    dst = nmsg_message_init(_get_msgmod(nmsg_message_get_vid(src), nmsg_message_get_msgtype(src))._instance)
+    if dst == NULL:
+        raise Exception, 'nmsg_message_init() failed'
+    try:
+        _copy_fields(src, dst, _get_schema(src), None)
+    except:
+        nmsg_message_destroy(&dst)
+        raise
+    nmsg_message_get_time(src, &ts)
+    nmsg_message_set_time(dst, &ts)
+    nmsg_message_set_source(dst, nmsg_message_get_source(src))
+    nmsg_message_set_operator(dst, nmsg_message_get_operator(src))
+    nmsg_message_set_group(dst, nmsg_message_get_group(src))
+    return dst
+
 cdef class message(object):
     cdef msgmod _mod
     cdef nmsg_message_t _instance
     cdef bool changed
+    cdef readonly bool frozen
     cdef readonly int vid
     cdef readonly int msgtype
     cdef public long time_sec
@@ -33,28 +75,44 @@ cdef class message(object):
     cdef public bool has_operator
     cdef public bool has_group
 
-    cdef readonly object fields
-    cdef readonly object field_types
-    cdef readonly object field_names
+    cdef _schema _schema
+    cdef object _fields
+    cdef bool _loaded
+    # Fields assigned through __setitem__ since the last sync.
+    cdef set _dirty
+    # Contents of repeated-field lists handed out to the caller, used to
+    # spot in-place modification at sync time.
+    cdef dict _snapshots
+    cdef bool _full_sync
+    cdef dict _field_types
 
     def __cinit__(self):
         self._instance = NULL
         self._mod = None
+        self._schema = None
         self.vid = 0
         self.msgtype = 0
         self.has_source = False
         self.has_operator = False
         self.has_group = False
         self.changed = False
+        self.frozen = False
+        self._fields = {}
+        self._loaded = False
+        self._dirty = set()
+        self._snapshots = {}
+        self._full_sync = False
+        self._field_types = None
 
     def __init__(self, unsigned vid, unsigned msgtype):
         self.vid = vid
         self.msgtype = msgtype
-        self._mod = msgmod(self.vid, self.msgtype)
+        self._mod = _get_msgmod(self.vid, self.msgtype)
         self._instance = nmsg_message_init(self._mod._instance)
         if self._instance == NULL:
             raise Exception, 'nmsg_message_init() failed'
 
+        self._schema = _get_schema(self._instance)
         self.load_message()
 
     def __dealloc__(self):
@@ -63,17 +121,51 @@ cdef class message(object):
 
     cdef reinit(self):
         if self._mod == None:
-            self._mod = msgmod(self.vid, self.msgtype)
+            self._mod = _get_msgmod(self.vid, self.msgtype)
         if self._instance == NULL:
             self._instance = nmsg_message_init(self._mod._instance)
             if self._instance == NULL:
                 raise Exception, 'nmsg_message_init() failed'
             self.changed = True
+            self._full_sync = True
 
-    cdef set_instance(self, nmsg_message_t instance):
+    cdef prepare_write(self):
+        # Brings the native instance up to date for nmsg_output_write().
+        # Writing does not consume the instance, and libnmsg keeps the
+        # packed payload until a field changes, so repeated writes of an
+        # unmodified message do not re-encode it.
+        if self._instance == NULL:
+            self.reinit()
+        if self.changed or self._snapshots:
+            self.sync_message()
+        if not self.frozen:
+            self.sync_fields()
+
+    def freeze(self):
+        self.prepare_write()
+        self.frozen = True
+
+    cdef nmsg_message_t detach(self) except NULL:
+        # Hands the native instance to a writer that will destroy it. The
+        # fields stay here, so the next write rebuilds an instance. A
+        # frozen message keeps its instance and the writer gets a copy.
+        cdef nmsg_message_t instance
+
+        self.prepare_write()
+        if self.frozen:
+            return _copy_instance(self._instance)
+        if not self._loaded:
+            self.load_message()
+        instance = self._instance
+        self._instance = NULL
+        self.frozen = False
+        return instance
+
+    cdef set_instance(self, nmsg_message_t instance, bint lazy=False):
         cdef const char *a
         cdef timespec ts
         cdef uint32_t u
+        cdef int64_t start
 
         if self._instance != NULL:
             nmsg_message_destroy(&self._instance)
@@ -91,6 +183,7 @@ cdef class message(object):
             self.has_source = True
             self.source = u
 
+        start = _profile_start()
         u = nmsg_message_get_operator(instance)
         if u != 0:
             self.has_operator = True
@@ -112,15 +205,26 @@ cdef class message(object):
                 self.group = b'<UNKNOWN>'
         else:
             self.group = None
-
-        self.load_message()
+        _profile_record(_PROF_ALIAS, _profile_key(self.vid, self.msgtype), start)
+
+        self._fields = {}
+        self._loaded = False
+        self._dirty = set()
+        self._snapshots = {}
+        self._full_sync = False
+        self._schema = _get_schema(instance)
+        self._field_types = None
+        if not lazy:
+            self.load_message()
 
     cdef sync_fields(self):
         cdef timespec ts
         cdef unsigned u
+        cdef int64_t start
 
         if self._instance == NULL:
             raise Exception, 'message not initialized'
+        start = _profile_start()
 
         ts.tv_sec = self.time_sec
         ts.tv_nsec = self.time_nsec
@@ -142,16 +246,19 @@ cdef class message(object):
             nmsg_message_set_group(self._instance, u)
         else:
             nmsg_message_set_group(self._instance, 0)
+        _profile_record(_PROF_ENCODE, _profile_key(self.vid, self.msgtype), start)
 
-    cdef load_message(self):
+    cdef bint has_field(self, unsigned field_idx):
+        cdef uint8_t *data
+        cdef size_t data_len
+
+        return nmsg_message_get_field_by_idx(self._instance, field_idx, 0, <void **> &data, &data_len) == nmsg_res_success
+
+    cdef load_field(self, unsigned field_idx):
         cdef nmsg_res res
-        cdef size_t n_fields
-        cdef const char *field_name
-        cdef nmsg_msgmod_field_type field_type
-        cdef unsigned field_flags
+        cdef nmsg_msgmod_field_type field_type = self._schema.c_types[field_idx]
 
         cdef unsigned val_enum
-        cdef const char *str_enum
         cdef int val_bool
         cdef uint32_t val_uint32
         cdef uint64_t val_uint64
@@ -161,102 +268,146 @@ cdef class message(object):
         cdef uint8_t *data
         cdef size_t data_len
 
-        self.fields = {}
-        self.field_types = {}
-        self.field_names = set()
-
-        res = nmsg_message_get_num_fields(self._instance, &n_fields)
-        if res != nmsg_res_success:
-            raise Exception, 'nmsg_message_get_num_fields() failed'
+        val_list = []
+        val_idx = 0
 
-        for field_idx in range(n_fields):
-            res = nmsg_message_get_field_name(self._instance, field_idx, &field_name)
+        while True:
+            res = nmsg_message_get_field_by_idx(self._instance, field_idx, val_idx, <void **> &data, &data_len)
             if res != nmsg_res_success:
-                raise Exception, 'nmsg_message_get_field_name() failed'
+                break
+            val_idx += 1
+            if field_type == nmsg_msgmod_ft_enum:
+                val_enum = (<unsigned *> data)[0]
+                val_list.append(self._schema.enum_name(self._instance, field_idx, val_enum))
+
+            elif field_type == nmsg_msgmod_ft_bytes:
+                val_list.append(data[:data_len])
+
+            elif field_type == nmsg_msgmod_ft_string or field_type == nmsg_msgmod_ft_mlstring:
+                if data_len > 0 and data[data_len - 1] == '\x00':
+                    data_len -= 1
+                val_list.append(data[:data_len])
+
+            elif field_type == nmsg_msgmod_ft_ip:
+                ip = data[:data_len]
+                if data_len == 4:
+                    val_list.append(socket.inet_ntop(socket.AF_INET, ip))
+                elif data_len == 16:
+                    val_list.append(socket.inet_ntop(socket.AF_INET6, ip))
+
+            elif field_type == nmsg_msgmod_ft_uint16 or field_type == nmsg_msgmod_ft_uint32:
+                val_uint32 = (<uint32_t *> data)[0]
+                val_list.append(val_uint32)
+
+            elif field_type == nmsg_msgmod_ft_uint64:
+                val_uint64 = (<uint64_t *> data)[0]
+                val_list.append(val_uint64)
+
+            elif field_type == nmsg_msgmod_ft_int16 or field_type == nmsg_msgmod_ft_int32:
+                val_int32 = (<int32_t *> data)[0]
+                val_list.append(val_int32)
+
+            elif field_type == nmsg_msgmod_ft_int64:
+                val_int64 = (<int64_t *> data)[0]
+                val_list.append(val_int64)
+
+            elif field_type == nmsg_msgmod_ft_double:
+                val_double = (<double *> data)[0]
+                val_list.append(val_double)
+
+            elif field_type == nmsg_msgmod_ft_bool:
+                val_bool = (<int *> data)[0]
+                val_list.append(val_bool)
+
+        if len(val_list) == 0:
+            return None
+        if self._schema.c_flags[field_idx] & NMSG_MSGMOD_FIELD_REPEATED:
+            return val_list
+        return val_list[0]
 
-            field_name_dec = field_name.decode('utf-8')
-            self.field_names.add(field_name_dec)
+    cdef load_message(self):
+        # Decode every field not already memoized by a lazy lookup or
+        # replaced by __setitem__.
+        cdef int64_t start = _profile_start()
+
+        for field_idx, field_name in enumerate(self._schema.names):
+            if field_name in self._fields:
+                continue
+            val = self.load_field(field_idx)
+            if val is not None:
+                self._fields[field_name] = val
+        self._loaded = True
+        _profile_record(_PROF_DECODE, _profile_key(self.vid, self.msgtype), start)
+
+    cdef size_t value_count(self, unsigned field_idx):
+        cdef uint8_t *data
+        cdef size_t data_len
+        cdef unsigned val_idx = 0
 
-            res = nmsg_message_get_field_type_by_idx(self._instance, field_idx, &field_type)
-            if res != nmsg_res_success:
-                raise Exception, 'nmsg_message_get_field_type_by_idx() failed'
-
-            if res != nmsg_res_success:
-                raise Exception, 'nmsg_message_get_num_field_values_by_idx() failed'
-
-            val_list = []
-            val_idx = 0
-
-            while True:
-                res = nmsg_message_get_field_by_idx(self._instance, field_idx, val_idx, <void **> &data, &data_len)
-                if res != nmsg_res_success:
-                    break
-                val_idx += 1
-                if field_type == nmsg_msgmod_ft_enum:
-                    val_enum = (<unsigned *> data)[0]
-                    res = nmsg_message_enum_value_to_name_by_idx(self._instance, field_idx, val_enum, &str_enum)
-                    if res == nmsg_res_success:
-                        val_list.append(str_enum.decode('utf-8'))
-
-                    else:
-                        val_list.append(val_enum)
-
-                elif field_type == nmsg_msgmod_ft_bytes:
-                    val_list.append(data[:data_len])
-
-                elif field_type == nmsg_msgmod_ft_string or field_type == nmsg_msgmod_ft_mlstring:
-                    if data_len > 0 and data[data_len - 1] == '\x00':
-                        data_len -= 1
-                    val_list.append(data[:data_len])
-
-                elif field_type == nmsg_msgmod_ft_ip:
-                    ip = data[:data_len]
-                    if data_len == 4:
-                        val_list.append(socket.inet_ntop(socket.AF_INET, ip))
-                    elif data_len == 16:
-                        val_list.append(socket.inet_ntop(socket.AF_INET6, ip))
-
-                elif field_type == nmsg_msgmod_ft_uint16 or field_type == nmsg_msgmod_ft_uint32:
-                    val_uint32 = (<uint32_t *> data)[0]
-                    val_list.append(val_uint32)
-
-                elif field_type == nmsg_msgmod_ft_uint64:
-                    val_uint64 = (<uint64_t *> data)[0]
-                    val_list.append(val_uint64)
-
-                elif field_type == nmsg_msgmod_ft_int16 or field_type == nmsg_msgmod_ft_int32:
-                    val_int32 = (<int32_t *> data)[0]
-                    val_list.append(val_int32)
-
-                elif field_type == nmsg_msgmod_ft_int64:
-                    val_int64 = (<int64_t *> data)[0]
-                    val_list.append(val_int64)
-
-                elif field_type == nmsg_msgmod_ft_double:
-                    val_double = (<double *> data)[0]
-                    val_list.append(val_double)
-
-                elif field_type == nmsg_msgmod_ft_bool:
-                    val_bool = (<int *> data)[0]
-                    val_list.append(val_bool)
-
-            res = nmsg_message_get_field_flags_by_idx(self._instance, field_idx, &field_flags)
-            if res != nmsg_res_success:
-                raise Exception, 'nmsg_message_get_field_flags_by_idx() failed'
-            if len(val_list) > 0:
-                if field_flags & NMSG_MSGMOD_FIELD_REPEATED:
-                    self.fields[field_name_dec] = val_list
-                else:
-                    self.fields[field_name_dec] = val_list[0]
-            self.field_types[field_name_dec] = field_type
+        while nmsg_message_get_field_by_idx(self._instance, field_idx, val_idx, <void **> &data, &data_len) == nmsg_res_success:
+            val_idx += 1
+        return val_idx
 
     cdef sync_message(self):
+        # Pushes only the fields that were assigned or mutated in place;
+        # everything else stays in the instance as received.
+        cdef int64_t start = _profile_start()
+
+        if self._instance == NULL:
+            self.reinit()
+
+        if self._full_sync:
+            names = list(self._fields)
+        else:
+            names = set(self._dirty)
+            for field_name, snapshot in self._snapshots.items():
+                if field_name not in names and tuple(self._fields[field_name]) != snapshot:
+                    names.add(field_name)
+
+            # libnmsg cannot remove values from a repeated field, so the
+            # fields that shrank are cleared by moving every other field's
+            # raw values into a fresh instance; they are then re-appended
+            # below with the rest of the changed fields.
+            shrunk = set()
+            for field_name in names:
+                val = self._fields[field_name]
+                if type(val) == list and len(val) < self.value_count(self._schema.idx[field_name]):
+                    shrunk.add(field_name)
+            if shrunk:
+                self.rebuild_without(shrunk)
+
+        for field_name in names:
+            val = self._fields[field_name]
+            self.set_field_values(self._schema.idx[field_name], val)
+            if type(val) == list:
+                self._snapshots[field_name] = tuple(val)
+
+        self._dirty.clear()
+        self._full_sync = False
+        self.changed = False
+        _profile_record(_PROF_ENCODE, _profile_key(self.vid, self.msgtype), start)
+
+    cdef rebuild_without(self, set skip):
+        cdef nmsg_message_t old = self._instance
+
+        self._instance = NULL
+        try:
+            self.reinit()
+            _copy_fields(old, self._instance, self._schema, skip)
+        except:
+            if self._instance != NULL:
+                nmsg_message_destroy(&self._instance)
+            self._instance = old
+            raise
+        nmsg_message_destroy(&old)
+        self.sync_fields()
+
+    cdef set_field_values(self, unsigned field_idx, val):
         cdef nmsg_res res
 
-        cdef nmsg_msgmod_field_type field_type
+        cdef nmsg_msgmod_field_type field_type = self._schema.c_types[field_idx]
 
         cdef unsigned val_enum
-        cdef char *str_enum
         cdef int val_bool
         cdef uint16_t val_uint16
         cdef uint32_t val_uint32
@@ -265,118 +416,144 @@ cdef class message(object):
         cdef int32_t val_int32
         cdef int64_t val_int64
         cdef double val_double
-        cdef char *val_buf
-        cdef Py_ssize_t val_buf_len
         cdef uint8_t *data
         cdef size_t data_len
 
-        if self._instance == NULL:
-            self.reinit()
-
-        for field_name in self.fields:
-            field_type = self.field_types[field_name]
-
-            if type(self.fields[field_name]) == list:
-                fields = self.fields[field_name]
-            else:
-                fields = [ self.fields[field_name] ]
-
-            for i in range(0, len(fields)):
-                if field_type == nmsg_msgmod_ft_enum:
-                    if type(fields[i]) == int:
-                        val_enum = fields[i]
-                        data = <uint8_t *> &val_enum
-                        data_len = sizeof(val_enum)
-                    elif type(fields[i]) == str or type(fields[i]) == unicode:
-                        tmp = field_name.encode('utf-8')
-                        if isinstance(fields[i], bytes):
-                            fields_enc = fields[i] # Don't encode in python2
-                        else:
-                            fields_enc = fields[i].encode('utf-8')
-                        res = nmsg_message_enum_name_to_value(self._instance, tmp,
-                                                              fields_enc, &val_enum)
-                        if res != nmsg_res_success:
-                            raise Exception, 'unknown enum value for field_name=%s: %s' % (field_name, fields[i])
-                        data = <uint8_t *> &val_enum
-                        data_len = sizeof(val_enum)
-                    else:
-                        raise Exception, 'unhandled python enum type: %s' % type(fields[i])
-                elif field_type == nmsg_msgmod_ft_bytes:
-                    data = fields[i]
-                    data_len = len(data)
-                elif field_type == nmsg_msgmod_ft_string or field_type == nmsg_msgmod_ft_mlstring:
-                    if isinstance(fields[i], bytes):
-                        fields_enc = fields[i] # Don't encode in python2
-                    else:
-                        fields_enc = fields[i].encode('utf-8')
-                    tmp_py_string = fields_enc + b'\x00'
-                    data = tmp_py_string
-                    data_len = len(data)
-                elif field_type == nmsg_msgmod_ft_ip:
-                    try:
-                        ip = socket.inet_pton(socket.AF_INET, fields[i])
-                    except:
-                        ip = socket.inet_pton(socket.AF_INET6, fields[i])
-                    data = ip
-                    data_len = len(ip)
-                elif field_type == nmsg_msgmod_ft_uint16:
-                    val_uint16 = fields[i]
-                    data = <uint8_t *> &val_uint16
-                    data_len = sizeof(val_uint16)
-
-                elif field_type == nmsg_msgmod_ft_int16:
-                    val_int16 = fields[i]
-                    data = <uint8_t *> &val_int16
-                    data_len = sizeof(val_int16)
-
-                elif field_type == nmsg_msgmod_ft_uint32:
-                    val_uint32 = fields[i]
-                    data = <uint8_t *> &val_uint32
-                    data_len = sizeof(val_uint32)
-
-                elif field_type == nmsg_msgmod_ft_int32:
-                    val_int32 = fields[i]
-                    data = <uint8_t *> &val_int32
-                    data_len = sizeof(val_int32)
-
-                elif field_type == nmsg_msgmod_ft_uint64:
-                    val_uint64 = fields[i]
-                    data = <uint8_t *> &val_uint64
-                    data_len = sizeof(val_uint64)
-
-                elif field_type == nmsg_msgmod_ft_int64:
-                    val_int64 = fields[i]
-                    data = <uint8_t *> &val_int64
-                    data_len = sizeof(val_int64)
-
-                elif field_type == nmsg_msgmod_ft_double:
-                    val_double = fields[i]
-                    data = <uint8_t *> &val_double
-                    data_len = sizeof(val_double)
-
-                elif field_type == nmsg_msgmod_ft_bool:
-                    val_bool = fields[i]
-                    data = <uint8_t *> &val_bool
-                    data_len = sizeof(int)
+        if type(val) == list:
+            fields = val
+        else:
+            fields = [ val ]
+
+        for i in range(0, len(fields)):
+            if field_type == nmsg_msgmod_ft_enum:
+                if type(fields[i]) == int:
+                    val_enum = fields[i]
+                    data = <uint8_t *> &val_enum
+                    data_len = sizeof(val_enum)
+                elif type(fields[i]) == str or type(fields[i]) == unicode:
+                    val_enum = self._schema.enum_value(self._instance, field_idx, fields[i])
+                    data = <uint8_t *> &val_enum
+                    data_len = sizeof(val_enum)
                 else:
-                    raise Exception, 'unknown field_type'
-
-                tmp = field_name.encode('utf-8')
-                res = nmsg_message_set_field(self._instance, tmp, i, data, data_len)
-                if res != nmsg_res_success:
-                    raise Exception, 'nmsg_message_set_field() failed'
+                    raise Exception, 'unhandled python enum type: %s' % type(fields[i])
+            elif field_type == nmsg_msgmod_ft_bytes:
+                data = fields[i]
+                data_len = len(data)
+            elif field_type == nmsg_msgmod_ft_string or field_type == nmsg_msgmod_ft_mlstring:
+                if isinstance(fields[i], bytes):
+                    fields_enc = fields[i] # Don't encode in python2
+                else:
+                    fields_enc = fields[i].encode('utf-8')
+                tmp_py_string = fields_enc + b'\x00'
+                data = tmp_py_string
+                data_len = len(data)
+            elif field_type == nmsg_msgmod_ft_ip:
+                try:
+                    ip = socket.inet_pton(socket.AF_INET, fields[i])
+                except:
+                    ip = socket.inet_pton(socket.AF_INET6, fields[i])
+                data = ip
+                data_len = len(ip)
+            elif field_type == nmsg_msgmod_ft_uint16:
+                val_uint16 = fields[i]
+                data = <uint8_t *> &val_uint16
+                data_len = sizeof(val_uint16)
+
+            elif field_type == nmsg_msgmod_ft_int16:
+                val_int16 = fields[i]
+                data = <uint8_t *> &val_int16
+                data_len = sizeof(val_int16)
+
+            elif field_type == nmsg_msgmod_ft_uint32:
+                val_uint32 = fields[i]
+                data = <uint8_t *> &val_uint32
+                data_len = sizeof(val_uint32)
+
+            elif field_type == nmsg_msgmod_ft_int32:
+                val_int32 = fields[i]
+                data = <uint8_t *> &val_int32
+                data_len = sizeof(val_int32)
+
+            elif field_type == nmsg_msgmod_ft_uint64:
+                val_uint64 = fields[i]
+                data = <uint8_t *> &val_uint64
+                data_len = sizeof(val_uint64)
+
+            elif field_type == nmsg_msgmod_ft_int64:
+                val_int64 = fields[i]
+                data = <uint8_t *> &val_int64
+                data_len = sizeof(val_int64)
+
+            elif field_type == nmsg_msgmod_ft_double:
+                val_double = fields[i]
+                data = <uint8_t *> &val_double
+                data_len = sizeof(val_double)
+
+            elif field_type == nmsg_msgmod_ft_bool:
+                val_bool = fields[i]
+                data = <uint8_t *> &val_bool
+                data_len = sizeof(int)
+            else:
+                raise Exception, 'unknown field_type'
 
-        self.changed = False
+            res = nmsg_message_set_field_by_idx(self._instance, field_idx, i, data, data_len)
+            if res != nmsg_res_success:
+                raise Exception, 'nmsg_message_set_field_by_idx() failed'
+
+    @property
+    def fields(self):
+        if not self._loaded and self._instance != NULL:
+            self.load_message()
+        for key, val in self._fields.items():
+            if type(val) == list and key not in self._snapshots:
+                self._snapshots[key] = tuple(val)
+        return self._fields
+
+    @property
+    def field_names(self):
+        return self._schema.name_set
+
+    @property
+    def field_types(self):
+        if self._field_types is None:
+            self._field_types = dict(self._schema.types)
+        return self._field_types
 
     def __contains__(self, key):
-        return key in self.fields
+        if key in self._fields:
+            return True
+        if self._loaded or self._instance == NULL:
+            return False
+        field_idx = self._schema.idx.get(key)
+        if field_idx is None:
+            return False
+        return self.has_field(field_idx)
 
     def __getitem__(self, key):
-        return self.fields[key]
+        cdef int64_t start
+
+        try:
+            val = self._fields[key]
+        except KeyError:
+            if self._loaded or self._instance == NULL:
+                raise
+            start = _profile_start()
+            val = self.load_field(self._schema.idx[key])
+            _profile_record(_PROF_DECODE, _profile_key(self.vid, self.msgtype), start)
+            if val is None:
+                raise KeyError(key)
+            self._fields[key] = val
+        if type(val) == list and key not in self._snapshots:
+            self._snapshots[key] = tuple(val)
+        return val
 
     def __setitem__(self, key, value):
-        if key in self.field_names:
-            self.fields[key] = value
+        if self.frozen:
+            raise Exception, 'message is frozen'
+        if key in self._schema.idx:
+            self._fields[key] = value
+            self._dirty.add(key)
+            self._snapshots.pop(key, None)
             self.changed = True
         else:
             raise KeyError(key)
@@ -385,7 +562,10 @@ cdef class message(object):
         return repr(self.fields)
 
     def keys(self):
-        return self.fields.keys()
+        if self._loaded or self._instance == NULL:
+            return self._fields.keys()
+        # Same type as the loaded case, without decoding any field.
+        return dict.fromkeys([ k for idx, k in enumerate(self._schema.names) if k in self._fields or self.has_field(idx) ]).keys()
 
     from_json = staticmethod(message_from_json)
 
@@ -393,7 +573,9 @@ cdef class message(object):
         cdef nmsg_res res
         cdef char *s
 
-        self.sync_message()
+        # A received message that was not modified is rendered from its
+        # instance as is.
+        self.prepare_write()
         res = nmsg_message_to_json(self._instance, &s)
         if res != nmsg_res_success:
             raise Exception, 'nmsg_message_to_json() failed: %s' % _cstr2str(nmsg_res_lookup(res))
@@ -421,6 +603,133 @@ cdef class _json_message(message):
         if res != nmsg_res_success:
             raise Exception, 'nmsg_message_from_json() failed: %s' % _cstr2str(nmsg_res_lookup(res))
 
-        self._mod = msgmod(nmsg_message_get_vid(self._instance),
+        self._mod = _get_msgmod(nmsg_message_get_vid(self._instance),
                 nmsg_message_get_msgtype(self._instance))
+        self._schema = _get_schema(self._instance)
         self.load_message()
+
+# The envelope of a received message: type, time and the raw source,
+# operator and group values, read without decoding the payload. Aliases
+# are only resolved when operator or group is accessed. The native
+# instance is kept, so the header can be passed to output.write()
+# unchanged or turned into a full message with upgrade().
+cdef class message_header(object):
+    cdef nmsg_message_t _instance
+    cdef message _message
+    cdef readonly unsigned vid
+    cdef readonly unsigned msgtype
+    cdef readonly long time_sec
+    cdef readonly int time_nsec
+    cdef readonly uint32_t source
+    cdef readonly uint32_t operator_id
+    cdef readonly uint32_t group_id
+
+    def __cinit__(self):
+        self._instance = NULL
+        self._message = None
+
+    def __init__(self):
+        raise TypeError('message_header objects are created by inputs in header-only mode')
+
+    def __dealloc__(self):
+        if self._instance != NULL:
+            nmsg_message_destroy(&self._instance)
+
+    def __repr__(self):
+        return 'nmsg message_header object vid=%d msgtype=%d time=%d.%09d' % (
+                self.vid, self.msgtype, self.time_sec, self.time_nsec)
+
+    cdef set_instance(self, nmsg_message_t instance):
+        cdef timespec ts
+
+        self._instance = instance
+        self.vid = nmsg_message_get_vid(instance)
+        self.msgtype = nmsg_message_get_msgtype(instance)
+        nmsg_message_get_time(instance, &ts)
+        self.time_sec = ts.tv_sec
+        self.time_nsec = ts.tv_nsec
+        self.source = nmsg_message_get_source(instance)
+        self.operator_id = nmsg_message_get_operator(instance)
+        self.group_id = nmsg_message_get_group(instance)
+
+    # The instance to hand to nmsg_output_write(). Once upgraded, the full
+    # message owns it and any changes made there are written.
+    cdef nmsg_message_t instance(self) except NULL:
+        if self._message is not None:
+            self._message.prepare_write()
+            return self._message._instance
+        if self._instance == NULL:
+            raise Exception, 'message_header not initialized'
+        return self._instance
+
+    cdef nmsg_message_t detach(self) except NULL:
+        cdef nmsg_message_t instance
+
+        if self._message is not None:
+            return self._message.detach()
+        instance = self.instance()
+        self._instance = NULL
+        return instance
+
+    property has_source:
+        def __get__(self):
+            return self.source != 0
+
+    property has_operator:
+        def __get__(self):
+            return self.operator_id != 0
+
+    property has_group:
+        def __get__(self):
+            return self.group_id != 0
+
+    property operator:
+        def __get__(self):
+            return _alias_name(nmsg_alias_operator, self.operator_id)
+
+    property group:
+        def __get__(self):
+            return _alias_name(nmsg_alias_group, self.group_id)
+
+    # Returns the full message for this header, moving the native instance
+    # into it; later calls return the same object.
+    def upgrade(self, lazy=False):
+        cdef _recv_message msg
+
+        if self._message is None:
+            if self._instance == NULL:
+                raise Exception, 'message_header not initialized'
+            msg = _recv_message()
+            msg.set_instance(self._instance, lazy)
+            self._instance = NULL
+            self._message = msg
+        return self._message
+
+cdef _alias_name(unsigned ae, uint32_t key):
+    cdef const char *a
+
+    if key == 0:
+        return None
+    a = nmsg_alias_by_key(ae, key)
+    if a == NULL:
+        return b'<UNKNOWN>'
+    return <bytes> a
+
+# Wraps a received instance, taking ownership of it even if this raises.
+cdef object _wrap_message(nmsg_message_t instance, bint lazy, bint header_only):
+    cdef _recv_message msg
+    cdef message_header hdr
+
+    try:
+        if header_only:
+            hdr = message_header.__new__(message_header)
+        else:
+            msg = _recv_message()
+    except:
+        nmsg_message_destroy(&instance)
+        raise
+    if header_only:
+        hdr.set_instance(instance)
+        return hdr
+    msg.set_instance(instance, lazy)
+    return msg
@@ -117,3 +117,21 @@ cdef class msgmod(object):
             msgmod_vid_to_vname(self._vid),
             msgmod_msgtype_to_mname(self._vid, self._msgtype)
         )
+
+# (vid << 32 | msgtype) -> msgmod. Message modules are initialized once and
+# kept for the life of the process; nmsg_message_init() does not use the
+# module closure, so one instance can back every message of its type.
+cdef dict _msgmods = {}
+
+# Callers hold the GIL, but creating a msgmod can run other Python code
+# (garbage collection), so two threads may both miss the same key. Both
+# modules are valid; setdefault() keeps whichever was stored first and the
+# other is finalized when the losing caller drops it.
+cdef msgmod _get_msgmod(unsigned vid, unsigned msgtype):
+    cdef uint64_t key = (<uint64_t> vid) << 32 | msgtype
+
+    try:
+        return _msgmods[key]
+    except KeyError:
+        pass
+    return _msgmods.setdefault(key, msgmod(vid, msgtype))
@@ -15,34 +15,79 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+# nmsg.msgtype.<vendor>.<msgtype> message classes. Vendors and classes
+# are looked up in libnmsg on first access and cached as attributes, so
+# importing the module does not initialize every installed message module.
+
+cdef unsigned _msgtype_name_lookup(name, bint vendor, unsigned vid=0):
+    cdef char *s
+
+    if name.startswith('_') or name != name.lower():
+        return 0
+    try:
+        t = name.encode('ascii')
+    except UnicodeError:
+        return 0
+    s = t
+    if vendor:
+        return nmsg_msgmod_vname_to_vid(s)
+    return nmsg_msgmod_mname_to_msgtype(vid, s)
+
+class _msgtype_vendor(object):
+    def __init__(self, vid, vname):
+        self._vid = vid
+        self._vname = vname
+
+    def __repr__(self):
+        return '<nmsg msgtype vendor %s>' % self._vname
+
+    def __getattr__(self, name):
+        cdef unsigned mtype = _msgtype_name_lookup(name, False, self._vid)
+
+        if mtype == 0:
+            raise AttributeError(name)
+        _get_msgmod(self._vid, mtype)
+        cls = type(str('%s_%s' % (self._vname, name)), (_meta_message,), {
+            '_vid': self._vid,
+            '_msgtype': mtype,
+        })
+        setattr(self, name, cls)
+        return cls
+
+    def __dir__(self):
+        cdef const char *mname_str
+
+        names = []
+        for mtype in range(1, nmsg_msgmod_get_max_msgtype(self._vid) + 1):
+            mname_str = nmsg_msgmod_msgtype_to_mname(self._vid, mtype)
+            if mname_str:
+                names.append(mname_str.decode('utf-8').lower())
+        return sorted(set(names) | set(self.__dict__))
+
 class _msgtype(object):
-    def __init__(self):
+    def __getattr__(self, name):
+        cdef unsigned vid = _msgtype_name_lookup(name, True)
+
+        if vid == 0:
+            # map 'isc' to 'base' vendor to avoid breaking code
+            # upon upgrade from libnmsg 0.7 to libnmsg 0.8
+            if name == 'isc':
+                v = self.base
+                setattr(self, name, v)
+                return v
+            raise AttributeError(name)
+        v = _msgtype_vendor(vid, name)
+        setattr(self, name, v)
+        return v
+
+    def __dir__(self):
         cdef const char *vname_str
-        cdef const char *mname_str
 
+        names = []
         for vid in range(1, nmsg_msgmod_get_max_vid() + 1):
             vname_str = nmsg_msgmod_vid_to_vname(vid)
-
             if vname_str:
-                vname = vname_str.decode('utf-8').lower()
-                v_dict = {}
-
-                for msgtype in range(1, nmsg_msgmod_get_max_msgtype(vid) + 1):
-                    mname_str = nmsg_msgmod_msgtype_to_mname(vid, msgtype)
-                    if mname_str:
-                        mname = mname_str.decode('utf-8').lower()
-                        mod = msgmod(vid, msgtype)
-                        m_dict = {
-                            '_vid': vid,
-                            '_msgtype': msgtype,
-                        }
-                        v_dict[mname] = type(str('%s_%s' % (vname, mname)), (_meta_message,), m_dict)
-                v_dict['_vname'] = vname
-                v_dict['_vid'] = vid
-
-                setattr(self, vname, type(str(vname), (object,), v_dict))
-
-                # map 'isc' to 'base' vendor to avoid breaking code
-                # upon upgrade from libnmsg 0.7 to libnmsg 0.8
-                if vname == 'base' and not getattr(self, 'isc', None):
-                    setattr(self, 'isc', type(str(vname), (object,), v_dict))
+                names.append(vname_str.decode('utf-8').lower())
+        if 'base' in names:
+            names.append('isc')
+        return sorted(set(names) | set(self.__dict__))
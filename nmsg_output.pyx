@@ -14,12 +14,58 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-def output_open_file(obj, size_t bufsz=NMSG_WBUFSZ_MAX):
+from cpython.pythread cimport (PyThread_type_lock, PyThread_allocate_lock, PyThread_free_lock,
+                               PyThread_acquire_lock, PyThread_release_lock, WAIT_LOCK)
+
+cdef extern from "output_thread.c" nogil:
+    enum:
+        PYNMSG_WRITER_BLOCK
+        PYNMSG_WRITER_DROP_NEWEST
+        PYNMSG_WRITER_DROP_OLDEST
+
+    struct pynmsg_writer_stats:
+        uint64_t queued
+        uint64_t written
+        uint64_t errors
+        uint64_t dropped_newest
+        uint64_t dropped_oldest
+        uint64_t timed_flushes
+        size_t depth
+        size_t max_depth
+        size_t capacity
+
+    struct pynmsg_writer:
+        pass
+
+    pynmsg_writer *pynmsg_writer_new(nmsg_output_t output, size_t capacity, int policy, int64_t max_delay_ns)
+    int pynmsg_writer_put(pynmsg_writer *w, nmsg_message_t msg)
+    nmsg_res pynmsg_writer_write(pynmsg_writer *w, nmsg_message_t msg)
+    void pynmsg_writer_callback(nmsg_message_t msg, void *user)
+    nmsg_res pynmsg_writer_flush(pynmsg_writer *w)
+    void pynmsg_writer_get_stats(pynmsg_writer *w, pynmsg_writer_stats *st)
+    void pynmsg_writer_free(pynmsg_writer *w)
+
+    struct pynmsg_timer:
+        pass
+
+    pynmsg_timer *pynmsg_timer_new(void (*fire)(void *) noexcept nogil, void *arg)
+    void pynmsg_timer_arm(pynmsg_timer *t, int64_t delay_ns)
+    void pynmsg_timer_free(pynmsg_timer *t)
+
+_writer_policies = {
+    'block': PYNMSG_WRITER_BLOCK,
+    'drop_newest': PYNMSG_WRITER_DROP_NEWEST,
+    'drop_oldest': PYNMSG_WRITER_DROP_OLDEST,
+}
+
+def output_open_file(obj, size_t bufsz=NMSG_WBUFSZ_MAX, max_delay=None):
     if type(obj) == str:
         obj = open(obj, 'w')
     o = output()
     o._open_file(obj, bufsz)
     o.fileobj = obj
+    if max_delay:
+        o.set_max_delay(max_delay)
     return o
 
 def output_open_json(obj):
@@ -30,7 +76,7 @@ def output_open_json(obj):
     o.fileobj = obj
     return o
 
-def output_open_sock(addr, port, size_t bufsz=NMSG_WBUFSZ_ETHER, broadcast=False):
+def output_open_sock(addr, port, size_t bufsz=NMSG_WBUFSZ_ETHER, broadcast=False, max_delay=None):
     obj = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     obj.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     if broadcast:
@@ -39,26 +85,189 @@ def output_open_sock(addr, port, size_t bufsz=NMSG_WBUFSZ_ETHER, broadcast=False
     o = output()
     o._open_sock(obj, bufsz)
     o.fileobj = obj
+    if max_delay:
+        o.set_max_delay(max_delay)
     return o
 
-def output_open_callback(func):
+def output_open_callback(func, lazy=False, batch_size=None, max_delay=None, header_only=False):
     o = output()
-    o._open_callback(func)
-    o.func = func
+    o.lazy = lazy
+    o.header_only = header_only
+    if batch_size is None and max_delay is None:
+        o._open_callback(func)
+    else:
+        o._open_callback_batch(func, batch_size or 1024, max_delay or 0)
     return o
 
-cdef void callback(nmsg_message_t _msg, void *user) with gil:
-    cdef _recv_message msg
-    msg = _recv_message()
-    msg.set_instance(_msg)
-    (<object>user)(msg)
+# Callbacks run inside libnmsg, from io threads or from nmsg_output_write()
+# in output.write(), and cannot raise. The first exception is kept on the
+# output and raised by io.loop() or write(); an io loop is stopped.
+cdef void _keep_error(output o) noexcept:
+    if o._error is None:
+        o._error = sys.exc_info()
+    if o._io != NULL:
+        nmsg_io_breakloop(o._io)
+
+cdef void callback(nmsg_message_t _msg, void *user) noexcept with gil:
+    cdef output o = <output>user
+
+    try:
+        if o._rate != NULL:
+            o._rate_sleep()
+        o._call(_wrap_message(_msg, o.lazy, o.header_only), 1)
+    except BaseException:
+        _keep_error(o)
+
+# Messages collected by a batched callback output, shared between the
+# libnmsg io threads and the output object.
+cdef struct _batch_state:
+    nmsg_message_t *msgs
+    size_t count
+    size_t size
+    int64_t max_delay_ns
+    int64_t first_ns
+    # Messages discarded because no batch array could be allocated.
+    uint64_t dropped
+    # Paces messages as they are added, like callback() does.
+    nmsg_rate_t rate
+    # Delivers a partial batch once it is max_delay old; the output is
+    # being freed once closing is set.
+    pynmsg_timer *timer
+    bint closing
+    PyThread_type_lock lock
+    void *user
+
+cdef int _deliver_batch(_batch_state *b, nmsg_message_t *msgs, size_t n) except -1:
+    cdef output o = <output>b.user
+    cdef size_t i = 0
+
+    msg_list = []
+    try:
+        while i < n:
+            msg = _wrap_message(msgs[i], o.lazy, o.header_only)
+            i += 1
+            msg_list.append(msg)
+    finally:
+        while i < n:
+            nmsg_message_destroy(&msgs[i])
+            i += 1
+        free(msgs)
+    if msg_list:
+        o._call(msg_list, n)
+    return 0
+
+cdef void _deliver_batch_cb(_batch_state *b, nmsg_message_t *msgs, size_t n) noexcept with gil:
+    try:
+        _deliver_batch(b, msgs, n)
+    except BaseException:
+        _keep_error(<output>b.user)
+
+cdef nmsg_message_t *_take_batch(_batch_state *b, size_t *n) noexcept nogil:
+    # Called with b.lock held. Swaps in an empty array and returns the full
+    # one, or NULL if no replacement could be allocated.
+    cdef nmsg_message_t *msgs = b.msgs
+    cdef nmsg_message_t *fresh
+
+    fresh = <nmsg_message_t *> malloc(b.size * sizeof(nmsg_message_t))
+    if fresh == NULL:
+        n[0] = 0
+        return NULL
+    n[0] = b.count
+    b.msgs = fresh
+    b.count = 0
+    return msgs
+
+cdef void batch_callback(nmsg_message_t _msg, void *user) noexcept nogil:
+    cdef _batch_state *b = <_batch_state *> user
+    cdef nmsg_message_t *msgs = NULL
+    cdef size_t n = 0
+    cdef int64_t now
+
+    PyThread_acquire_lock(b.lock, WAIT_LOCK)
+    if b.rate != NULL:
+        nmsg_rate_sleep(b.rate)
+    now = _monotonic_ns()
+    if b.count == b.size:
+        # A previous swap failed for lack of memory. Try again; if that
+        # fails too, the message has nowhere to go.
+        msgs = _take_batch(b, &n)
+        if msgs == NULL:
+            b.dropped += 1
+            PyThread_release_lock(b.lock)
+            nmsg_message_destroy(&_msg)
+            return
+    if b.count == 0:
+        b.first_ns = now
+        if b.timer != NULL:
+            pynmsg_timer_arm(b.timer, b.max_delay_ns)
+    b.msgs[b.count] = _msg
+    b.count += 1
+    if msgs == NULL and (b.count == b.size or (b.max_delay_ns > 0 and now - b.first_ns >= b.max_delay_ns)):
+        msgs = _take_batch(b, &n)
+    PyThread_release_lock(b.lock)
+
+    if msgs != NULL:
+        _deliver_batch_cb(b, msgs, n)
+
+cdef void _batch_timer_fire(void *user) noexcept nogil:
+    cdef _batch_state *b = <_batch_state *> user
+    cdef nmsg_message_t *msgs = NULL
+    cdef size_t n = 0
+    cdef int64_t age
+
+    PyThread_acquire_lock(b.lock, WAIT_LOCK)
+    if not b.closing and b.count > 0:
+        age = _monotonic_ns() - b.first_ns
+        if age >= b.max_delay_ns:
+            msgs = _take_batch(b, &n)
+        else:
+            # A full batch went out since the timer was armed; wait for
+            # the one that started after it.
+            pynmsg_timer_arm(b.timer, b.max_delay_ns - age)
+    PyThread_release_lock(b.lock)
+
+    if msgs != NULL:
+        _deliver_batch_cb(b, msgs, n)
+
+cdef nmsg_message_t _write_instance(msg) except NULL:
+    if isinstance(msg, message_header):
+        return (<message_header> msg).instance()
+    (<message?> msg).prepare_write()
+    return (<message> msg)._instance
+
+# Takes the native instance out of msg for a writer that destroys it, or
+# with copy, gives the writer a copy and leaves msg as it is.
+cdef nmsg_message_t _detach_instance(msg, bint copy=False) except NULL:
+    if copy:
+        return _copy_instance(_write_instance(msg))
+    if isinstance(msg, message_header):
+        return (<message_header> msg).detach()
+    return (<message?> msg).detach()
 
 cdef class output(object):
     cdef nmsg_output_t _instance
     cdef public object fileobj
     cdef public object func
-    cdef str output_type
+    cdef public bool lazy
+    cdef public bool header_only
+    cdef readonly str output_type
     cdef object lock
+    cdef _batch_state *batch
+    # Applied to messages delivered by libnmsg to unbatched callback
+    # outputs; batched ones keep theirs in batch.
+    cdef nmsg_rate_t _rate
+    cdef _stats _stats
+    cdef pynmsg_writer *_writer
+    cdef size_t _writer_queue
+    cdef int _writer_policy
+    cdef int64_t _writer_max_delay_ns
+    # The io loop this output was added to, and the first exception raised
+    # by its callback there or in write().
+    cdef nmsg_io_t _io
+    cdef object _error
+    # Mirrors the libnmsg msgtype filter; 0, 0 is no filter.
+    cdef unsigned _filter_vid
+    cdef unsigned _filter_msgtype
 
     open_file = staticmethod(output_open_file)
     open_json = staticmethod(output_open_json)
@@ -68,10 +277,34 @@ cdef class output(object):
     def __cinit__(self):
         self._instance = NULL
         self.lock = threading.Lock()
+        self.batch = NULL
+        self._rate = NULL
+        self._writer = NULL
+        self._writer_queue = 0
+        self._writer_policy = PYNMSG_WRITER_BLOCK
+        self._writer_max_delay_ns = 0
+        self._io = NULL
+        self._filter_vid = 0
+        self._filter_msgtype = 0
 
     def __dealloc__(self):
+        self._stop_writer()
         if self._instance != NULL:
             nmsg_output_close(&self._instance)
+        # Only callback outputs keep a rate; libnmsg owns the others.
+        if self._rate != NULL:
+            nmsg_rate_destroy(&self._rate)
+        if self.batch != NULL:
+            self._stop_batch_timer()
+            if self.batch.rate != NULL:
+                nmsg_rate_destroy(&self.batch.rate)
+            for i in range(self.batch.count):
+                nmsg_message_destroy(&self.batch.msgs[i])
+            free(self.batch.msgs)
+            if self.batch.lock != NULL:
+                PyThread_free_lock(self.batch.lock)
+            free(self.batch)
+            self.batch = NULL
 
     def __repr__(self):
         return 'nmsg output object type=%s _instance=0x%x' % (self.output_type, <uint64_t> self._instance)
@@ -95,11 +328,160 @@ cdef class output(object):
         self.output_type = 'socket'
 
     cpdef _open_callback(self, object func):
-        self._instance = nmsg_output_open_callback(<nmsg_cb_message>callback, <void*>func)
+        self.func = func
+        self._instance = nmsg_output_open_callback(<nmsg_cb_message>callback, <void*>self)
+        if self._instance == NULL:
+            raise Exception, 'nmsg_output_open_callback() failed'
+        self.output_type = 'callback'
+
+    cpdef _open_callback_batch(self, object func, size_t batch_size, double max_delay):
+        if batch_size == 0:
+            raise ValueError('batch_size must be at least 1')
+        self.func = func
+        self.batch = <_batch_state *> malloc(sizeof(_batch_state))
+        if self.batch == NULL:
+            raise MemoryError()
+        self.batch.count = 0
+        self.batch.dropped = 0
+        self.batch.rate = NULL
+        self.batch.timer = NULL
+        self.batch.closing = False
+        self.batch.size = batch_size
+        self.batch.msgs = <nmsg_message_t *> malloc(batch_size * sizeof(nmsg_message_t))
+        self.batch.lock = PyThread_allocate_lock()
+        if self.batch.msgs == NULL or self.batch.lock == NULL:
+            raise MemoryError()
+        self.batch.max_delay_ns = <int64_t> (max_delay * 1e9)
+        self.batch.first_ns = 0
+        self.batch.user = <void *> self
+        if self.batch.max_delay_ns > 0:
+            self.batch.timer = pynmsg_timer_new(_batch_timer_fire, <void *> self.batch)
+            if self.batch.timer == NULL:
+                raise Exception, 'unable to start the batch timer thread'
+
+        self._instance = nmsg_output_open_callback(<nmsg_cb_message>batch_callback, <void *> self.batch)
         if self._instance == NULL:
             raise Exception, 'nmsg_output_open_callback() failed'
         self.output_type = 'callback'
 
+    cdef _call(self, arg, size_t n):
+        cdef int64_t start
+
+        if self._stats is None and not _profiling:
+            self.func(arg)
+            return
+        start = _monotonic_ns()
+        try:
+            self.func(arg)
+        finally:
+            if self._stats is not None:
+                self._stats.record_callback(_monotonic_ns() - start)
+                self._stats.messages += n
+            _profile_record(_PROF_CALLBACK, _PROF_NOKEY, start)
+
+    cdef size_t _queue_depth(self):
+        cdef pynmsg_writer_stats st
+
+        if self._writer != NULL:
+            pynmsg_writer_get_stats(self._writer, &st)
+            return st.depth
+        if self.batch == NULL:
+            return 0
+        return self.batch.count
+
+    def set_stats(self, bool flag):
+        self._stats = _stats_enable(self._stats, flag)
+
+    cdef uint64_t _dropped(self):
+        if self.batch == NULL:
+            return 0
+        return self.batch.dropped
+
+    def stats(self):
+        d = _stats_snapshot(self._stats, None)
+        d['queue_depth'] = self._queue_depth()
+        d['dropped'] = self._dropped()
+        return d
+
+    cdef _raise_error(self):
+        err = self._error
+        if err is not None:
+            self._error = None
+            raise err[0], err[1], err[2]
+
+    cdef _stop_batch_timer(self):
+        # A delivery already under way may still need the GIL to finish.
+        cdef _batch_state *b = self.batch
+        cdef pynmsg_timer *t = b.timer
+
+        if t == NULL:
+            return
+        with nogil:
+            PyThread_acquire_lock(b.lock, WAIT_LOCK)
+            b.closing = True
+            b.timer = NULL
+            PyThread_release_lock(b.lock)
+            pynmsg_timer_free(t)
+
+    cdef _flush_batch(self, bint stale_only):
+        # Hands any pending batched messages to the callback. With
+        # stale_only, only a batch older than max_delay is delivered.
+        cdef nmsg_message_t *msgs = NULL
+        cdef size_t n = 0
+        cdef _batch_state *b = self.batch
+
+        if b == NULL:
+            return
+        with nogil:
+            PyThread_acquire_lock(b.lock, WAIT_LOCK)
+            if b.count > 0 and (not stale_only or _monotonic_ns() - b.first_ns >= b.max_delay_ns):
+                msgs = _take_batch(b, &n)
+            PyThread_release_lock(b.lock)
+        if msgs != NULL:
+            _deliver_batch(b, msgs, n)
+
+    cdef _rate_sleep(self):
+        cdef nmsg_rate_t rate = self._rate
+
+        with self.lock:
+            with nogil:
+                nmsg_rate_sleep(rate)
+
+    # Limits the output to rate messages per second, checked freq times a
+    # second. libnmsg paces file and socket outputs itself and owns the
+    # rate given to it: it destroys the previous one when the rate is
+    # replaced and the current one when the output is closed. Callback
+    # outputs are paced here, before each call or, when batched, as each
+    # message joins a batch. 0 or None removes the limit.
+    def set_rate(self, rate, unsigned freq=100):
+        cdef nmsg_rate_t new = NULL
+        cdef nmsg_rate_t old
+        cdef _batch_state *b = self.batch
+
+        if self._instance == NULL:
+            raise Exception, 'object not initialized'
+        if rate:
+            if freq == 0:
+                raise ValueError('freq must be at least 1')
+            new = nmsg_rate_init(rate, freq)
+            if new == NULL:
+                raise Exception, 'nmsg_rate_init() failed'
+        if self.output_type != 'callback':
+            nmsg_output_set_rate(self._instance, new)
+            return
+        if b != NULL:
+            with nogil:
+                PyThread_acquire_lock(b.lock, WAIT_LOCK)
+                old = b.rate
+                b.rate = new
+                PyThread_release_lock(b.lock)
+        else:
+            with self.lock:
+                old = self._rate
+                self._rate = new
+        if old != NULL:
+            nmsg_rate_destroy(&old)
+
     def set_filter_msgtype(self, vid, msgtype):
         if self._instance == NULL:
             raise Exception, 'object not initialized'
@@ -108,8 +490,83 @@ cdef class output(object):
         if type(msgtype) == str:
             msgtype = msgmod_mname_to_msgtype(vid, msgtype)
         nmsg_output_set_filter_msgtype(self._instance, vid, msgtype)
+        self._filter_vid = vid
+        self._filter_msgtype = msgtype
+
+    cdef _stop_writer(self):
+        cdef pynmsg_writer *w = self._writer
+
+        if w == NULL:
+            return
+        self._writer = NULL
+        with nogil:
+            pynmsg_writer_free(w)
+
+    # Makes write() queue messages for a native writer thread, which does
+    # the serialization, compression and I/O with the GIL released. When
+    # the queue of queue_size messages is full, policy 'block' waits for
+    # room, 'drop_newest' discards the message being written and
+    # 'drop_oldest' discards the longest queued one. A queue_size of 0
+    # drains the queue and returns to synchronous writes.
+    def set_async(self, size_t queue_size=1024, policy='block'):
+        if self.output_type == 'callback':
+            raise Exception, 'callback outputs cannot be asynchronous'
+        if policy not in _writer_policies:
+            raise ValueError('policy must be one of: %s' % ', '.join(sorted(_writer_policies)))
+        self._start_writer(queue_size, _writer_policies[policy], self._writer_max_delay_ns)
+
+    # Flushes a partly filled container once its oldest message has waited
+    # max_delay seconds, so low-rate outputs can stay buffered with bounded
+    # latency. The deadline is kept by the writer thread; synchronous
+    # writes take its lock instead of being queued. None or 0 disables it.
+    def set_max_delay(self, max_delay):
+        cdef int64_t ns = 0
+
+        if self.output_type == 'callback':
+            raise Exception, 'callback outputs take max_delay in open_callback()'
+        if max_delay:
+            if not isinstance(max_delay, numbers.Real) or max_delay < 0:
+                raise ValueError('max_delay must be a non-negative number of seconds')
+            ns = int(max_delay * 1e9)
+        self._start_writer(self._writer_queue, self._writer_policy, ns)
+
+    cdef _start_writer(self, size_t queue_size, int policy, int64_t max_delay_ns):
+        if self._instance == NULL:
+            raise Exception, 'object not initialized'
+        if self._io != NULL:
+            raise Exception, 'the writer thread of an output in an io loop cannot be changed'
+
+        with self.lock:
+            self._stop_writer()
+            self._writer_queue = queue_size
+            self._writer_policy = policy
+            self._writer_max_delay_ns = max_delay_ns
+            if queue_size == 0 and max_delay_ns == 0:
+                return
+            self._writer = pynmsg_writer_new(self._instance, queue_size, policy, max_delay_ns)
+        if self._writer == NULL:
+            raise Exception, 'unable to start the output writer thread'
+
+    def async_stats(self):
+        cdef pynmsg_writer_stats st
+
+        if self._writer == NULL:
+            raise Exception, 'output has no writer thread; call set_async() or set_max_delay()'
+        pynmsg_writer_get_stats(self._writer, &st)
+        return {
+            'queued': st.queued,
+            'written': st.written,
+            'errors': st.errors,
+            'dropped_newest': st.dropped_newest,
+            'dropped_oldest': st.dropped_oldest,
+            'timed_flushes': st.timed_flushes,
+            'depth': st.depth,
+            'max_depth': st.max_depth,
+            'capacity': st.capacity,
+        }
 
     def close(self):
+        self._stop_writer()
         nmsg_output_close(&self._instance)
         self._instance = NULL
 
@@ -124,35 +581,289 @@ cdef class output(object):
     def flush(self):
         cdef nmsg_res res
 
-        res = nmsg_output_flush(self._instance)
+        cdef pynmsg_writer *w = self._writer
+
+        self._flush_batch(False)
+        if self._instance == NULL:
+            return
+        if w != NULL:
+            # Also reports a failed write from the writer thread.
+            with nogil:
+                res = pynmsg_writer_flush(w)
+        else:
+            res = nmsg_output_flush(self._instance)
+        if self._stats is not None:
+            self._stats.flushes += 1
         if res != nmsg_res_success:
-            raise Exception, 'nmsg_output_flush() failed'
+            if self._stats is not None:
+                self._stats.errors += 1
+            raise Exception, 'nmsg_output_flush() failed: %s' % _cstr2str(nmsg_res_lookup(res))
 
-    def write(self, message msg):
+    cdef _write(self, msg, nmsg_message_t _msg_instance):
         cdef nmsg_res res
+        cdef int64_t start
+        cdef pynmsg_writer *w
+
+        if self._writer_queue > 0:
+            raise Exception, 'asynchronous outputs take ownership of each message; use output.write()'
+
+        if self.output_type == 'callback':
+            self._write_callback(msg)
+            return
+
+        with self.lock:
+            w = self._writer
+            with nogil:
+                start = _profile_start()
+                if w != NULL:
+                    res = pynmsg_writer_write(w, _msg_instance)
+                else:
+                    res = nmsg_output_write(self._instance, _msg_instance)
+        if start != 0:
+            _profile_record(_PROF_WRITE, _profile_key(nmsg_message_get_vid(_msg_instance),
+                                                      nmsg_message_get_msgtype(_msg_instance)), start)
+        if self._stats is not None:
+            if res == nmsg_res_success:
+                self._stats.messages += 1
+            else:
+                self._stats.errors += 1
+        if res != nmsg_res_success:
+            raise Exception, 'nmsg_output_write() failed'
+
+    cdef _write_callback(self, msg, bint copy=False):
+        # libnmsg hands the instance to the callback, which destroys it, so
+        # msg gives it up as for an asynchronous write. Going through
+        # nmsg_output_write() applies the msgtype filter, and callback()
+        # or batch_callback() the field filter, rate, batching, lazy and
+        # header_only, as for messages from an io loop.
         cdef nmsg_message_t _msg_instance
+        cdef nmsg_res res
+
+        if self._filter_vid != 0 or self._filter_msgtype != 0:
+            # libnmsg would skip the message without destroying it.
+            _msg_instance = _write_instance(msg)
+            if (<unsigned> nmsg_message_get_vid(_msg_instance) != self._filter_vid or
+                <unsigned> nmsg_message_get_msgtype(_msg_instance) != self._filter_msgtype):
+                return
+        _msg_instance = _detach_instance(msg, copy)
+        with nogil:
+            res = nmsg_output_write(self._instance, _msg_instance)
+        self._raise_error()
+        if res != nmsg_res_success:
+            if self._stats is not None:
+                self._stats.errors += 1
+            raise Exception, 'nmsg_output_write() failed'
 
+    # Accepts a message or a message_header; a header is written from its
+    # native instance as received.
+    def write(self, msg):
         if self._instance == NULL:
             raise Exception, 'object not initialized'
 
-        if not msg:
+        if msg is None:
             return
+        if self._writer_queue > 0:
+            self._write_async(msg)
+            return
+        self._write(msg, _write_instance(msg))
 
-        if msg._instance == NULL:
-            msg.reinit()
+    cdef _write_async(self, msg, bint copy=False):
+        # The queue destroys the instance once written, so msg gives it up
+        # and rebuilds one from its fields if it is written again.
+        cdef nmsg_message_t _msg_instance = _detach_instance(msg, copy)
+        cdef pynmsg_writer *w = self._writer
+        cdef int r
 
-        if msg.changed:
-            msg.sync_message()
+        with nogil:
+            r = pynmsg_writer_put(w, _msg_instance)
+        if self._stats is not None and r == 0:
+            self._stats.messages += 1
 
-        msg.sync_fields()
+cdef class output_group(object):
+    # Writes each message to several outputs, encoding it only once.
+    cdef readonly list outputs
 
-        _msg_instance = msg._instance
-        msg._instance = NULL
+    def __init__(self, outputs=()):
+        self.outputs = []
+        for o in outputs:
+            self.add(o)
 
-        with self.lock:
-            with nogil:
-                res = nmsg_output_write(self._instance, _msg_instance)
-        if res != nmsg_res_success:
-            nmsg_message_destroy(&_msg_instance)
-            raise Exception, 'nmsg_output_write() failed'
-        nmsg_message_destroy(&_msg_instance)
+    def add(self, output o):
+        if o._instance == NULL:
+            raise Exception, 'output object not initialized'
+        self.outputs.append(o)
+
+    def write(self, msg):
+        cdef output o
+        cdef nmsg_message_t _msg_instance
+
+        if msg is None:
+            return
+
+        # Asynchronous and callback outputs destroy the instance they are
+        # given, so each gets a copy and msg is left as it was.
+        _msg_instance = _write_instance(msg)
+        for o in self.outputs:
+            if o._writer_queue > 0:
+                o._write_async(msg, True)
+            elif o.output_type == 'callback':
+                o._write_callback(msg, True)
+            else:
+                o._write(msg, _msg_instance)
+
+    def flush(self):
+        for o in self.outputs:
+            o.flush()
+
+    def close(self):
+        for o in self.outputs:
+            o.close()
+
+cdef enum:
+    _PART_ROUND_ROBIN
+    _PART_SOURCE
+    _PART_OPERATOR
+    _PART_GROUP
+    _PART_FIELD
+
+_partition_modes = {
+    'round_robin': _PART_ROUND_ROBIN,
+    'source': _PART_SOURCE,
+    'operator': _PART_OPERATOR,
+    'group': _PART_GROUP,
+    'field': _PART_FIELD,
+}
+
+# Writes each message to exactly one of several outputs, chosen in turn
+# or by a hash of the source, operator or group header or of the first
+# value of a named field, so equal keys always reach the same output. The
+# key is read from the native instance; each output keeps its own
+# buffering.
+cdef class partitioned_output(object):
+    cdef readonly list outputs
+    cdef readonly str by
+    cdef readonly object field
+    cdef int mode
+    cdef size_t next
+    cdef dict field_idx
+    cdef uint64_t *n_messages
+    cdef uint64_t *n_errors
+
+    def __cinit__(self):
+        self.n_messages = NULL
+        self.n_errors = NULL
+
+    def __init__(self, outputs, by='round_robin', field=None):
+        cdef output o
+        cdef size_t n, i
+
+        if by not in _partition_modes:
+            raise ValueError('by must be one of: %s' % ', '.join(sorted(_partition_modes)))
+        if (by == 'field') != (field is not None):
+            raise ValueError("field must be given when, and only when, by='field'")
+        self.outputs = []
+        for o in outputs:
+            if o._instance == NULL:
+                raise Exception, 'output object not initialized'
+            self.outputs.append(o)
+        n = len(self.outputs)
+        if n == 0:
+            raise ValueError('at least one output is required')
+
+        self.by = by
+        self.field = field
+        self.mode = _partition_modes[by]
+        self.next = 0
+        self.field_idx = {}
+        self.n_messages = <uint64_t *> malloc(n * sizeof(uint64_t))
+        self.n_errors = <uint64_t *> malloc(n * sizeof(uint64_t))
+        if self.n_messages == NULL or self.n_errors == NULL:
+            raise MemoryError()
+        for i in range(n):
+            self.n_messages[i] = 0
+            self.n_errors[i] = 0
+
+    def __dealloc__(self):
+        free(self.n_messages)
+        free(self.n_errors)
+
+    def __len__(self):
+        return len(self.outputs)
+
+    cdef Py_ssize_t _route(self, nmsg_message_t instance) except -1:
+        cdef size_t n = len(self.outputs)
+        cdef size_t i
+        cdef uint32_t u
+        cdef uint8_t *data = NULL
+        cdef size_t data_len = 0
+        cdef uint64_t key
+        cdef long idx
+
+        if self.mode == _PART_ROUND_ROBIN:
+            i = self.next
+            self.next = (i + 1) % n
+            return i
+
+        if self.mode == _PART_FIELD:
+            key = (<uint64_t> <uint32_t> nmsg_message_get_vid(instance)) << 32 | <uint32_t> nmsg_message_get_msgtype(instance)
+            try:
+                idx = self.field_idx[key]
+            except KeyError:
+                idx = _get_schema(instance).idx.get(self.field, -1)
+                self.field_idx[key] = idx
+            # A type without the field, or a message without a value,
+            # hashes the empty string.
+            if idx >= 0 and nmsg_message_get_field_by_idx(instance, idx, 0, <void **> &data, &data_len) != nmsg_res_success:
+                data_len = 0
+            return _fnv1a(data, data_len) % n
+
+        if self.mode == _PART_SOURCE:
+            u = nmsg_message_get_source(instance)
+        elif self.mode == _PART_OPERATOR:
+            u = nmsg_message_get_operator(instance)
+        else:
+            u = nmsg_message_get_group(instance)
+        return _fnv1a(<uint8_t *> &u, sizeof(u)) % n
+
+    def write(self, msg):
+        cdef nmsg_message_t _msg_instance
+        cdef Py_ssize_t i
+        cdef output o
+
+        if msg is None:
+            return
+
+        _msg_instance = _write_instance(msg)
+        i = self._route(_msg_instance)
+        o = self.outputs[i]
+        try:
+            if o._writer_queue > 0:
+                o._write_async(msg)
+            else:
+                o._write(msg, _msg_instance)
+        except:
+            self.n_errors[i] += 1
+            raise
+        self.n_messages[i] += 1
+
+    # Per-partition counters, in the order of outputs.
+    def stats(self):
+        cdef output o
+        cdef size_t i
+
+        out = []
+        for i, o in enumerate(self.outputs):
+            out.append({
+                'messages': self.n_messages[i],
+                'errors': self.n_errors[i],
+                'queue_depth': o._queue_depth(),
+            })
+        return out
+
+    def flush(self):
+        for o in self.outputs:
+            o.flush()
+
+    def close(self):
+        for o in self.outputs:
+            o.close()
@@ -0,0 +1,143 @@
+#cython: embedsignature=True
+
+# Copyright (c) 2026 by Farsight Security, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys
+
+cdef inline int64_t _monotonic_ns() nogil:
+    cdef timespec ts
+    clock_gettime(CLOCK_MONOTONIC, &ts)
+    return <int64_t> ts.tv_sec * 1000000000 + ts.tv_nsec
+
+# Per-phase timing of the binding, off by default. Every instrumented
+# site tests the C flag _profiling before reading the clock, so the
+# disabled path costs one branch.
+cdef enum:
+    _PROF_DECODE
+    _PROF_ENCODE
+    _PROF_ALIAS
+    _PROF_READ
+    _PROF_WRITE
+    _PROF_CALLBACK
+    _PROF_NPHASES
+
+_profile_phases = ('decode', 'encode', 'alias', 'read', 'write', 'callback')
+
+# Key for phases that cover a batch of messages rather than one type.
+cdef uint64_t _PROF_NOKEY = 0xffffffffffffffffULL
+
+cdef bint _profiling = False
+cdef object _profile_hook = None
+cdef dict _profile_slots = {}
+
+cdef class _profile_slot(object):
+    cdef uint64_t count[_PROF_NPHASES]
+    cdef uint64_t total_ns[_PROF_NPHASES]
+    cdef uint64_t max_ns[_PROF_NPHASES]
+
+cdef inline int64_t _profile_start() nogil:
+    if _profiling:
+        return _monotonic_ns()
+    return 0
+
+cdef inline uint64_t _profile_key(unsigned vid, unsigned msgtype):
+    return (<uint64_t> vid) << 32 | msgtype
+
+# Records the time since start, a value from _profile_start(). A start of
+# 0 means profiling was off when the phase began.
+cdef int _profile_record(int phase, uint64_t key, int64_t start) except -1:
+    cdef int64_t ns
+    cdef _profile_slot slot
+
+    if start == 0 or not _profiling:
+        return 0
+    ns = _monotonic_ns() - start
+
+    slot = _profile_slots.get(key)
+    if slot is None:
+        slot = _profile_slot()
+        _profile_slots[key] = slot
+    slot.count[phase] += 1
+    slot.total_ns[phase] += ns
+    if <uint64_t> ns > slot.max_ns[phase]:
+        slot.max_ns[phase] = ns
+
+    if _profile_hook is not None:
+        if key == _PROF_NOKEY:
+            _profile_hook(_profile_phases[phase], None, None, ns)
+        else:
+            _profile_hook(_profile_phases[phase], <unsigned> (key >> 32), <unsigned> key, ns)
+    return 0
+
+# Starts recording. hook, if given, is called as
+# hook(phase, vid, msgtype, ns) for every timed phase; vid and msgtype are
+# None for phases that cover a whole batch.
+def profile_enable(hook=None):
+    global _profiling, _profile_hook
+    _profile_hook = hook
+    _profiling = True
+
+def profile_disable():
+    global _profiling, _profile_hook
+    _profiling = False
+    _profile_hook = None
+
+def profile_reset():
+    _profile_slots.clear()
+
+# Returns {(vid, msgtype) or None: {phase: {'count', 'total_ns', 'max_ns'}}}.
+def profile_stats():
+    cdef _profile_slot slot
+    cdef int phase
+
+    out = {}
+    for key, slot in _profile_slots.items():
+        phases = {}
+        for phase in range(_PROF_NPHASES):
+            if slot.count[phase]:
+                phases[_profile_phases[phase]] = {
+                    'count': slot.count[phase],
+                    'total_ns': slot.total_ns[phase],
+                    'max_ns': slot.max_ns[phase],
+                }
+        if key == _PROF_NOKEY:
+            out[None] = phases
+        else:
+            out[(key >> 32, key & 0xffffffff)] = phases
+    return out
+
+def _profile_type_name(key):
+    if key is None:
+        return '(batch)'
+    vid, msgtype = key
+    try:
+        return '%s/%s' % (msgmod_vid_to_vname(vid), msgmod_msgtype_to_mname(vid, msgtype))
+    except Exception:
+        return '%d/%d' % (vid, msgtype)
+
+def profile_summary(out=None):
+    if out is None:
+        out = sys.stdout
+    out.write('%-24s %-8s %10s %12s %10s %10s\n' % ('type', 'phase', 'count', 'total ms', 'mean us', 'max us'))
+    stats = profile_stats()
+    for key in sorted(stats, key=lambda k: (k is None, k)):
+        name = _profile_type_name(key)
+        for phase in _profile_phases:
+            p = stats[key].get(phase)
+            if p is None:
+                continue
+            out.write('%-24s %-8s %10d %12.3f %10.3f %10.3f\n' % (
+                name, phase, p['count'], p['total_ns'] / 1e6,
+                p['total_ns'] / 1e3 / p['count'], p['max_ns'] / 1e3))
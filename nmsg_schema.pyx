@@ -0,0 +1,151 @@
+#cython: embedsignature=True
+
+# Copyright (c) 2026 by Farsight Security, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# (vid << 32 | msgtype) -> _schema
+cdef dict _schemas = {}
+
+cdef class _schema(object):
+    cdef readonly unsigned vid
+    cdef readonly unsigned msgtype
+    cdef readonly size_t n_fields
+    cdef readonly list names
+    cdef readonly list enc_names
+    cdef readonly dict idx
+    cdef readonly dict types
+    cdef readonly dict flags
+    cdef readonly frozenset name_set
+    cdef nmsg_msgmod_field_type *c_types
+    cdef unsigned *c_flags
+    cdef list enum_names
+    cdef list enum_values
+
+    def __cinit__(self):
+        self.c_types = NULL
+        self.c_flags = NULL
+
+    def __dealloc__(self):
+        free(self.c_types)
+        free(self.c_flags)
+
+    cdef load(self, nmsg_message_t instance):
+        cdef nmsg_res res
+        cdef size_t n_fields
+        cdef const char *field_name
+        cdef nmsg_msgmod_field_type field_type
+        cdef unsigned field_flags
+
+        self.vid = nmsg_message_get_vid(instance)
+        self.msgtype = nmsg_message_get_msgtype(instance)
+
+        res = nmsg_message_get_num_fields(instance, &n_fields)
+        if res != nmsg_res_success:
+            raise Exception, 'nmsg_message_get_num_fields() failed'
+
+        self.n_fields = n_fields
+        self.c_types = <nmsg_msgmod_field_type *> malloc(max(n_fields, 1) * sizeof(nmsg_msgmod_field_type))
+        self.c_flags = <unsigned *> malloc(max(n_fields, 1) * sizeof(unsigned))
+        if self.c_types == NULL or self.c_flags == NULL:
+            raise MemoryError()
+
+        self.names = []
+        self.enc_names = []
+        self.idx = {}
+        self.types = {}
+        self.flags = {}
+        self.enum_names = []
+        self.enum_values = []
+
+        for field_idx in range(n_fields):
+            res = nmsg_message_get_field_name(instance, field_idx, &field_name)
+            if res != nmsg_res_success:
+                raise Exception, 'nmsg_message_get_field_name() failed'
+
+            res = nmsg_message_get_field_type_by_idx(instance, field_idx, &field_type)
+            if res != nmsg_res_success:
+                raise Exception, 'nmsg_message_get_field_type_by_idx() failed'
+
+            res = nmsg_message_get_field_flags_by_idx(instance, field_idx, &field_flags)
+            if res != nmsg_res_success:
+                raise Exception, 'nmsg_message_get_field_flags_by_idx() failed'
+
+            enc_name = <bytes> field_name
+            field_name_dec = enc_name.decode('utf-8')
+
+            self.names.append(field_name_dec)
+            self.enc_names.append(enc_name)
+            self.idx[field_name_dec] = field_idx
+            self.types[field_name_dec] = field_type
+            self.flags[field_name_dec] = field_flags
+            self.c_types[field_idx] = field_type
+            self.c_flags[field_idx] = field_flags
+            self.enum_names.append({})
+            self.enum_values.append({})
+
+        self.name_set = frozenset(self.names)
+
+    cdef enum_name(self, nmsg_message_t instance, unsigned field_idx, unsigned value):
+        # Returns the enum name for value, or value itself if it is unnamed.
+        cdef nmsg_res res
+        cdef const char *str_enum
+        cdef dict names = self.enum_names[field_idx]
+
+        try:
+            return names[value]
+        except KeyError:
+            pass
+
+        res = nmsg_message_enum_value_to_name_by_idx(instance, field_idx, value, &str_enum)
+        if res == nmsg_res_success:
+            name = str_enum.decode('utf-8')
+        else:
+            name = value
+        names[value] = name
+        return name
+
+    cdef unsigned enum_value(self, nmsg_message_t instance, unsigned field_idx, name) except? 0:
+        cdef nmsg_res res
+        cdef unsigned value
+        cdef dict values = self.enum_values[field_idx]
+
+        try:
+            return values[name]
+        except KeyError:
+            pass
+
+        if isinstance(name, bytes):
+            name_enc = name # Don't encode in python2
+        else:
+            name_enc = name.encode('utf-8')
+        res = nmsg_message_enum_name_to_value_by_idx(instance, field_idx, name_enc, &value)
+        if res != nmsg_res_success:
+            raise Exception, 'unknown enum value for field_name=%s: %s' % (self.names[field_idx], name)
+        values[name] = value
+        return value
+
+cdef _schema _get_schema(nmsg_message_t instance):
+    cdef uint64_t key
+    cdef _schema schema
+
+    key = (<uint64_t> <uint32_t> nmsg_message_get_vid(instance)) << 32 | <uint32_t> nmsg_message_get_msgtype(instance)
+    try:
+        return _schemas[key]
+    except KeyError:
+        pass
+
+    schema = _schema()
+    schema.load(instance)
+    _schemas[key] = schema
+    return schema
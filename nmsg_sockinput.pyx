@@ -0,0 +1,270 @@
+#cython: embedsignature=True
+
+# Copyright (c) 2026 by Farsight Security, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from libc.errno cimport errno
+
+cdef extern from "sock_recv.c" nogil:
+    struct pynmsg_sockbuf:
+        unsigned int vlen
+        uint32_t drops
+        uint64_t truncated
+
+    pynmsg_sockbuf *pynmsg_sockbuf_new(unsigned int vlen, size_t bufsz)
+    void pynmsg_sockbuf_free(pynmsg_sockbuf *sb)
+    int pynmsg_sockbuf_recv(int fd, pynmsg_sockbuf *sb, int timeout_ms)
+    uint8_t *pynmsg_sockbuf_datagram(pynmsg_sockbuf *sb, unsigned int i, size_t *len)
+    int pynmsg_enable_rxq_ovfl(int fd)
+
+# Longest single wait inside the receive loop, so signals are noticed.
+cdef int _SOCK_POLL_MS = 500
+
+def input_open_sock_batch(addr, port, rcvbuf=4 * 1048576, size_t batch=32, size_t bufsz=65536, reuseport=False):
+    obj = socket.socket(_sock_family(addr), socket.SOCK_DGRAM)
+    obj.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuseport:
+        if not hasattr(socket, 'SO_REUSEPORT'):
+            raise Exception, 'SO_REUSEPORT is not supported on this platform'
+        obj.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    if rcvbuf:
+        try:
+            obj.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+        except socket.error:
+            pass
+    obj.bind((addr, int(port)))
+    i = sockinput()
+    i._open(obj, batch, bufsz)
+    return i
+
+# Opens count sockets bound to the same address with SO_REUSEPORT. The
+# kernel spreads incoming datagrams across them by flow, so each shard can
+# be drained by its own thread or process.
+def input_open_sock_shards(addr, port, unsigned count, rcvbuf=4 * 1048576, size_t batch=32, size_t bufsz=65536):
+    return [ input_open_sock_batch(addr, port, rcvbuf, batch, bufsz, True) for _ in range(count) ]
+
+cdef class sockinput(object):
+    cdef nmsg_input_t _instance
+    cdef pynmsg_sockbuf *_sb
+    cdef nmsg_message_t **_results
+    cdef size_t *_counts
+    cdef object fileobj
+    cdef int fd
+    cdef object lock
+    cdef list _pending
+    cdef bool blocking_io
+    cdef bool lazy
+    cdef bool header_only
+    cdef _filter _filter
+    cdef readonly bool drops_supported
+    cdef uint64_t n_datagrams
+    cdef uint64_t n_bytes
+    cdef uint64_t n_messages
+    cdef uint64_t n_errors
+
+    open = staticmethod(input_open_sock_batch)
+    open_shards = staticmethod(input_open_sock_shards)
+
+    def __cinit__(self):
+        self._instance = NULL
+        self._sb = NULL
+        self._results = NULL
+        self._counts = NULL
+        self.fd = -1
+        self.lock = threading.Lock()
+        self._pending = []
+        self.blocking_io = True
+        self.lazy = False
+        self.header_only = False
+        self.n_datagrams = 0
+        self.n_bytes = 0
+        self.n_messages = 0
+        self.n_errors = 0
+
+    def __dealloc__(self):
+        self._close()
+
+    def __repr__(self):
+        return 'nmsg sockinput object fd=%d _instance=0x%x' % (self.fd, <uint64_t> self._instance)
+
+    cdef _close(self):
+        if self._instance != NULL:
+            nmsg_input_close(&self._instance)
+        pynmsg_sockbuf_free(self._sb)
+        self._sb = NULL
+        free(self._results)
+        self._results = NULL
+        free(self._counts)
+        self._counts = NULL
+
+    cpdef _open(self, fileobj, size_t batch, size_t bufsz):
+        if batch == 0 or bufsz == 0:
+            raise ValueError('batch and bufsz must be at least 1')
+        self._instance = nmsg_input_open_null()
+        if self._instance == NULL:
+            raise Exception, 'nmsg_input_open_null() failed'
+        self._sb = pynmsg_sockbuf_new(batch, bufsz)
+        self._results = <nmsg_message_t **> malloc(batch * sizeof(nmsg_message_t *))
+        self._counts = <size_t *> malloc(batch * sizeof(size_t))
+        if self._sb == NULL or self._results == NULL or self._counts == NULL:
+            self._close()
+            raise MemoryError()
+        self.fileobj = fileobj
+        self.fd = fileobj.fileno()
+        self.drops_supported = pynmsg_enable_rxq_ovfl(self.fd) == 0
+
+    def fileno(self):
+        return self.fd
+
+    def close(self):
+        self._close()
+        if self.fileobj is not None:
+            self.fileobj.close()
+            self.fileobj = None
+        self.fd = -1
+
+    property rcvbuf:
+        def __get__(self):
+            return self.fileobj.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+
+    def stats(self):
+        if self._sb == NULL:
+            raise Exception, 'object not initialized'
+        return {
+            'datagrams': self.n_datagrams,
+            'bytes': self.n_bytes,
+            'messages': self.n_messages,
+            'errors': self.n_errors,
+            'truncated': self._sb.truncated,
+            'drops': self._sb.drops,
+            'filtered': self._filter.rejected if self._filter is not None else 0,
+            'sampled_out': self._filter.sampled_out if self._filter is not None else 0,
+        }
+
+    cdef int _recv(self, int timeout_ms) except -1:
+        # Receives one batch of datagrams and decodes them into _pending.
+        # Returns the number of datagrams, 0 if none arrived in time.
+        cdef int n
+        cdef int i
+        cdef int err = 0
+        cdef size_t j
+        cdef size_t k
+        cdef size_t dlen
+        cdef uint8_t *dptr
+        cdef nmsg_res res
+        cdef uint64_t n_bytes = 0
+        cdef uint64_t n_errors = 0
+
+        with self.lock:
+            with nogil:
+                n = pynmsg_sockbuf_recv(self.fd, self._sb, timeout_ms)
+                if n < 0:
+                    err = errno
+                for i in range(n):
+                    dptr = pynmsg_sockbuf_datagram(self._sb, i, &dlen)
+                    n_bytes += dlen
+                    res = nmsg_input_read_null(self._instance, dptr, dlen, NULL, &self._results[i], &self._counts[i])
+                    if res != nmsg_res_success:
+                        if res != nmsg_res_again:
+                            n_errors += 1
+                        self._results[i] = NULL
+                        self._counts[i] = 0
+
+            if n < 0:
+                raise socket.error(err, os.strerror(err))
+
+            self.n_datagrams += n
+            self.n_bytes += n_bytes
+            self.n_errors += n_errors
+            for i in range(n):
+                if self._results[i] == NULL:
+                    continue
+                if self._filter is not None:
+                    try:
+                        self._counts[i] = _filter_messages(self._filter, self._results[i], self._counts[i])
+                    except:
+                        for j in range(i, n):
+                            if j > i:
+                                for k in range(self._counts[j]):
+                                    nmsg_message_destroy(&self._results[j][k])
+                            free(self._results[j])
+                        raise
+                for j in range(self._counts[i]):
+                    self._pending.append(_wrap_message(self._results[i][j], self.lazy, self.header_only))
+                self.n_messages += self._counts[i]
+                free(self._results[i])
+        return n
+
+    # Returns up to max_count messages, blocking until at least one arrives
+    # unless the input is non-blocking or the timeout expires.
+    def read_many(self, size_t max_count, timeout=None):
+        cdef int err
+        cdef int wait_ms
+
+        if self._instance == NULL:
+            raise Exception, 'object not initialized'
+
+        if timeout is not None:
+            if not isinstance(timeout, numbers.Real):
+                raise ValueError('timeout must be a real number')
+            deadline = time.time() + timeout
+
+        while not self._pending:
+            if self.blocking_io is False:
+                wait_ms = 0
+            elif timeout is not None:
+                wait_ms = max(0, min(_SOCK_POLL_MS, int((deadline - time.time()) * 1000)))
+            else:
+                wait_ms = _SOCK_POLL_MS
+            if self._recv(wait_ms) > 0:
+                continue
+            err = PyErr_CheckSignals()
+            if err != 0:
+                if PyErr_ExceptionMatches(KeyboardInterrupt):
+                    raise KeyboardInterrupt
+            elif wait_ms == 0 or (timeout is not None and time.time() >= deadline):
+                break
+
+        msg_list = self._pending[:max_count]
+        del self._pending[:max_count]
+        return msg_list
+
+    def read(self):
+        msg_list = self.read_many(1)
+        if msg_list:
+            return msg_list[0]
+        return None
+
+    def __iter__(self):
+        while True:
+            msg_list = self.read_many(_READ_BATCH)
+            if not msg_list:
+                return
+            for msg in msg_list:
+                yield msg
+
+    def set_blocking_io(self, bool flag):
+        self.blocking_io = flag
+
+    def set_lazy(self, bool flag):
+        self.lazy = flag
+
+    def set_header_only(self, bool flag):
+        self.header_only = flag
+
+    def set_filter(self, expr):
+        self._filter = _filter_with_expr(self._filter, expr)
+
+    def set_sample(self, rate, key=None):
+        self._filter = _filter_with_sample(self._filter, rate, key)
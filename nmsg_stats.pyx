@@ -0,0 +1,107 @@
+#cython: embedsignature=True
+
+# Copyright (c) 2026 by Farsight Security, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+cdef enum:
+    # Bucket i counts callbacks that took under 2**i microseconds; the last
+    # bucket takes everything slower.
+    _STATS_HIST_BUCKETS = 24
+
+# Counters kept by an input, output or io once set_stats(True) is called.
+# Objects hold None until then, so a disabled object pays one pointer
+# comparison per operation.
+cdef class _stats(object):
+    cdef uint64_t messages
+    cdef uint64_t bytes
+    cdef uint64_t containers
+    cdef uint64_t errors
+    cdef uint64_t again
+    cdef uint64_t flushes
+    cdef uint64_t callbacks
+    cdef uint64_t callback_ns
+    cdef uint64_t hist[_STATS_HIST_BUCKETS]
+
+    cdef void record_callback(self, int64_t ns):
+        cdef uint64_t us = ns // 1000 if ns > 0 else 0
+        cdef unsigned b = 0
+
+        while us > 0 and b < _STATS_HIST_BUCKETS - 1:
+            us >>= 1
+            b += 1
+        self.hist[b] += 1
+        self.callbacks += 1
+        self.callback_ns += ns
+
+    cdef dict snapshot(self):
+        cdef unsigned b
+
+        return {
+            'messages': self.messages,
+            'bytes': self.bytes,
+            'containers': self.containers,
+            'errors': self.errors,
+            'again': self.again,
+            'flushes': self.flushes,
+            'callbacks': self.callbacks,
+            'callback_ns': self.callback_ns,
+            # (upper bound in microseconds, count); None is unbounded.
+            'callback_histogram': [ (1 << b if b < _STATS_HIST_BUCKETS - 1 else None, self.hist[b])
+                                    for b in range(_STATS_HIST_BUCKETS) ],
+        }
+
+cdef _stats _stats_enable(_stats s, bint flag):
+    if not flag:
+        return None
+    if s is None:
+        s = _stats()
+    return s
+
+# Adds the filter counters, if any, to a stats snapshot.
+cdef dict _stats_snapshot(_stats s, _filter f):
+    if s is None:
+        raise Exception, 'statistics are not enabled; call set_stats(True)'
+    d = s.snapshot()
+    d['filtered'] = f.rejected if f is not None else 0
+    d['sampled_out'] = f.sampled_out if f is not None else 0
+    return d
+
+# Calls fn(obj.stats()) every interval seconds on a daemon thread until
+# stop() is called.
+class stats_monitor(object):
+    def __init__(self, obj, fn, interval=10.0):
+        self.obj = obj
+        self.fn = fn
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.fn(self.obj.stats())
@@ -0,0 +1,471 @@
+/*
+ * Copyright (c) 2026 by Farsight Security, Inc.
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *    http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+
+/* Writer thread for outputs. With a queue, messages are held in a bounded
+ * ring and written to the nmsg output by a native thread, so serialization,
+ * compression and I/O happen without the GIL and off the caller's thread.
+ * The queue owns every message it holds and destroys it once written or
+ * dropped. Without a queue, the caller writes through
+ * pynmsg_writer_write() and the thread only enforces the maximum delay.
+ *
+ * With a maximum delay, the output is flushed once the oldest write that
+ * has not been flushed is that old, so a partly filled container does not
+ * wait indefinitely for more messages. */
+
+#include <errno.h>
+#include <pthread.h>
+#include <stdint.h>
+#include <stdlib.h>
+#include <time.h>
+
+#include <nmsg.h>
+
+/* Deadlines are kept on the monotonic clock, so stepping the wall clock
+ * neither delays nor floods the timed flushes. macOS cannot time condition
+ * variable waits against it and falls back to the wall clock. */
+#ifdef __APPLE__
+#define PYNMSG_COND_CLOCK CLOCK_REALTIME
+#else
+#define PYNMSG_COND_CLOCK CLOCK_MONOTONIC
+#endif
+
+static int
+pynmsg_cond_init(pthread_cond_t *cond)
+{
+    pthread_condattr_t attr;
+    int r;
+
+    if (pthread_condattr_init(&attr) != 0)
+        return -1;
+#ifndef __APPLE__
+    if (pthread_condattr_setclock(&attr, PYNMSG_COND_CLOCK) != 0) {
+        pthread_condattr_destroy(&attr);
+        return -1;
+    }
+#endif
+    r = pthread_cond_init(cond, &attr);
+    pthread_condattr_destroy(&attr);
+    return r == 0 ? 0 : -1;
+}
+
+enum {
+    PYNMSG_WRITER_BLOCK = 0,
+    PYNMSG_WRITER_DROP_NEWEST = 1,
+    PYNMSG_WRITER_DROP_OLDEST = 2,
+};
+
+struct pynmsg_writer_stats {
+    uint64_t queued;
+    uint64_t written;
+    uint64_t errors;
+    uint64_t dropped_newest;
+    uint64_t dropped_oldest;
+    uint64_t timed_flushes;
+    size_t depth;
+    size_t max_depth;
+    size_t capacity;
+};
+
+struct pynmsg_writer {
+    nmsg_output_t output;
+    pthread_t thread;
+    pthread_mutex_t lock;
+    pthread_cond_t nonempty;
+    pthread_cond_t nonfull;
+    pthread_cond_t idle;
+    nmsg_message_t *ring;
+    size_t head;
+    size_t count;
+    int policy;
+    int busy;
+    int stop;
+    int64_t max_delay_ns;
+    /* Whether anything was written since the last flush, and when the
+     * first such write happened, on PYNMSG_COND_CLOCK. */
+    int dirty;
+    struct timespec since;
+    /* First failure since the last flush, reported by the next flush. */
+    nmsg_res error;
+    struct pynmsg_writer_stats st;
+};
+
+static struct timespec
+pynmsg_writer_deadline(struct pynmsg_writer *w)
+{
+    struct timespec ts = w->since;
+    int64_t ns = ts.tv_nsec + w->max_delay_ns;
+
+    ts.tv_sec += ns / 1000000000;
+    ts.tv_nsec = ns % 1000000000;
+    return ts;
+}
+
+/* Called with w->lock held after a successful write. */
+static void
+pynmsg_writer_mark(struct pynmsg_writer *w)
+{
+    if (w->dirty || w->max_delay_ns <= 0)
+        return;
+    w->dirty = 1;
+    clock_gettime(PYNMSG_COND_CLOCK, &w->since);
+    /* Wake the thread so that it starts waiting on the new deadline. */
+    pthread_cond_signal(&w->nonempty);
+}
+
+/* Called with w->lock held; flushes if the deadline has passed. */
+static void
+pynmsg_writer_flush_due(struct pynmsg_writer *w)
+{
+    struct timespec now, deadline;
+    nmsg_res res;
+
+    if (!w->dirty)
+        return;
+    clock_gettime(PYNMSG_COND_CLOCK, &now);
+    deadline = pynmsg_writer_deadline(w);
+    if (now.tv_sec < deadline.tv_sec ||
+        (now.tv_sec == deadline.tv_sec && now.tv_nsec < deadline.tv_nsec))
+        return;
+    res = nmsg_output_flush(w->output);
+    w->dirty = 0;
+    w->st.timed_flushes++;
+    if (res != nmsg_res_success) {
+        w->st.errors++;
+        if (w->error == nmsg_res_success)
+            w->error = res;
+    }
+}
+
+static void *
+pynmsg_writer_run(void *arg)
+{
+    struct pynmsg_writer *w = arg;
+    struct timespec deadline;
+    nmsg_message_t msg;
+    nmsg_res res;
+
+    pthread_mutex_lock(&w->lock);
+    for (;;) {
+        while (w->count == 0 && !w->stop) {
+            if (w->dirty) {
+                deadline = pynmsg_writer_deadline(w);
+                if (pthread_cond_timedwait(&w->nonempty, &w->lock, &deadline) == ETIMEDOUT)
+                    pynmsg_writer_flush_due(w);
+            } else {
+                pthread_cond_wait(&w->nonempty, &w->lock);
+            }
+        }
+        if (w->count == 0)
+            break;
+        msg = w->ring[w->head];
+        w->head = (w->head + 1) % w->st.capacity;
+        w->count--;
+        w->busy = 1;
+        pthread_cond_signal(&w->nonfull);
+        pthread_mutex_unlock(&w->lock);
+
+        res = nmsg_output_write(w->output, msg);
+        nmsg_message_destroy(&msg);
+
+        pthread_mutex_lock(&w->lock);
+        w->busy = 0;
+        if (res == nmsg_res_success) {
+            w->st.written++;
+            pynmsg_writer_mark(w);
+        } else {
+            w->st.errors++;
+            if (w->error == nmsg_res_success)
+                w->error = res;
+        }
+        /* Under steady load the queue never empties, so check here too. */
+        pynmsg_writer_flush_due(w);
+        if (w->count == 0)
+            pthread_cond_broadcast(&w->idle);
+    }
+    pthread_mutex_unlock(&w->lock);
+    return NULL;
+}
+
+__attribute__((unused))
+static struct pynmsg_writer *
+pynmsg_writer_new(nmsg_output_t output, size_t capacity, int policy, int64_t max_delay_ns)
+{
+    struct pynmsg_writer *w;
+
+    w = calloc(1, sizeof(*w));
+    if (w == NULL)
+        return NULL;
+    if (capacity > 0) {
+        w->ring = calloc(capacity, sizeof(*w->ring));
+        if (w->ring == NULL) {
+            free(w);
+            return NULL;
+        }
+    }
+    w->output = output;
+    w->policy = policy;
+    w->max_delay_ns = max_delay_ns;
+    w->error = nmsg_res_success;
+    w->st.capacity = capacity;
+    pthread_mutex_init(&w->lock, NULL);
+    pthread_cond_init(&w->nonfull, NULL);
+    pthread_cond_init(&w->idle, NULL);
+    if (pynmsg_cond_init(&w->nonempty) != 0) {
+        pthread_mutex_destroy(&w->lock);
+        pthread_cond_destroy(&w->nonfull);
+        pthread_cond_destroy(&w->idle);
+        free(w->ring);
+        free(w);
+        return NULL;
+    }
+    if (pthread_create(&w->thread, NULL, pynmsg_writer_run, w) != 0) {
+        pthread_mutex_destroy(&w->lock);
+        pthread_cond_destroy(&w->nonempty);
+        pthread_cond_destroy(&w->nonfull);
+        pthread_cond_destroy(&w->idle);
+        free(w->ring);
+        free(w);
+        return NULL;
+    }
+    return w;
+}
+
+/* Takes ownership of msg. Returns 0 if it was queued, 1 if it was dropped
+ * because the queue was full under the drop-newest policy. */
+__attribute__((unused))
+static int
+pynmsg_writer_put(struct pynmsg_writer *w, nmsg_message_t msg)
+{
+    size_t cap = w->st.capacity;
+    nmsg_message_t old;
+
+    pthread_mutex_lock(&w->lock);
+    if (w->count == cap) {
+        if (w->policy == PYNMSG_WRITER_DROP_NEWEST) {
+            w->st.dropped_newest++;
+            pthread_mutex_unlock(&w->lock);
+            nmsg_message_destroy(&msg);
+            return 1;
+        } else if (w->policy == PYNMSG_WRITER_DROP_OLDEST) {
+            old = w->ring[w->head];
+            w->head = (w->head + 1) % cap;
+            w->count--;
+            w->st.dropped_oldest++;
+            nmsg_message_destroy(&old);
+        } else {
+            while (w->count == cap)
+                pthread_cond_wait(&w->nonfull, &w->lock);
+        }
+    }
+    w->ring[(w->head + w->count) % cap] = msg;
+    w->count++;
+    w->st.queued++;
+    if (w->count > w->st.max_depth)
+        w->st.max_depth = w->count;
+    pthread_cond_signal(&w->nonempty);
+    pthread_mutex_unlock(&w->lock);
+    return 0;
+}
+
+/* Writes msg on the calling thread, for writers without a queue. The
+ * caller keeps ownership of msg. */
+__attribute__((unused))
+static nmsg_res
+pynmsg_writer_write(struct pynmsg_writer *w, nmsg_message_t msg)
+{
+    nmsg_res res;
+
+    pthread_mutex_lock(&w->lock);
+    res = nmsg_output_write(w->output, msg);
+    if (res == nmsg_res_success) {
+        w->st.written++;
+        pynmsg_writer_mark(w);
+    } else {
+        w->st.errors++;
+    }
+    pthread_mutex_unlock(&w->lock);
+    return res;
+}
+
+/* nmsg callback output handed to an io loop in place of the writer's
+ * output, which libnmsg io threads must not write to while the writer
+ * thread flushes it. Each message goes to the writer, which owns it. */
+__attribute__((unused))
+static void
+pynmsg_writer_callback(nmsg_message_t msg, void *user)
+{
+    struct pynmsg_writer *w = user;
+
+    if (w->st.capacity > 0) {
+        pynmsg_writer_put(w, msg);
+    } else {
+        pynmsg_writer_write(w, msg);
+        nmsg_message_destroy(&msg);
+    }
+}
+
+/* Waits for the queue to drain, then flushes the output. Returns the first
+ * write error since the previous flush, if any, or the flush result. */
+__attribute__((unused))
+static nmsg_res
+pynmsg_writer_flush(struct pynmsg_writer *w)
+{
+    nmsg_res res;
+
+    pthread_mutex_lock(&w->lock);
+    while (w->count > 0 || w->busy)
+        pthread_cond_wait(&w->idle, &w->lock);
+    res = w->error;
+    w->error = nmsg_res_success;
+    if (res == nmsg_res_success)
+        res = nmsg_output_flush(w->output);
+    w->dirty = 0;
+    pthread_mutex_unlock(&w->lock);
+    return res;
+}
+
+__attribute__((unused))
+static void
+pynmsg_writer_get_stats(struct pynmsg_writer *w, struct pynmsg_writer_stats *st)
+{
+    pthread_mutex_lock(&w->lock);
+    *st = w->st;
+    st->depth = w->count;
+    pthread_mutex_unlock(&w->lock);
+}
+
+/* Writes out whatever is queued, then stops the thread and frees w. */
+__attribute__((unused))
+static void
+pynmsg_writer_free(struct pynmsg_writer *w)
+{
+    if (w == NULL)
+        return;
+    pthread_mutex_lock(&w->lock);
+    w->stop = 1;
+    pthread_cond_signal(&w->nonempty);
+    pthread_mutex_unlock(&w->lock);
+    pthread_join(w->thread, NULL);
+
+    pthread_mutex_destroy(&w->lock);
+    pthread_cond_destroy(&w->nonempty);
+    pthread_cond_destroy(&w->nonfull);
+    pthread_cond_destroy(&w->idle);
+    free(w->ring);
+    free(w);
+}
+
+/* One-shot deadline timer on a native thread, used to deliver partial
+ * callback batches once they reach their maximum delay. Arming an armed
+ * timer keeps the earlier deadline; fire() may re-arm it. */
+struct pynmsg_timer {
+    pthread_t thread;
+    pthread_mutex_t lock;
+    pthread_cond_t cond;
+    int armed;
+    int stop;
+    struct timespec deadline;
+    void (*fire)(void *);
+    void *arg;
+};
+
+static void *
+pynmsg_timer_run(void *arg)
+{
+    struct pynmsg_timer *t = arg;
+
+    pthread_mutex_lock(&t->lock);
+    for (;;) {
+        while (!t->armed && !t->stop)
+            pthread_cond_wait(&t->cond, &t->lock);
+        while (t->armed && !t->stop) {
+            if (pthread_cond_timedwait(&t->cond, &t->lock, &t->deadline) == ETIMEDOUT)
+                break;
+        }
+        if (t->stop)
+            break;
+        if (!t->armed)
+            continue;
+        t->armed = 0;
+        pthread_mutex_unlock(&t->lock);
+        t->fire(t->arg);
+        pthread_mutex_lock(&t->lock);
+    }
+    pthread_mutex_unlock(&t->lock);
+    return NULL;
+}
+
+__attribute__((unused))
+static struct pynmsg_timer *
+pynmsg_timer_new(void (*fire)(void *), void *arg)
+{
+    struct pynmsg_timer *t;
+
+    t = calloc(1, sizeof(*t));
+    if (t == NULL)
+        return NULL;
+    t->fire = fire;
+    t->arg = arg;
+    pthread_mutex_init(&t->lock, NULL);
+    if (pynmsg_cond_init(&t->cond) != 0) {
+        pthread_mutex_destroy(&t->lock);
+        free(t);
+        return NULL;
+    }
+    if (pthread_create(&t->thread, NULL, pynmsg_timer_run, t) != 0) {
+        pthread_mutex_destroy(&t->lock);
+        pthread_cond_destroy(&t->cond);
+        free(t);
+        return NULL;
+    }
+    return t;
+}
+
+__attribute__((unused))
+static void
+pynmsg_timer_arm(struct pynmsg_timer *t, int64_t delay_ns)
+{
+    int64_t ns;
+
+    pthread_mutex_lock(&t->lock);
+    if (!t->armed) {
+        clock_gettime(PYNMSG_COND_CLOCK, &t->deadline);
+        ns = t->deadline.tv_nsec + delay_ns;
+        t->deadline.tv_sec += ns / 1000000000;
+        t->deadline.tv_nsec = ns % 1000000000;
+        t->armed = 1;
+        pthread_cond_signal(&t->cond);
+    }
+    pthread_mutex_unlock(&t->lock);
+}
+
+/* Stops the thread, waiting for a fire() in progress, and frees t. */
+__attribute__((unused))
+static void
+pynmsg_timer_free(struct pynmsg_timer *t)
+{
+    if (t == NULL)
+        return;
+    pthread_mutex_lock(&t->lock);
+    t->stop = 1;
+    pthread_cond_signal(&t->cond);
+    pthread_mutex_unlock(&t->lock);
+    pthread_join(t->thread, NULL);
+
+    pthread_mutex_destroy(&t->lock);
+    pthread_cond_destroy(&t->cond);
+    free(t);
+}
@@ -21,6 +21,7 @@ from distutils.command.clean import clean
 import unittest
 import os
 import shutil
+import sys
 
 NAME = "pynmsg"
 VERSION = "0.5.1"
@@ -92,18 +93,35 @@ try:
             extra_compile_args=["-Wno-unused-variable"],
             depends=[
                 "nmsg.pxi",
+                "nmsg_columns.pyx",
+                "nmsg_convert.pyx",
+                "nmsg_fanout.pyx",
+                "nmsg_filereader.pyx",
+                "nmsg_filter.pyx",
                 "nmsg_input.pyx",
                 "nmsg_io.pyx",
                 "nmsg_message.pyx",
                 "nmsg_msgmod.pyx",
                 "nmsg_msgtype.pyx",
                 "nmsg_output.pyx",
+                "nmsg_profile.pyx",
+                "nmsg_schema.pyx",
+                "nmsg_stats.pyx",
+                "nmsg_sockinput.pyx",
                 "nmsg_util.pyx",
+                "output_thread.c",
+                "sock_recv.c",
             ],
-            **pkgconfig("libnmsg >= 0.10.0")
+            **pkgconfig("libnmsg >= 1.0.0")
         )
     ]
 
+    # nmsg_asyncio uses Python 3 syntax and needs 3.7 at runtime; Python 2
+    # would fail to byte-compile it.
+    py_modules = ["nmsg"]
+    if sys.version_info >= (3, 7):
+        py_modules.append("nmsg_asyncio")
+
     for f in ["_nmsg.c", "_nmsg.h"]:
         try:
             os.remove(f)
@@ -113,13 +131,11 @@ try:
         ext_modules=cythonize(extensions),
         name=NAME,
         version=VERSION,
-        py_modules=["nmsg"],
+        py_modules=py_modules,
         cmdclass={"test": Test, "clean": Cleaner},
         zip_safe=True,
     )
 except ImportError as e:
-    import sys
-
     print(
         "Cython is required. You are building with Python {}".format(
             sys.version_info.major
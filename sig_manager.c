@@ -25,6 +25,8 @@ static void setup_sighandler(void)
         perror("sigaction");
     if (sigaction(SIGINT, &sa, NULL))
         perror("sigaction");
+    if (sigaction(SIGTERM, &sa, NULL))
+        perror("sigaction");
     if (sigaction(SIGALRM, &sa, NULL))
         perror("sigaction");
 }
@@ -0,0 +1,201 @@
+/*
+ * Copyright (c) 2026 by Farsight Security, Inc.
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *    http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+
+/* Batched datagram receive for sockinput. Uses recvmmsg() where available
+ * and falls back to a recvmsg() loop elsewhere. */
+
+#include <errno.h>
+#include <poll.h>
+#include <stdint.h>
+#include <stdlib.h>
+#include <string.h>
+#include <sys/types.h>
+#include <sys/socket.h>
+#include <sys/uio.h>
+
+#if defined(__linux__) && !defined(SO_RXQ_OVFL)
+#define SO_RXQ_OVFL 40
+#endif
+
+#define PYNMSG_CTRLSZ 64
+
+struct pynmsg_mmsghdr {
+    struct msghdr msg_hdr;
+    unsigned int msg_len;
+};
+
+struct pynmsg_sockbuf {
+    unsigned int vlen;
+    size_t bufsz;
+    uint8_t *data;
+    char *ctrl;
+    struct iovec *iov;
+    struct sockaddr_storage *addrs;
+#ifdef __linux__
+    struct mmsghdr *hdrs;
+#else
+    struct pynmsg_mmsghdr *hdrs;
+#endif
+    /* Latest SO_RXQ_OVFL value, the kernel's running count of datagrams
+     * dropped on this socket for lack of buffer space. */
+    uint32_t drops;
+    uint64_t truncated;
+};
+
+__attribute__((unused))
+static void
+pynmsg_sockbuf_free(struct pynmsg_sockbuf *sb)
+{
+    if (sb == NULL)
+        return;
+    free(sb->data);
+    free(sb->ctrl);
+    free(sb->iov);
+    free(sb->addrs);
+    free(sb->hdrs);
+    free(sb);
+}
+
+__attribute__((unused))
+static struct pynmsg_sockbuf *
+pynmsg_sockbuf_new(unsigned int vlen, size_t bufsz)
+{
+    struct pynmsg_sockbuf *sb;
+
+    sb = calloc(1, sizeof(*sb));
+    if (sb == NULL)
+        return NULL;
+    sb->vlen = vlen;
+    sb->bufsz = bufsz;
+    sb->data = malloc(vlen * bufsz);
+    sb->ctrl = malloc(vlen * PYNMSG_CTRLSZ);
+    sb->iov = calloc(vlen, sizeof(*sb->iov));
+    sb->addrs = calloc(vlen, sizeof(*sb->addrs));
+    sb->hdrs = calloc(vlen, sizeof(*sb->hdrs));
+    if (sb->data == NULL || sb->ctrl == NULL || sb->iov == NULL ||
+        sb->addrs == NULL || sb->hdrs == NULL)
+    {
+        pynmsg_sockbuf_free(sb);
+        return NULL;
+    }
+
+    for (unsigned int i = 0; i < vlen; i++) {
+        sb->iov[i].iov_base = sb->data + i * bufsz;
+        sb->iov[i].iov_len = bufsz;
+        sb->hdrs[i].msg_hdr.msg_iov = &sb->iov[i];
+        sb->hdrs[i].msg_hdr.msg_iovlen = 1;
+    }
+    return sb;
+}
+
+static void
+pynmsg_sockbuf_reset(struct pynmsg_sockbuf *sb, unsigned int i)
+{
+    struct msghdr *mh = &sb->hdrs[i].msg_hdr;
+
+    mh->msg_name = &sb->addrs[i];
+    mh->msg_namelen = sizeof(sb->addrs[i]);
+    mh->msg_control = sb->ctrl + i * PYNMSG_CTRLSZ;
+    mh->msg_controllen = PYNMSG_CTRLSZ;
+    mh->msg_flags = 0;
+}
+
+static void
+pynmsg_sockbuf_scan(struct pynmsg_sockbuf *sb, unsigned int i)
+{
+    struct msghdr *mh = &sb->hdrs[i].msg_hdr;
+    struct cmsghdr *cm;
+
+    if (mh->msg_flags & MSG_TRUNC)
+        sb->truncated++;
+#ifdef SO_RXQ_OVFL
+    for (cm = CMSG_FIRSTHDR(mh); cm != NULL; cm = CMSG_NXTHDR(mh, cm)) {
+        if (cm->cmsg_level == SOL_SOCKET && cm->cmsg_type == SO_RXQ_OVFL)
+            memcpy(&sb->drops, CMSG_DATA(cm), sizeof(sb->drops));
+    }
+#else
+    (void)cm;
+#endif
+}
+
+/* Waits up to timeout_ms for the socket to become readable, then receives
+ * as many datagrams as are queued, up to vlen. Returns the number received,
+ * 0 on timeout or interruption, or -1 with errno set. */
+__attribute__((unused))
+static int
+pynmsg_sockbuf_recv(int fd, struct pynmsg_sockbuf *sb, int timeout_ms)
+{
+    struct pollfd pfd;
+    int n, rc;
+
+    pfd.fd = fd;
+    pfd.events = POLLIN;
+    rc = poll(&pfd, 1, timeout_ms);
+    if (rc == 0 || (rc < 0 && errno == EINTR))
+        return 0;
+    if (rc < 0)
+        return -1;
+
+    for (unsigned int i = 0; i < sb->vlen; i++)
+        pynmsg_sockbuf_reset(sb, i);
+
+#ifdef __linux__
+    n = recvmmsg(fd, sb->hdrs, sb->vlen, MSG_DONTWAIT, NULL);
+#else
+    for (n = 0; (unsigned int)n < sb->vlen; n++) {
+        ssize_t len = recvmsg(fd, &sb->hdrs[n].msg_hdr, MSG_DONTWAIT);
+        if (len < 0)
+            break;
+        sb->hdrs[n].msg_len = (unsigned int)len;
+    }
+    if (n == 0)
+        n = -1;
+#endif
+    if (n < 0) {
+        if (errno == EAGAIN || errno == EWOULDBLOCK || errno == EINTR)
+            return 0;
+        return -1;
+    }
+
+    for (int i = 0; i < n; i++)
+        pynmsg_sockbuf_scan(sb, i);
+    return n;
+}
+
+__attribute__((unused))
+static uint8_t *
+pynmsg_sockbuf_datagram(struct pynmsg_sockbuf *sb, unsigned int i, size_t *len)
+{
+    *len = sb->hdrs[i].msg_len;
+    if (*len > sb->bufsz)
+        *len = sb->bufsz;
+    return sb->iov[i].iov_base;
+}
+
+/* Asks the kernel to report its drop counter with each datagram. Returns 0
+ * on success, -1 where SO_RXQ_OVFL is not supported. */
+__attribute__((unused))
+static int
+pynmsg_enable_rxq_ovfl(int fd)
+{
+#ifdef SO_RXQ_OVFL
+    int on = 1;
+    return setsockopt(fd, SOL_SOCKET, SO_RXQ_OVFL, &on, sizeof(on));
+#else
+    (void)fd;
+    return -1;
+#endif
+}
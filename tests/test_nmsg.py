@@ -23,6 +23,10 @@ import warnings
 import multiprocessing as mp
 import socket
 import tempfile
+import shutil
+import zlib
+
+import _nmsg
 
 try:
     # This is needed because 'spawn' is the start method in macos by default since 3.8.
@@ -90,6 +94,38 @@ class fileobj(object):
         return self.fd
 
 
+def _msg_time(msg):
+    return (msg.time_sec, msg.time_nsec)
+
+
+def _write_fragmented(path):
+    # data, then one message too large for a 512-byte container, which is
+    # written as a run of fragment containers, then data again.
+    m = nmsg.msgtype.base.encode()
+    m.time_sec = 1700000000
+    m.time_nsec = 0
+    m["type"] = "TEXT"
+    m["payload"] = b"x" * 4000
+    with open(path, "wb") as f:
+        f.write(data)
+        f.flush()
+        o = nmsg.output.open_file(f, bufsz=512)
+        o.write(m)
+        o.flush()
+        f.write(data)
+
+
+def _wait_for(pred, timeout=10):
+    # Polls pred until it holds or timeout seconds pass, so tests that wait
+    # on a background thread do not depend on how fast it is scheduled.
+    deadline = time.time() + timeout
+    while not pred():
+        if time.time() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
 class TestNMSG(unittest.TestCase):
     def test_nullinput(self):
         ni = nmsg.nullinput()
@@ -100,6 +136,279 @@ class TestNMSG(unittest.TestCase):
         self.assertEqual(j["message"]["type"], "TEXT")
         self.assertEqual(j["message"]["payload"], expected)
 
+    def test_nullinput_lazy(self):
+        eager = nmsg.nullinput().read(data)[0]
+
+        ni = nmsg.nullinput()
+        ni.set_lazy(True)
+        m = ni.read(data)[0]
+
+        self.assertIn("payload", m)
+        self.assertNotIn("no_such_field", m)
+        self.assertEqual(m["type"], "TEXT")
+        self.assertEqual(m["payload"], b'"FSI SIE heartbeat"')
+        self.assertEqual(sorted(m.keys()), sorted(eager.keys()))
+        self.assertEqual(m.fields, eager.fields)
+
+        m = ni.read(data)[0]
+        self.assertEqual(type(m.keys()), type(eager.keys()))
+        self.assertIs(m.field_types, m.field_types)
+
+    def test_nullinput_buffers(self):
+        ni = nmsg.nullinput()
+        self.assertEqual(len(ni.read(bytearray(data))), 10)
+
+        padded = b"xxxx" + data + b"yyyy"
+        self.assertEqual(len(ni.read(memoryview(padded)[4 : 4 + len(data)])), 10)
+        self.assertEqual(len(ni.read(padded, offset=4, length=len(data))), 10)
+        with self.assertRaises(ValueError):
+            ni.read(data, offset=len(data) + 1)
+
+        batch = ni.read_batch(data)
+        self.assertEqual(len(batch), 10)
+        self.assertIs(batch[3], batch[3])
+        self.assertEqual(batch[-1]["type"], "TEXT")
+        self.assertEqual(len(list(batch)), 10)
+
+    def test_msgtype_lazy(self):
+        cls = nmsg.msgtype.base.dnsqr
+        self.assertIs(nmsg.msgtype.base.dnsqr, cls)
+        self.assertIs(nmsg.msgtype.isc.dnsqr, cls)
+        self.assertEqual(cls().vid, nmsg.msgtype.base._vid)
+        self.assertIn("ncap", dir(nmsg.msgtype.base))
+        self.assertIn("base", dir(nmsg.msgtype))
+        with self.assertRaises(AttributeError):
+            nmsg.msgtype.nosuchvendor
+        with self.assertRaises(AttributeError):
+            nmsg.msgtype.base.nosuchtype
+
+    def test_header_only(self):
+        full = nmsg.nullinput().read(data)
+        ni = nmsg.nullinput()
+        ni.set_header_only(True)
+        headers = ni.read(data)
+        self.assertEqual(len(headers), 10)
+        for h, m in zip(headers, full):
+            self.assertEqual((h.vid, h.msgtype), (m.vid, m.msgtype))
+            self.assertEqual((h.time_sec, h.time_nsec), (m.time_sec, m.time_nsec))
+            self.assertIsNone(h.operator)
+        with self.assertRaises(AttributeError):
+            headers[0].extra = 1
+
+        out = []
+        o = nmsg.output.open_callback(out.append, header_only=True)
+        o.write(headers[0])
+        self.assertEqual(out[0].time_sec, headers[0].time_sec)
+        self.assertFalse(hasattr(out[0], "keys"))
+
+        m = headers[1].upgrade()
+        self.assertIs(headers[1].upgrade(), m)
+        self.assertEqual(m["type"], "TEXT")
+        self.assertEqual(m.to_json(), full[1].to_json())
+
+    def test_nullinput_filter(self):
+        def count(expr):
+            ni = nmsg.nullinput()
+            ni.set_filter(expr)
+            return len(ni.read(data))
+
+        F = nmsg.field
+        self.assertEqual(count(F("type") == "TEXT"), 10)
+        self.assertEqual(count(F("type") == "JSON"), 0)
+        self.assertEqual(count(F("type").isin(["JSON", "TEXT"])), 10)
+        self.assertEqual(count(F("type") != "TEXT"), 0)
+        self.assertEqual(count(F("type").between(0, 0)), 10)
+        self.assertEqual(count(F("payload").startswith(b'"FSI')), 10)
+        self.assertEqual(count(F("payload").endswith(b"nope")), 0)
+        self.assertEqual(count((F("type") == "JSON") | F("payload").exists()), 10)
+        self.assertEqual(count(~F("payload").exists()), 0)
+        self.assertEqual(count(F("no_such_field") == 1), 0)
+        with self.assertRaises(ValueError):
+            count(F("payload") > 1)
+
+    def test_nullinput_sample(self):
+        ni = nmsg.nullinput()
+        ni.set_sample(5)
+        self.assertEqual(len(ni.read(data)), 2)
+
+        # every message has the same type, so all are kept or none are
+        ni.set_sample(3, key="type")
+        self.assertIn(len(ni.read(data)), (0, 10))
+
+        ni.set_sample(None)
+        self.assertEqual(len(ni.read(data)), 10)
+
+    def test_output_rate(self):
+        mlist = nmsg.nullinput().read(data)
+        seen = []
+        rate = 20
+        o = nmsg.output.open_callback(seen.append)
+        # Check the clock on every message rather than every 100.
+        o.set_rate(rate, 1)
+        start = time.time()
+        for m in mlist:
+            o.write(m)
+        elapsed = time.time() - start
+        self.assertEqual(len(seen), len(mlist))
+        # At least the len(mlist) - 1 intervals between messages, less a
+        # tenth for timer slack. A slow host only makes this longer.
+        self.assertTrue(elapsed >= 0.9 * (len(mlist) - 1) / float(rate), elapsed)
+
+        # libnmsg takes over rates given to file and socket outputs,
+        # including across replacement and when the output joins an io.
+        o = nmsg.output.open_file(open(os.devnull, "w"))
+        o.set_rate(1000)
+        o.set_rate(2000)
+        o.write(mlist[0])
+        o.set_rate(None)
+        o.set_rate(1000)
+        o.close()
+
+        o = nmsg.output.open_file(open(os.devnull, "w"))
+        o.set_rate(1000)
+        io = nmsg.io()
+        io.add_output(o)
+        del io, o
+
+    def test_output_async(self):
+        mlist = nmsg.nullinput().read(data)
+        expected = [m.to_json() for m in mlist]
+        with tempfile.NamedTemporaryFile(prefix="test-async-", dir="/tmp") as f:
+            o = nmsg.output.open_file(f.name)
+            o.set_async(4, "block")
+            for m in mlist:
+                o.write(m)
+            # Messages given to the writer are rebuilt on the next use.
+            mlist[0]["payload"] = b"changed"
+            o.write(mlist[0])
+            o.flush()
+            st = o.async_stats()
+            self.assertEqual(st["written"], 11)
+            self.assertEqual(st["depth"], 0)
+            o.close()
+
+            msgs = list(nmsg.input.open_file(f.name))
+            self.assertEqual([m.to_json() for m in msgs[:10]], expected)
+            self.assertEqual(msgs[10]["payload"], b"changed")
+
+        o = nmsg.output.open_file(open(os.devnull, "w"))
+        with self.assertRaises(ValueError):
+            o.set_async(4, "sometimes")
+        o.set_async(1, "drop_newest")
+        for m in nmsg.nullinput().read(data):
+            o.write(m)
+        o.flush()
+        st = o.async_stats()
+        self.assertEqual(st["written"] + st["dropped_newest"], 10)
+        with self.assertRaises(Exception):
+            nmsg.output.open_callback(len).set_async()
+
+    def test_output_max_delay(self):
+        m = nmsg.nullinput().read(data)[0]
+        with tempfile.NamedTemporaryFile(prefix="test-delay-", dir="/tmp") as f:
+            def count():
+                return len(list(nmsg.input.open_file(f.name)))
+
+            # A long max_delay leaves plenty of time to see the message is
+            # still buffered; the flush itself is waited for, not timed.
+            o = nmsg.output.open_file(f.name, max_delay=1)
+            o.write(m)
+            self.assertEqual(count(), 0)
+            self.assertTrue(_wait_for(lambda: count() == 1))
+            self.assertEqual(o.async_stats()["timed_flushes"], 1)
+
+            o.set_async(16)
+            o.write(m)
+            self.assertTrue(_wait_for(lambda: count() == 2))
+            o.close()
+
+    def test_stats(self):
+        ni = nmsg.nullinput()
+        with self.assertRaises(Exception):
+            ni.stats()
+        ni.set_stats(True)
+        ni.set_filter(nmsg.field("type") == "TEXT")
+        mlist = ni.read(data)
+        st = ni.stats()
+        self.assertEqual(st["containers"], 1)
+        self.assertEqual(st["bytes"], len(data))
+        self.assertEqual(st["messages"], 10)
+        self.assertEqual(st["filtered"], 0)
+
+        o = nmsg.output.open_callback(lambda m: None)
+        o.set_stats(True)
+        for m in mlist:
+            o.write(m)
+        st = o.stats()
+        self.assertEqual(st["messages"], 10)
+        self.assertEqual(st["callbacks"], 10)
+        self.assertEqual(sum(c for _, c in st["callback_histogram"]), 10)
+
+        snapshots = []
+        mon = nmsg.stats_monitor(o, snapshots.append, interval=0.05)
+        mon.start()
+        self.assertTrue(_wait_for(lambda: snapshots))
+        mon.stop()
+        self.assertEqual(snapshots[-1]["messages"], 10)
+
+    def test_profile(self):
+        seen = []
+        nmsg.profile_reset()
+        nmsg.profile_enable(lambda *args: seen.append(args))
+        try:
+            mlist = nmsg.nullinput().read(data)
+        finally:
+            nmsg.profile_disable()
+        st = nmsg.profile_stats()
+        key = (mlist[0].vid, mlist[0].msgtype)
+        self.assertEqual(st[key]["decode"]["count"], 10)
+        self.assertEqual(st[None]["read"]["count"], 1)
+        self.assertIn("decode", [s[0] for s in seen])
+
+        nmsg.nullinput().read(data)
+        self.assertEqual(nmsg.profile_stats()[key]["decode"]["count"], 10)
+        nmsg.profile_reset()
+        self.assertEqual(nmsg.profile_stats(), {})
+
+    def test_schema_shared(self):
+        mlist = nmsg.nullinput().read(data)
+        m = nmsg.msgtype.base.encode()
+
+        self.assertIs(mlist[0].field_names, mlist[1].field_names)
+        self.assertIs(mlist[0].field_names, m.field_names)
+        self.assertIn("payload", m.field_names)
+
+        m["type"] = "TEXT"
+        m["payload"] = b"hello"
+        j = json.loads(m.to_json())
+        self.assertEqual(j["message"]["type"], "TEXT")
+
+    def test_nullinput_columns(self):
+        cols = nmsg.nullinput().read_columns(data, "base", "encode")
+        self.assertEqual(len(cols), 10)
+        self.assertEqual(len(cols.time_sec), 10)
+
+        payload = cols["payload"]
+        self.assertEqual(list(payload.valid), [1] * 10)
+        offs = payload.value_offsets
+        self.assertEqual(
+            bytes(bytearray(payload.values[offs[0] : offs[1]])), b'"FSI SIE heartbeat"'
+        )
+
+        t = cols["type"]
+        self.assertEqual(t.enum_names[int(t.values[0])], "TEXT")
+
+        # With numpy, columns are views over the native buffers.
+        if hasattr(cols.time_sec, "flags"):
+            self.assertFalse(cols.time_sec.flags.owndata)
+            self.assertFalse(isinstance(cols.time_sec.base, bytes))
+        elif isinstance(cols.time_sec, memoryview):
+            self.assertTrue(cols.time_sec.readonly)
+            self.assertEqual(cols.time_sec.format, "q")
+
+        cols = nmsg.nullinput().read_columns(data, "base", "dnsqr")
+        self.assertEqual(len(cols), 0)
+
     @ignore_warnings
     def test_send_recv_filter_match(self):
         ni = nmsg.nullinput()
@@ -211,6 +520,82 @@ class TestNMSG(unittest.TestCase):
         self.assertEqual(j, None)
         r.close()
 
+    @ignore_warnings
+    def test_sockinput_batch(self):
+        r = nmsg.input_open_sock_batch("127.0.0.1", 19197, batch=16)
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        n_datagrams = 200
+        for _ in range(n_datagrams):
+            s.sendto(data, ("127.0.0.1", 19197))
+        s.close()
+
+        mlist = []
+        while len(mlist) < n_datagrams * 10:
+            batch = r.read_many(1000, timeout=2)
+            if not batch:
+                break
+            mlist.extend(batch)
+        stats = r.stats()
+        r.close()
+
+        self.assertEqual(len(mlist), n_datagrams * 10)
+        self.assertEqual(mlist[0]["type"], "TEXT")
+        self.assertEqual(stats["datagrams"], n_datagrams)
+        self.assertEqual(stats["bytes"], n_datagrams * len(data))
+        self.assertEqual(stats["messages"], n_datagrams * 10)
+        self.assertEqual(stats["errors"], 0)
+
+    def _drain_shards(self, shards, expected):
+        mlist = []
+        while len(mlist) < expected:
+            got = 0
+            for r in shards:
+                batch = r.read_many(1000, timeout=0.5)
+                got += len(batch)
+                mlist.extend(batch)
+            if not got:
+                break
+        return mlist
+
+    def test_sockinput_ipv6(self):
+        if not socket.has_ipv6:
+            self.skipTest("no IPv6 support")
+        try:
+            r = nmsg.input_open_sock_batch("::1", 19198, batch=4)
+        except socket.error:
+            self.skipTest("no IPv6 loopback")
+        s = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
+        for _ in range(3):
+            s.sendto(data, ("::1", 19198))
+        s.close()
+
+        mlist = self._drain_shards([r], 30)
+        stats = r.stats()
+        r.close()
+        self.assertEqual(len(mlist), 30)
+        self.assertEqual(stats["datagrams"], 3)
+
+    @unittest.skipUnless(hasattr(socket, "SO_REUSEPORT"), "no SO_REUSEPORT")
+    def test_sockinput_shards(self):
+        shards = nmsg.sockinput.open_shards("127.0.0.1", 19199, 2, batch=8)
+        self.assertEqual(len(shards), 2)
+        # Separate sending sockets are separate flows for the kernel to
+        # spread; every datagram reaches exactly one shard.
+        n_datagrams = 0
+        for _ in range(8):
+            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            for _ in range(5):
+                s.sendto(data, ("127.0.0.1", 19199))
+                n_datagrams += 1
+            s.close()
+
+        mlist = self._drain_shards(shards, n_datagrams * 10)
+        stats = [r.stats() for r in shards]
+        for r in shards:
+            r.close()
+        self.assertEqual(len(mlist), n_datagrams * 10)
+        self.assertEqual(sum(st["datagrams"] for st in stats), n_datagrams)
+
     @ignore_warnings
     def test_message_http(self):
         # See https://github.com/farsightsec/nmsg/blob/master/nmsg/base/http.proto
@@ -324,6 +709,467 @@ class TestNMSG(unittest.TestCase):
         s.close()
         p.join()
 
+    @ignore_warnings
+    def test_input_read_many(self):
+        with tempfile.NamedTemporaryFile(
+            prefix="test-data-", dir="/tmp", delete=True
+        ) as f:
+            f.write(data)
+            f.flush()
+
+            nif = nmsg.input_open_file(f.name)
+            batch = nif.read_many(4)
+            self.assertEqual(len(batch), 4)
+            self.assertEqual(len(nif.read_many(100)), 6)
+            self.assertEqual(nif.read_many(100), [])
+            nif.close()
+
+            nif = nmsg.input_open_file(f.name)
+            mlist = list(nif)
+            self.assertEqual(len(mlist), 10)
+            self.assertEqual(mlist[0]["type"], "TEXT")
+            nif.close()
+
+        # A partial batch from a blocking socket is returned once the
+        # socket runs dry.
+        r = nmsg.input.open_sock("127.0.0.1", 19198)
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        s.sendto(data, ("127.0.0.1", 19198))
+        self.assertEqual(len(r.read_many(100)), 10)
+        self.assertEqual(r.read_many(100, timeout=0.1), [])
+        s.close()
+        r.close()
+
+    @ignore_warnings
+    def test_filereader_index(self):
+        with tempfile.NamedTemporaryFile(
+            prefix="test-data-", dir="/tmp", delete=True
+        ) as f:
+            f.write(data)
+            f.write(data)
+            f.flush()
+
+            r = nmsg.filereader(f.name)
+            self.assertEqual(len(r), 2)
+            self.assertEqual(sum(r.counts().values()), 20)
+            c = r.container(1)
+            self.assertEqual(c["offset"], len(data))
+            self.assertEqual(c["count"], 10)
+            self.assertTrue(c["first"] <= c["last"])
+
+            self.assertEqual(len(r.read_container(1)), 10)
+            self.assertEqual(len(list(r.between(c["first"], c["last"] + 1))), 20)
+            self.assertEqual(len(list(r.between(0, c["first"]))), 0)
+
+            r.seek(1)
+            self.assertEqual(len(list(r)), 10)
+            r.seek_time(c["last"] + 1)
+            self.assertEqual(r.tell(), 2)
+            self.assertEqual(r.find_time(0), 0)
+            self.assertEqual(r.find_time(c["last"]), 0)
+
+            r.save_index()
+            try:
+                r2 = nmsg.filereader(f.name)
+                self.assertEqual(r2.container(1), c)
+                r2.close()
+            finally:
+                os.unlink(f.name + ".idx.json")
+            r.close()
+
+    @ignore_warnings
+    def test_map_file(self):
+        with tempfile.NamedTemporaryFile(
+            prefix="test-data-", dir="/tmp", delete=True
+        ) as f:
+            for _ in range(5):
+                f.write(data)
+            f.flush()
+
+            expected_times = [_msg_time(m) for m in nmsg.input.open_file(f.name)]
+            self.assertEqual(len(expected_times), 50)
+
+            times = list(
+                nmsg.map_file(f.name, _msg_time, processes=2, containers_per_chunk=2)
+            )
+            self.assertEqual(times, expected_times)
+
+            times = nmsg.map_file(f.name, _msg_time, processes=2, ordered=False)
+            self.assertEqual(sorted(times), sorted(expected_times))
+
+        with tempfile.NamedTemporaryFile(prefix="test-data-", dir="/tmp") as f:
+            _write_fragmented(f.name)
+            expected_times = [_msg_time(m) for m in nmsg.input.open_file(f.name)]
+            self.assertEqual(len(expected_times), 21)
+            times = list(
+                nmsg.map_file(f.name, _msg_time, processes=2, containers_per_chunk=1)
+            )
+            self.assertEqual(times, expected_times)
+
+    @ignore_warnings
+    def test_filereader_fragments(self):
+        with tempfile.NamedTemporaryFile(prefix="test-data-", dir="/tmp") as f:
+            _write_fragmented(f.name)
+
+            r = nmsg.filereader(f.name)
+            fragments = [i for i in range(len(r)) if r.container(i)["fragment"]]
+            self.assertTrue(len(fragments) > 1)
+            mlist = list(r)
+            self.assertEqual(len(mlist), 21)
+            self.assertEqual(len(mlist[10]["payload"]), 4000)
+            self.assertEqual(len(list(r.between(0, 2 ** 33))), 21)
+
+    def test_jsonl_convert(self):
+        tmpdir = tempfile.mkdtemp(prefix="test-convert-", dir="/tmp")
+        self.addCleanup(shutil.rmtree, tmpdir)
+        src = os.path.join(tmpdir, "in.nmsg")
+        with open(src, "wb") as f:
+            for _ in range(5):
+                f.write(data)
+        expected = [m.to_json() for m in nmsg.input.open_file(src)]
+
+        for threads in (1, 2):
+            jsonl = os.path.join(tmpdir, "out-%d.jsonl" % threads)
+            st = nmsg.nmsg_to_jsonl(src, jsonl, threads=threads, containers_per_chunk=2)
+            self.assertEqual(st, {"messages": 50, "errors": 0})
+            with open(jsonl) as f:
+                self.assertEqual(f.read().splitlines(), expected)
+
+            out = os.path.join(tmpdir, "out-%d.nmsg" % threads)
+            st = nmsg.jsonl_to_nmsg(jsonl, out, threads=threads, chunk_size=256)
+            self.assertEqual(st, {"messages": 50, "errors": 0})
+            self.assertEqual([m.to_json() for m in nmsg.input.open_file(out)], expected)
+
+        # Paths may also be bytes or os.PathLike.
+        import pathlib
+
+        jsonl = pathlib.Path(tmpdir) / "out-path.jsonl"
+        st = nmsg.nmsg_to_jsonl(os.fsencode(src), jsonl, threads=2, containers_per_chunk=2)
+        self.assertEqual(st, {"messages": 50, "errors": 0})
+        st = nmsg.jsonl_to_nmsg(jsonl, os.fsencode(os.path.join(tmpdir, "out-path.nmsg")))
+        self.assertEqual(st, {"messages": 50, "errors": 0})
+
+    @ignore_warnings
+    def test_io_batched_callback(self):
+        with tempfile.NamedTemporaryFile(
+            prefix="test-data-", dir="/tmp", delete=True
+        ) as f:
+            f.write(data)
+            f.flush()
+
+            batches = []
+            io = nmsg.io()
+            io.add_input(nmsg.input.open_file(f.name))
+            io.add_output_callback(batches.append, batch_size=4, max_delay=1)
+            io.loop()
+
+            self.assertEqual(sum(len(b) for b in batches), 10)
+            self.assertTrue(all(len(b) <= 4 for b in batches))
+            self.assertEqual(batches[0][0]["type"], "TEXT")
+
+            # An exception from a batched callback stops the loop and is
+            # raised by loop().
+            def fail(batch):
+                raise ValueError("batch rejected")
+
+            io = nmsg.io()
+            io.set_stats(True)
+            io.add_input(nmsg.input.open_file(f.name))
+            io.add_output_callback(fail, batch_size=4)
+            with self.assertRaises(ValueError):
+                io.loop()
+            self.assertEqual(io.stats()["dropped"], 0)
+
+    @ignore_warnings
+    def test_io_writer_outputs(self):
+        with tempfile.NamedTemporaryFile(
+            prefix="test-data-", dir="/tmp", delete=True
+        ) as f, tempfile.NamedTemporaryFile(
+            prefix="test-out-", dir="/tmp", delete=True
+        ) as out1, tempfile.NamedTemporaryFile(
+            prefix="test-out-", dir="/tmp", delete=True
+        ) as out2:
+            f.write(data)
+            f.flush()
+
+            delayed = nmsg.output.open_file(out1.name, max_delay=0.05)
+            queued = nmsg.output.open_file(out2.name)
+            queued.set_async(4)
+            io = nmsg.io()
+            io.add_input(nmsg.input.open_file(f.name))
+            io.add_output(delayed)
+            io.add_output(queued)
+            io.loop()
+
+            for name in (out1.name, out2.name):
+                self.assertEqual(len(list(nmsg.input.open_file(name))), 10)
+            self.assertEqual(queued.async_stats()["written"], 10)
+            with self.assertRaises(Exception):
+                delayed.set_async(4)
+
+    @ignore_warnings
+    def test_io_filter(self):
+        F = nmsg.field
+        io = nmsg.io()
+        with self.assertRaises(TypeError):
+            io.set_filter("type == TEXT")
+        with self.assertRaises(ValueError):
+            io.set_filter(F("addr").in_network("10.0.0.0/40"))
+        io.set_filter_msgtype("base", "encode")
+        with self.assertRaises(ValueError):
+            io.set_filter(F("payload") > 1)
+
+        with tempfile.NamedTemporaryFile(
+            prefix="test-data-", dir="/tmp", delete=True
+        ) as f, tempfile.NamedTemporaryFile(
+            prefix="test-out-", dir="/tmp", delete=True
+        ) as out:
+            f.write(data)
+            f.flush()
+
+            for expr, n in ((F("type") == "JSON", 0), (F("type") == "TEXT", 10)):
+                seen = []
+                io = nmsg.io()
+                io.set_filter(expr)
+                io.add_input(nmsg.input.open_file(f.name))
+                io.add_output(nmsg.output.open_file(out.name))
+                io.add_output_callback(seen.append)
+                io.loop()
+                del io
+
+                self.assertEqual(len(seen), n)
+                self.assertEqual(len(list(nmsg.input.open_file(out.name))), n)
+
+            # The io's input threads share the compiled filter and the
+            # sample counter.
+            seen = []
+            io = nmsg.io()
+            io.set_filter(F("type") == "TEXT")
+            io.set_sample(5)
+            io.set_stats(True)
+            io.add_input(nmsg.input.open_file(f.name))
+            io.add_input(nmsg.input.open_file(f.name))
+            io.add_output_callback(seen.append)
+            io.loop()
+            self.assertEqual(len(seen), 4)
+            self.assertEqual(io.stats()["sampled_out"], 16)
+            self.assertEqual(io.stats()["filtered"], 0)
+
+    @ignore_warnings
+    def test_output_group(self):
+        m = nmsg.nullinput().read(data)[0]
+        with tempfile.NamedTemporaryFile(
+            prefix="test-data-", dir="/tmp", delete=True
+        ) as f1, tempfile.NamedTemporaryFile(
+            prefix="test-data-", dir="/tmp", delete=True
+        ) as f2:
+            g = nmsg.output_group(
+                [nmsg.output.open_file(f1.name), nmsg.output.open_file(f2.name)]
+            )
+            m.freeze()
+            g.write(m)
+            g.write(m)
+            g.flush()
+
+            self.assertEqual(m["type"], "TEXT")
+            with self.assertRaises(Exception):
+                m["type"] = "JSON"
+
+            for name in (f1.name, f2.name):
+                mlist = list(nmsg.input.open_file(name))
+                self.assertEqual(len(mlist), 2)
+                self.assertEqual(mlist[1]["payload"], b'"FSI SIE heartbeat"')
+
+        # Callback outputs get a copy; the frozen message is untouched.
+        seen = []
+        g = nmsg.output_group([nmsg.output.open_callback(seen.append)])
+        g.write(m)
+        g.write(m)
+        self.assertEqual(len(seen), 2)
+        self.assertTrue(m.frozen)
+        self.assertEqual(seen[1]["payload"], m["payload"])
+        with self.assertRaises(Exception):
+            m["type"] = "JSON"
+
+        # Asynchronous outputs queue a copy for their writer thread.
+        with tempfile.NamedTemporaryFile(prefix="test-data-", dir="/tmp") as f:
+            a = nmsg.output.open_file(f.name)
+            a.set_async(4)
+            seen = []
+            g = nmsg.output_group([a, nmsg.output.open_callback(seen.append)])
+            for _ in range(3):
+                g.write(m)
+            g.flush()
+            self.assertEqual(a.async_stats()["written"], 3)
+            self.assertEqual(len(seen), 3)
+            self.assertTrue(m.frozen)
+            mlist = list(nmsg.input.open_file(f.name))
+            self.assertEqual([x.to_json() for x in mlist], [m.to_json()] * 3)
+            a.close()
+
+    def test_fanout(self):
+        socks = [("127.0.0.1", port) for port in range(19200, 19205)]
+        f = nmsg.fanout(socks, lambda m: None, workers=2)
+        self.assertEqual(f.worker_socks(0), socks[0::2])
+        self.assertEqual(f.worker_socks(1), socks[1::2])
+        # With a key the dispatcher binds the sockets, not the workers.
+        self.assertEqual(nmsg.fanout(socks, None, workers=2, key="source").worker_socks(1), [])
+        # At most one worker per socket without a key.
+        self.assertEqual(nmsg.fanout(socks[:1], None, workers=4).workers, 1)
+
+        counters = f.counters()
+        self.assertEqual(len(counters), 2)
+        self.assertEqual(sorted(counters[0]), ["errors", "processed", "received"])
+        f.counters_array[1 * 3 + 1] = 7
+        self.assertEqual(f.counters()[1]["processed"], 7)
+        self.assertEqual(f.counters()[0]["processed"], 0)
+
+        h = _nmsg._fanout_key_hash
+        self.assertEqual(h(b"abc"), zlib.crc32(b"abc") & 0xFFFFFFFF)
+        self.assertEqual(h(u"abc"), h(b"abc"))
+        self.assertEqual(h(12345), 12345)
+
+    def _fanout_feed(self, f, port):
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        deadline = time.time() + 30
+        while sum(c["received"] for c in f.counters()) == 0 and time.time() < deadline:
+            s.sendto(data, ("127.0.0.1", port))
+            time.sleep(0.1)
+        s.close()
+
+    @ignore_warnings
+    def test_fanout_key(self):
+        f = nmsg.fanout([("127.0.0.1", 19206)], lambda m: None, workers=2, key=lambda m: 0)
+        f.start()
+        try:
+            self.assertEqual(len(f.processes), 3)
+            self._fanout_feed(f, 19206)
+        finally:
+            f.stop()
+        counters = f.counters()
+        self.assertTrue(counters[0]["received"] > 0)
+        self.assertEqual(counters[1]["received"], 0)
+
+    @ignore_warnings
+    def test_fanout_stop_stuck_worker(self):
+        f = nmsg.fanout([("127.0.0.1", 19205)], lambda m: time.sleep(3600), workers=1)
+        f.start()
+        self._fanout_feed(f, 19205)
+        procs = list(f.processes)
+
+        # SIGTERM interrupts the callback through the io signal handler.
+        f.stop(timeout=5)
+        self.assertFalse(any(p.is_alive() for p in procs))
+        self.assertEqual(f.processes, [])
+
+    def test_partitioned_output(self):
+        mlist = nmsg.nullinput().read(data)
+        seen = [[], [], []]
+        outs = [nmsg.output.open_callback(s.append) for s in seen]
+
+        p = nmsg.partitioned_output(outs)
+        for m in mlist:
+            p.write(m)
+        self.assertEqual([len(s) for s in seen], [4, 3, 3])
+        self.assertEqual([st["messages"] for st in p.stats()], [4, 3, 3])
+
+        # Every message has the same payload, so all go to one partition.
+        p = nmsg.partitioned_output(outs, by="field", field="payload")
+        for m in mlist:
+            p.write(m)
+        counts = sorted(st["messages"] for st in p.stats())
+        self.assertEqual(counts, [0, 0, 10])
+        self.assertEqual(sum(st["errors"] for st in p.stats()), 0)
+
+        with self.assertRaises(ValueError):
+            nmsg.partitioned_output(outs, by="field")
+        with self.assertRaises(ValueError):
+            nmsg.partitioned_output(outs, by="nope")
+        with self.assertRaises(ValueError):
+            nmsg.partitioned_output([])
+
+    @ignore_warnings
+    def test_output_reuse_message(self):
+        m = nmsg.nullinput().read(data)[0]
+        r = nmsg.input.open_sock("127.0.0.1", 19206)
+        with tempfile.NamedTemporaryFile(prefix="test-data-", dir="/tmp") as f:
+            fo = nmsg.output.open_file(f.name)
+            so = nmsg.output.open_sock("127.0.0.1", 19206)
+            seen = []
+            co = nmsg.output.open_callback(seen.append)
+            # The callback output takes the instance; the message rebuilds
+            # one for the next write.
+            for o in (fo, so, co, fo, so):
+                o.write(m)
+            fo.flush()
+            so.flush()
+
+            got = list(nmsg.input.open_file(f.name)) + r.read_many(2, timeout=5) + seen
+            self.assertEqual(len(got), 5)
+            for x in got:
+                self.assertEqual(x["type"], "TEXT")
+                self.assertEqual(x["payload"], b'"FSI SIE heartbeat"')
+                self.assertEqual((x.time_sec, x.time_nsec), (m.time_sec, m.time_nsec))
+            fo.close()
+            so.close()
+        r.close()
+
+    def test_output_callback_filters(self):
+        m = nmsg.nullinput().read(data)[0]
+
+        seen = []
+        o = nmsg.output.open_callback(seen.append)
+        o.set_filter_msgtype("base", "dnsqr")
+        o.write(m)
+        self.assertEqual(seen, [])
+        o.set_filter_msgtype("base", "encode")
+        o.write(m)
+        self.assertEqual(len(seen), 1)
+
+        o = nmsg.output.open_callback(seen.append, header_only=True)
+        o.write(m)
+        self.assertIsInstance(seen[-1], nmsg.message_header)
+
+        o = nmsg.output.open_callback(seen.append, batch_size=2)
+        o.write(m)
+        o.write(m)
+        self.assertEqual(len(seen[-1]), 2)
+
+        # Batched outputs are paced by set_rate() as messages join a batch,
+        # and a partial batch goes out on its own once max_delay passes.
+        batches = []
+        o = nmsg.output.open_callback(batches.append, batch_size=100, max_delay=0.05)
+        o.set_rate(20)
+        start = time.time()
+        for _ in range(5):
+            o.write(m)
+        self.assertGreaterEqual(time.time() - start, 0.5 * 4 / 20.0)
+        self.assertTrue(_wait_for(lambda: sum(len(b) for b in batches) == 5))
+
+        def fail(msg):
+            raise ValueError("rejected")
+
+        with self.assertRaises(ValueError):
+            nmsg.output.open_callback(fail).write(m)
+
+    def test_dirty_fields(self):
+        m = nmsg.msgtype.base.dnsqr()
+        m["type"] = "TCP"
+        m["id"] = 12
+        m["response_time_sec"] = [1, 2]
+        j = json.loads(m.to_json())
+        self.assertEqual(j["message"]["response_time_sec"], [1, 2])
+
+        m["response_time_sec"].append(3)
+        j = json.loads(m.to_json())
+        self.assertEqual(j["message"]["response_time_sec"], [1, 2, 3])
+
+        del m["response_time_sec"][0]
+        j = json.loads(m.to_json())
+        self.assertEqual(j["message"]["response_time_sec"], [2, 3])
+        self.assertEqual(j["message"]["id"], 12)
+        self.assertEqual(j["message"]["type"], "TCP")
+
     @ignore_warnings
     def test_input_repr_should_not_raise(self):
         with tempfile.NamedTemporaryFile(
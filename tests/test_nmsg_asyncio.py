@@ -0,0 +1,58 @@
+# Copyright (c) 2026 by Farsight Security, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import sys
+import unittest
+
+import nmsg
+
+from tests.test_nmsg import data
+
+if sys.version_info >= (3, 7):
+    import asyncio
+    import nmsg_asyncio
+
+
+# The coroutines are driven with run_until_complete() rather than written
+# with async syntax, so this module still imports on Python 2.
+@unittest.skipIf(sys.version_info < (3, 7), "nmsg_asyncio requires Python 3.7+")
+class TestNMSGAsyncio(unittest.TestCase):
+    def test_iter_input(self):
+        mlist = nmsg.nullinput().read(data)
+        r = nmsg.input.open_sock("127.0.0.1", 19196)
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+
+        def run(aw):
+            return loop.run_until_complete(asyncio.wait_for(aw, 5))
+
+        try:
+            s = nmsg_asyncio.AsyncOutput(nmsg.output.open_sock("127.0.0.1", 19196))
+            run(s.write(mlist[0]))
+            run(s.flush())
+
+            messages = nmsg_asyncio.iter_input(r)
+            m = run(messages.__anext__())
+            run(messages.aclose())
+            run(s.close())
+        finally:
+            asyncio.set_event_loop(None)
+            loop.close()
+            r.close()
+
+        self.assertEqual(m["type"], "TEXT")
+        self.assertEqual(m["payload"], b'"FSI SIE heartbeat"')
+
+
+if __name__ == "__main__":
+    unittest.main()